@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for nltk_tgrep, run with pytest-benchmark from the top of
+the repository:
+
+    python -m pytest benchmarks
+
+Timings depend on the machine, so no timing baselines are kept in the
+repository.  To store one (e.g. for the last release), run
+
+    python -m pytest benchmarks --benchmark-save=baseline
+
+Later runs compare their timings against the latest run stored in
+``benchmarks/baselines`` for this platform, and fail if any
+benchmark's minimum time has regressed by more than the threshold set
+in ``benchmarks/pytest.ini``.  Peak memory use is compared against
+``benchmarks/baselines/memory.json`` (see ``conftest.py``); add
+``--save-memory`` to record it anew.
+'''
+
+from __future__ import print_function, unicode_literals
+import multiprocessing
+import pytest
+import nltk.tree
+from nltk_tgrep import tgrep
+from nltk_tgrep.binary_corpus import BinaryCorpus, write_binary_corpus
+from nltk_tgrep.parallel import parallel_search_corpus
+from treebank import right_branching_tree, synthetic_treebank
+
+# the relation operators, one per distinct implementation in
+# `_tgrep_relation_predicate`
+OPERATORS = ['<', '>', '<,', '>,', '<2', '>2', '<\'', '>\'', '<-2', '>-2',
+             '<:', '>:', '<<', '>>', '<<,', '>>,', '<<\'', '>>\'', '<<:',
+             '>>:', '.', ',', '..', ',,', '$', '$.', '$,', '$..', '$,,']
+
+# operators which enumerate many nodes, for the deep tree benchmarks,
+# which time each one both through a search (with a `TreeIndex`) and
+# called directly on `ParentedTree` nodes, grouped by pattern; each
+# pattern matches near the node it starts from, so that a lazy
+# enumerator can stop early
+DEEP_PATTERNS = ['S << VP', 'VP >> S', 'VP .. NN', 'NN ,, DT', 'S <<, DT',
+                 'S <<\' NN', 'VP >>, S', 'VP >>\' S', 'VP . NN', 'NN , DT']
+
+COMPILE_PATTERNS = [
+    'NP',
+    'NP < DT',
+    '/^NN/ > (NP $.. (VP << VBD))',
+    'S < (NP=s < (DT !$. JJ)) < (VP < (/^VB/ $. =s))',
+    '@ NOUN /^NN/; @ DET DT|PRP; @NOUN > (NP < @DET) !, @DET',
+    'NP [<< NN | << NNS] [$ VP | > S] !<< PP',
+]
+
+CORPUS_PATTERNS = ['NP < DT', 'VP << (NP < JJ)', '/^NN/ . VBD',
+                   'NP=n < DT : =n $.. VP']
+
+@pytest.fixture(scope='module')
+def small_corpus():
+    '''A small synthetic treebank, for the microbenchmarks.'''
+    return synthetic_treebank(20, depth=6, branching=3, seed=1)
+
+@pytest.fixture(scope='module')
+def corpus():
+    '''A synthetic treebank, for the corpus throughput benchmarks.'''
+    return synthetic_treebank(200, depth=8, branching=3, seed=2)
+
+@pytest.fixture(scope='module')
+def large_corpus():
+    '''
+    A larger synthetic treebank, for the parallel search benchmarks, so
+    that starting the worker processes does not dominate.
+    '''
+    return synthetic_treebank(2000, depth=8, branching=3, seed=3)
+
+@pytest.fixture(scope='module')
+def large_binary_corpus(large_corpus, tmpdir_factory):
+    '''`large_corpus`, written to a binary corpus file.'''
+    path = str(tmpdir_factory.mktemp('corpus').join('corpus.t2c'))
+    write_binary_corpus(path, large_corpus)
+    with BinaryCorpus(path) as corpus:
+        yield corpus
+
+@pytest.fixture(scope='module')
+def deep_tree():
+    '''A deep right-branching `ParentedTree`.'''
+    return right_branching_tree(100)
+
+@pytest.mark.parametrize('pattern', COMPILE_PATTERNS)
+def bench_compile(benchmark, pattern):
+    benchmark(tgrep.tgrep_compile, pattern)
+
+@pytest.mark.parametrize('operator', OPERATORS)
+def bench_operator(benchmark, small_corpus, operator):
+    pattern = tgrep.tgrep_compile('NP {0} NN'.format(operator))
+    def search():
+        for tree in small_corpus:
+            tgrep.tgrep_positions(tree, pattern)
+    benchmark(search)
+
+@pytest.mark.parametrize('pattern', DEEP_PATTERNS)
+def bench_deep_tree_search(benchmark, deep_tree, pattern):
+    benchmark.group = 'deep tree: ' + pattern
+    pattern = tgrep.tgrep_compile(pattern)
+    benchmark(tgrep.tgrep_positions, deep_tree, pattern)
+
+@pytest.mark.parametrize('pattern', DEEP_PATTERNS)
+def bench_deep_tree_direct(benchmark, deep_tree, pattern):
+    '''
+    Calls the compiled predicate directly on every node of a
+    `ParentedTree`, without a `TreeIndex`.
+    '''
+    benchmark.group = 'deep tree: ' + pattern
+    predicate = tgrep.tgrep_compile(pattern)
+    nodes = [deep_tree[position] for position in deep_tree.treepositions()]
+    benchmark(lambda: [predicate(node) for node in nodes])
+
+def bench_treepositions_no_leaves(benchmark, small_corpus):
+    benchmark(lambda: [tgrep.treepositions_no_leaves(tree)
+                       for tree in small_corpus])
+
+def bench_tree_index(benchmark, small_corpus):
+    benchmark(lambda: [tgrep.TreeIndex(tree) for tree in small_corpus])
+
+def _record_throughput(benchmark, corpus):
+    '''
+    Records the number of trees searched per second, unless
+    benchmarking is disabled (with ``--benchmark-disable``).
+    '''
+    if benchmark.stats is not None:
+        benchmark.extra_info['trees_per_second'] = (
+            len(corpus) / benchmark.stats.stats.mean)
+
+def _search_corpus(trees, pattern, engine):
+    '''Consumes the results of searching the corpus.'''
+    for _result in tgrep.search_corpus(trees, pattern, engine=engine):
+        pass
+
+@pytest.mark.parametrize('engine', ['node', 'set'])
+@pytest.mark.parametrize('pattern', CORPUS_PATTERNS)
+def bench_corpus_throughput(benchmark, corpus, pattern, engine):
+    pattern = tgrep.tgrep_compile(pattern)
+    benchmark(_search_corpus, corpus, pattern, engine)
+    _record_throughput(benchmark, corpus)
+
+@pytest.mark.parametrize('engine', ['node', 'set'])
+@pytest.mark.parametrize('pattern', CORPUS_PATTERNS)
+def bench_corpus_filter(benchmark, corpus, pattern, engine):
+    '''Finds the trees containing a match, stopping at the first one.'''
+    pattern = tgrep.tgrep_compile(pattern)
+    benchmark(lambda: list(tgrep.filter_corpus(corpus, pattern,
+                                               engine=engine)))
+
+def bench_corpus_parented_throughput(benchmark, corpus):
+    '''Searches the corpus after converting each tree to a ParentedTree.'''
+    pattern = tgrep.tgrep_compile('NP < DT')
+    benchmark(lambda: _search_corpus(
+        (nltk.tree.ParentedTree.convert(tree) for tree in corpus),
+        pattern, 'node'))
+    _record_throughput(benchmark, corpus)
+
+@pytest.mark.parametrize('engine', ['node', 'set'])
+@pytest.mark.parametrize('pattern', CORPUS_PATTERNS)
+def bench_corpus_memory(memory_baselines, corpus, pattern, engine):
+    '''Checks the peak memory used to search the corpus.'''
+    pattern = tgrep.tgrep_compile(pattern)
+    name = 'corpus_memory[{0}-{1}]'.format(pattern.tgrep_string, engine)
+    memory_baselines.check(name, _search_corpus, corpus, pattern, engine)
+
+@pytest.mark.parametrize('pattern', CORPUS_PATTERNS)
+def bench_array_forest_count(benchmark, corpus, pattern):
+    '''Counts the matches in the corpus, encoded as an `ArrayForest`.'''
+    pytest.importorskip('numpy')
+    from nltk_tgrep.array_forest import ArrayForest
+    forest = ArrayForest(corpus)
+    pattern = tgrep.tgrep_compile(pattern)
+    benchmark(forest.count, pattern)
+    _record_throughput(benchmark, corpus)
+
+# the numbers of worker processes for the parallel search benchmarks
+PARALLEL_PROCESSES = sorted(set([1, 2, multiprocessing.cpu_count()]))
+
+@pytest.mark.parametrize('processes', PARALLEL_PROCESSES)
+@pytest.mark.parametrize('source', ['trees', 'binary'])
+def bench_parallel_search(benchmark, large_corpus, large_binary_corpus,
+                          source, processes):
+    '''
+    Searches the corpus with `parallel_search_corpus`, either sending
+    the trees to the workers, or letting them read a binary corpus;
+    compare the timings for each number of processes in a group to
+    find the speedup.
+    '''
+    benchmark.group = 'parallel search: {0} ({1} CPUs)'.format(
+        source, multiprocessing.cpu_count())
+    trees = large_corpus if source == 'trees' else large_binary_corpus
+    pattern = tgrep.tgrep_compile('VP << (NP < JJ)')
+    benchmark.pedantic(lambda: list(parallel_search_corpus(
+        trees, pattern, processes, chunksize=100)), rounds=3)
+    _record_throughput(benchmark, large_corpus)
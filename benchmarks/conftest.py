@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Support for the benchmarks: stored peak memory baselines.
+
+pytest-benchmark compares timings against its latest stored run for
+this machine, if there is one (see ``pytest.ini``); peak memory use is
+compared here against ``baselines/memory.json``, and a benchmark fails
+if it uses more than `MEMORY_TOLERANCE` times its baseline.  Run with
+``--save-memory`` to record new baselines.
+'''
+
+from __future__ import print_function, unicode_literals
+import glob
+import io
+import json
+import os
+import tracemalloc
+import pytest
+
+MEMORY_BASELINES = os.path.join(os.path.dirname(__file__), 'baselines',
+                                'memory.json')
+MEMORY_TOLERANCE = 1.25
+
+def pytest_addoption(parser):
+    parser.addoption('--save-memory', action='store_true', default=False,
+                     help='record peak memory use as the new baselines')
+
+def pytest_configure(config):
+    '''
+    Turns off the comparison of timings when no baseline has been
+    stored for this machine, rather than failing the run.
+    '''
+    storage = config.getoption('benchmark_storage', None)
+    if storage is None:
+        # pytest-benchmark is not installed
+        return
+    from pytest_benchmark.utils import get_machine_id
+    if storage.startswith('file://'):
+        storage = storage[len('file://'):]
+    if not glob.glob(os.path.join(storage, get_machine_id(), '*.json')):
+        config.option.benchmark_compare = False
+        config.option.benchmark_compare_fail = None
+
+def _load_baselines():
+    try:
+        with io.open(MEMORY_BASELINES, encoding='utf-8') as input_file:
+            return json.load(input_file)
+    except IOError:
+        return {}
+
+class MemoryBaselines(object):
+    '''
+    Measures the peak memory use of benchmarks, and checks it against
+    (or records it as) the stored baselines.
+    '''
+
+    def __init__(self, save):
+        self.save = save
+        self.baselines = _load_baselines()
+
+    def check(self, name, function, *args):
+        '''
+        Calls `function(*args)`, and returns its peak memory use in
+        bytes, as measured by `tracemalloc`.
+        '''
+        tracemalloc.start()
+        try:
+            function(*args)
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        if self.save:
+            self.baselines[name] = peak
+        elif name in self.baselines:
+            limit = self.baselines[name] * MEMORY_TOLERANCE
+            if peak > limit:
+                pytest.fail('{0}: peak memory {1} bytes exceeds baseline {2} '
+                            'bytes by more than {3:.0%}'.format(
+                                name, peak, self.baselines[name],
+                                MEMORY_TOLERANCE - 1))
+        return peak
+
+    def write(self):
+        '''Writes the recorded baselines.'''
+        with io.open(MEMORY_BASELINES, 'w', encoding='utf-8') as output_file:
+            output_file.write(json.dumps(self.baselines, indent=2,
+                                         sort_keys=True) + '\n')
+
+@pytest.fixture(scope='session')
+def memory_baselines(request):
+    '''The `MemoryBaselines` of the benchmark session.'''
+    baselines = MemoryBaselines(request.config.getoption('--save-memory'))
+    yield baselines
+    if baselines.save:
+        baselines.write()
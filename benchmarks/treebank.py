@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Deterministic synthetic treebanks for the benchmarks.
+
+The trees use a small Penn Treebank-like set of phrase and
+part-of-speech labels, so that realistic search strings (``NP < DT``,
+``VP << NN``, etc.) have matches.  The same arguments always build the
+same trees.
+'''
+
+from __future__ import print_function, unicode_literals
+import random
+import nltk.tree
+
+PHRASE_LABELS = ['S', 'NP', 'VP', 'PP', 'ADJP', 'SBAR']
+POS_LABELS = ['DT', 'NN', 'NNS', 'JJ', 'VBD', 'VBZ', 'IN', 'PRP', 'RB']
+
+def synthetic_tree(rng, depth, branching, preterminal_prob=0.3,
+                   vocabulary=1000, label='S', tree_class=nltk.tree.Tree):
+    '''
+    Builds a random tree using the random number generator `rng`.
+
+    Phrases are at most `depth` levels deep (not counting the words),
+    and have between one and `branching` children, each of which is a
+    preterminal (a part-of-speech label over a word) with probability
+    `preterminal_prob`.  Words are drawn from `vocabulary` distinct
+    strings.
+    '''
+    if depth <= 1:
+        return tree_class(rng.choice(POS_LABELS),
+                          ['w{0}'.format(rng.randrange(vocabulary))])
+    children = []
+    for _ in range(rng.randint(1, branching)):
+        if rng.random() < preterminal_prob:
+            children.append(synthetic_tree(rng, 1, branching,
+                                           tree_class=tree_class))
+        else:
+            children.append(synthetic_tree(rng, depth - 1, branching,
+                                           preterminal_prob, vocabulary,
+                                           rng.choice(PHRASE_LABELS),
+                                           tree_class))
+    return tree_class(label, children)
+
+def synthetic_treebank(num_trees, depth=6, branching=3, seed=0, **kwargs):
+    '''
+    Returns a list of `num_trees` random trees (see `synthetic_tree`),
+    generated from the given `seed`.
+    '''
+    rng = random.Random(seed)
+    return [synthetic_tree(rng, depth, branching, **kwargs)
+            for _ in range(num_trees)]
+
+def right_branching_tree(depth, tree_class=nltk.tree.ParentedTree):
+    '''
+    Builds a right-branching tree of the given depth:
+    (S (VP (DT the) (VP (DT the) (VP ... (NN end))))).
+    '''
+    tree = tree_class('NN', ['end'])
+    for _ in range(depth):
+        tree = tree_class('VP', [tree_class('DT', ['the']), tree])
+    return tree_class('S', [tree])
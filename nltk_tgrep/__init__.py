@@ -25,5 +25,16 @@ except IOError as ex:
 
 # import top-level functionality
 from .tgrep import tgrep_tokenize, tgrep_compile, treepositions_no_leaves, \
-    tgrep_positions, tgrep_nodes
+    tgrep_positions, tgrep_nodes, TgrepException, TgrepPattern, \
+    TgrepPatternCache, tgrep_cache_info, tgrep_cache_clear, \
+    tgrep_set_cache_size, tgrep_set_memoization, TreeIndex, \
+    iter_tgrep_positions, iter_tgrep_nodes, search_corpus, PatternSet, \
+    TgrepProfile, tgrep_profile, TgrepPlan, tgrep_explain, TgrepMatch, \
+    tgrep_matches, tgrep_exists, tgrep_first, tgrep_count, \
+    filter_corpus
+from .corpus_stats import CorpusStatistics
+from .corpus_index import CorpusIndex
+from .binary_corpus import BinaryCorpus, write_binary_corpus
+from .array_forest import ArrayForest
+from .parallel import parallel_search_corpus
 
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Vectorized searches over a batch of trees with NumPy.
+
+An `ArrayForest` encodes a list of trees as NumPy arrays with one
+entry per node (tree nodes and leaves alike, numbered in preorder
+across the whole batch, so that each tree occupies a contiguous range
+of node ids):
+
+- `label`: the id of the node's label (or word) in `strings`
+- `parent`: the id of the node's parent, or -1 for the root of a tree
+- `end`: the id of the last node in the node's subtree
+- `child_rank`: the index of the node in its parent
+- `tree_id`: the index of the node's tree in the batch
+
+A search then evaluates every part of the search string for all the
+nodes in the batch at once, as a boolean mask over the node ids: tests
+on node names are run once per distinct string and looked up by label
+id, and the relations ``<``, ``>``, ``<<``, ``>>``, ``$``, ``.`` and
+``..`` become scatters, gathers and prefix sums over the arrays::
+
+    >>> forest = ArrayForest(trees)
+    >>> num_matches = forest.count('NP < DT')
+    >>> for tree_index, positions in forest.search_positions('NP < DT'):
+    ...     print(tree_index, positions)
+
+Search strings using other relations, tree positions (``N(...)``) or
+node labels (``=x``) are searched one tree at a time with the
+node-at-a-time engine instead (see `tgrep_positions`).
+
+NumPy is only imported when an `ArrayForest` is built; it is not
+needed by the rest of `nltk_tgrep`.
+'''
+
+from __future__ import print_function, unicode_literals
+from .tgrep import TgrepException, TgrepPattern, TreeIndex, _PATTERN_CACHE, \
+    _istree, _tgrep_ast_walk, _tgrep_is_name_test, _tgrep_match_ids, \
+    _tgrep_name_test, _tgrep_node_literal_value
+
+# the relation operators which `_forest_relation_mask` evaluates
+_VECTORIZED_OPERATORS = frozenset(['<', '>', '<<', '>>', '$', '.', '..'])
+
+def _tgrep_ast_is_vectorizable(ast):
+    '''
+    Returns True if the given pattern AST can be evaluated by
+    `_ForestEvaluator`: that is, if it uses only the relations in
+    `_VECTORIZED_OPERATORS`, and neither tree positions nor node
+    labels (binding them is harmless).
+    '''
+    for node in _tgrep_ast_walk(ast):
+        kind = node[0]
+        if kind in ('treepos', 'label_use', 'segment'):
+            return False
+        if kind == 'rel' and node[1] not in _VECTORIZED_OPERATORS:
+            return False
+    return True
+
+def _forest_relation_mask(forest, operator, targets):
+    '''
+    Returns the boolean mask of the nodes in `forest` which stand in
+    the relation given by the tgrep `operator` to some node in the
+    mask `targets`.
+
+    This is the vectorized counterpart of
+    `nltk_tgrep.tgrep._tgrep_relation_join`; as there, relations
+    looking upwards or sideways from a leaf never hold.
+    '''
+    import numpy
+    parent = forest.parent
+    end = forest.end
+    has_parent = parent >= 0
+    num_nodes = len(parent)
+    result = numpy.zeros(num_nodes, dtype=bool)
+    # A < B       A is the parent of (immediately dominates) B.
+    if operator == '<':
+        result[parent[targets & has_parent]] = True
+        return result
+    # A > B       A is the child of B.
+    elif operator == '>':
+        result[has_parent] = targets[parent[has_parent]]
+    # A << B      A dominates B (A is an ancestor of B).
+    elif operator == '<<':
+        # `before[i]` is the number of targets with ids below `i`, so
+        # that the targets inside the subtree of `i` (excluding `i`
+        # itself) number `before[end[i] + 1] - before[i + 1]`
+        before = forest.prefix_counts(targets)
+        return before[end + 1] > before[1:]
+    # A >> B      A is dominated by B (A is a descendant of B).
+    elif operator == '>>':
+        # count, for each node, the targets whose subtrees (not
+        # including the targets themselves) contain it
+        ids = numpy.flatnonzero(targets)
+        starts = (numpy.bincount(ids + 1, minlength=num_nodes + 1) -
+                  numpy.bincount(end[ids] + 1, minlength=num_nodes + 1))
+        result = numpy.cumsum(starts[:-1]) > 0
+    # A $ B       A is a sister of B (and A != B).
+    elif operator == '$':
+        # the number of targets among the children of each node
+        children = numpy.bincount(parent[targets & has_parent],
+                                  minlength=num_nodes)
+        siblings = children[numpy.where(has_parent, parent, 0)]
+        result = has_parent & (siblings > targets)
+    # A . B       A immediately precedes B.
+    elif operator == '.':
+        # A immediately precedes B iff A's subtree ends just before
+        # the top of the left-most path leading down to B, unless that
+        # is the root of a tree
+        top = forest.leftmost_top[targets]
+        follows = numpy.zeros(num_nodes + 1, dtype=bool)
+        follows[top[parent[top] >= 0]] = True
+        result = follows[end + 1]
+    # A .. B      A precedes B.
+    elif operator == '..':
+        before = forest.prefix_counts(targets)
+        tree_end = forest.tree_offsets[forest.tree_id + 1]
+        result = before[tree_end] > before[end + 1]
+    else:
+        raise TgrepException(
+            'cannot vectorize tgrep operator "{0}"'.format(operator))
+    return result & forest.is_tree
+
+class _ForestEvaluator(object):
+    '''
+    Evaluates pattern ASTs bottom-up over an `ArrayForest`, computing
+    for each subpattern the boolean mask of the nodes in the forest
+    which match it.  This mirrors `nltk_tgrep.tgrep._SetEvaluator`,
+    with masks in place of sets of node ids.
+    '''
+
+    def __init__(self, pattern, forest):
+        self.pattern = pattern
+        self.forest = forest
+        self.macros = dict(pattern.ast[1])
+        self._results = {}
+
+    def matches(self, ast):
+        '''
+        Returns the boolean mask of the nodes in the forest matching
+        the given pattern AST.
+        '''
+        try:
+            return self._results[ast]
+        except KeyError:
+            pass
+        import numpy
+        kind = ast[0]
+        if _tgrep_is_name_test(ast):
+            result = self.forest.name_mask(_tgrep_name_test(ast))
+        elif kind == 'node_or':
+            result = numpy.zeros(self.forest.num_nodes, dtype=bool)
+            for disjunct in ast[1]:
+                result = result | self.matches(disjunct)
+        elif kind == 'macro':
+            if ast[1] not in self.macros:
+                raise TgrepException('macro {0} not defined'.format(ast[1]))
+            result = self.matches(self.macros[ast[1]])
+        elif kind == 'bind':
+            # only label uses depend on the bindings
+            result = self.matches(ast[1])
+        elif kind == 'rel':
+            result = _forest_relation_mask(self.forest, ast[1],
+                                           self.matches(ast[2]))
+        elif kind == 'not':
+            result = ~self.matches(ast[1])
+        elif kind == 'and':
+            result = self.matches(ast[1][0])
+            for conjunct in ast[1][1:]:
+                if not result.any():
+                    break
+                result = result & self.matches(conjunct)
+        elif kind in ('or', 'exprs'):
+            disjuncts = ast[1] if kind == 'or' else ast[2]
+            result = numpy.zeros(self.forest.num_nodes, dtype=bool)
+            for disjunct in disjuncts:
+                result = result | self.matches(disjunct)
+        else:
+            raise TgrepException(
+                'cannot vectorize pattern node {0!r}'.format(ast))
+        self._results[ast] = result
+        return result
+
+class ArrayForest(object):
+    '''
+    A batch of trees encoded as NumPy arrays (see the module
+    documentation), searched with vectorized operations.
+    '''
+
+    def __init__(self, trees):
+        import numpy
+        self.trees = list(trees)
+        self.strings = []
+        string_ids = {}
+        labels = []
+        parents = []
+        ends = []
+        child_ranks = []
+        is_tree = []
+        offsets = [0]
+        for tree in self.trees:
+            if not _istree(tree):
+                raise TgrepException('cannot encode {0!r} as a tree'.format(
+                    tree))
+            index = TreeIndex(tree)
+            offset = offsets[-1]
+            for node in index.nodes:
+                label = -1
+                if self.strings is not None:
+                    name = _tgrep_node_literal_value(node)
+                    try:
+                        label = string_ids.get(name)
+                    except TypeError:
+                        # node labels which are not hashable cannot be
+                        # interned, and so the trees can only be
+                        # searched one at a time
+                        self.strings = None
+                        label = -1
+                    else:
+                        if label is None:
+                            label = string_ids[name] = len(self.strings)
+                            self.strings.append(name)
+                labels.append(label)
+                is_tree.append(_istree(node))
+            parents.extend(parent + offset if parent >= 0 else -1
+                           for parent in index.parent_id)
+            ends.extend(end + offset for end in index.end_id)
+            child_ranks.extend(index.child_rank)
+            offsets.append(offset + len(index))
+        self.label = numpy.array(labels, dtype=numpy.intp)
+        self.parent = numpy.array(parents, dtype=numpy.intp)
+        self.end = numpy.array(ends, dtype=numpy.intp)
+        self.child_rank = numpy.array(child_ranks, dtype=numpy.intp)
+        self.is_tree = numpy.array(is_tree, dtype=bool)
+        self.tree_offsets = numpy.array(offsets, dtype=numpy.intp)
+        self.tree_id = numpy.repeat(numpy.arange(len(self.trees)),
+                                    numpy.diff(self.tree_offsets))
+        self._leftmost_top = None
+
+    def __len__(self):
+        return len(self.trees)
+
+    @property
+    def num_nodes(self):
+        '''The number of nodes (including leaves) in the forest.'''
+        return len(self.label)
+
+    @property
+    def leftmost_top(self):
+        '''
+        An array mapping each node onto the top of the left-most path
+        leading down to it: its highest ancestor (or itself) reached
+        by climbing only from first children to their parents.
+        '''
+        if self._leftmost_top is None:
+            import numpy
+            ids = numpy.arange(self.num_nodes)
+            top = numpy.where((self.child_rank == 0) & (self.parent >= 0),
+                              self.parent, ids)
+            # pointer jumping: each pass doubles the distance climbed
+            while True:
+                jumped = top[top]
+                if (jumped == top).all():
+                    break
+                top = jumped
+            self._leftmost_top = top
+        return self._leftmost_top
+
+    def prefix_counts(self, mask):
+        '''
+        Returns an array whose `i`th element is the number of nodes
+        with ids below `i` in the given mask.
+        '''
+        import numpy
+        counts = numpy.zeros(self.num_nodes + 1, dtype=numpy.intp)
+        numpy.cumsum(mask, out=counts[1:])
+        return counts
+
+    def name_mask(self, test):
+        '''
+        Returns the boolean mask of the nodes whose name satisfies the
+        given test on node names, which is run once per distinct name.
+        '''
+        import numpy
+        flags = numpy.fromiter((bool(test(s)) for s in self.strings),
+                               dtype=bool, count=len(self.strings))
+        return flags[self.label]
+
+    def match_mask(self, tgrep_string, search_leaves=True):
+        '''
+        Returns the boolean mask of the nodes in the forest which match
+        the given TGrep search string (or compiled `TgrepPattern`).
+
+        Search strings which `_ForestEvaluator` cannot evaluate (see
+        `_tgrep_ast_is_vectorizable`) are searched one tree at a time
+        with the node-at-a-time engine.
+        '''
+        import numpy
+        pattern = tgrep_string
+        if not isinstance(pattern, TgrepPattern):
+            pattern = _PATTERN_CACHE.compile(tgrep_string)
+        if (self.strings is not None and
+                _tgrep_ast_is_vectorizable(pattern.ast)):
+            mask = _ForestEvaluator(pattern, self).matches(pattern.ast)
+            if not search_leaves:
+                mask = mask & (self.end != numpy.arange(self.num_nodes))
+            return mask
+        mask = numpy.zeros(self.num_nodes, dtype=bool)
+        for tree_index, tree in enumerate(self.trees):
+            _index, match_ids, _label_dict = _tgrep_match_ids(
+                tree, pattern, search_leaves, 'node')
+            ids = numpy.fromiter(match_ids, dtype=numpy.intp)
+            mask[ids + self.tree_offsets[tree_index]] = True
+        return mask
+
+    def count(self, tgrep_string, search_leaves=True):
+        '''
+        Returns the number of nodes in the forest which match the given
+        TGrep search string.
+        '''
+        return int(self.match_mask(tgrep_string, search_leaves).sum())
+
+    def tree_counts(self, tgrep_string, search_leaves=True):
+        '''
+        Returns an array giving, for each tree in the forest, the number
+        of its nodes which match the given TGrep search string.
+        '''
+        import numpy
+        mask = self.match_mask(tgrep_string, search_leaves)
+        return numpy.bincount(self.tree_id[mask], minlength=len(self))
+
+    def treeposition(self, node_id):
+        '''
+        Returns the tree position, within its tree, of the node with
+        the given id.
+        '''
+        position = []
+        while self.parent[node_id] >= 0:
+            position.append(int(self.child_rank[node_id]))
+            node_id = self.parent[node_id]
+        return tuple(reversed(position))
+
+    def search_positions(self, tgrep_string, search_leaves=True):
+        '''
+        Searches the forest for the given TGrep search string, and
+        yields a `(tree_index, positions)` pair for each tree containing
+        a match, where `positions` is the list of tree positions of the
+        matching nodes, in preorder.
+        '''
+        import numpy
+        ids = numpy.flatnonzero(self.match_mask(tgrep_string, search_leaves))
+        if not len(ids):
+            return
+        # split the matching ids at the boundaries between trees
+        tree_ids = self.tree_id[ids]
+        starts = numpy.flatnonzero(numpy.diff(tree_ids)) + 1
+        for group in numpy.split(ids, starts):
+            yield (int(self.tree_id[group[0]]),
+                   [self.treeposition(node_id) for node_id in group])
+
+    def search_nodes(self, tgrep_string, search_leaves=True):
+        '''
+        Searches the forest for the given TGrep search string, and
+        yields a `(tree_index, nodes)` pair for each tree containing a
+        match, where `nodes` is the list of matching nodes.
+        '''
+        for tree_index, positions in self.search_positions(tgrep_string,
+                                                           search_leaves):
+            tree = self.trees[tree_index]
+            yield tree_index, [tree[position] for position in positions]
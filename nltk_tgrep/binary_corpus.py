@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Compact binary corpus format, searchable without building trees.
+
+Like TGrep2's ``.t2c`` files, a binary corpus stores a collection of
+trees as flat tables of integers, one entry per node (tree nodes and
+leaves alike, numbered in preorder within each tree):
+
+- `label`: the id of the node's label (or word) in the string table
+- `parent`: the id of the node's parent, or -1 for the root
+- `first_child`: the id of the node's first child, or -1
+- `next_sibling`: the id of the node's next sister, or -1
+- `end`: the id of the last node in the node's subtree
+- `child_rank`: the position of the node among its sisters
+- `child_count`: the number of children of the node, or -1 for leaves
+
+Node ids are local to each tree.  Labels and words are interned in a
+string table, stored as UTF-8 text.  `BinaryCorpus` opens the file
+with `mmap`, so that opening a corpus does not read it, and searches
+evaluate patterns with the set-at-a-time engine directly on the node
+tables (see `BinaryTree`); `nltk.tree.ParentedTree` objects are only
+built for the trees containing matches, and only when asked for::
+
+    >>> write_binary_corpus('treebank.t2c', trees)
+    >>> with BinaryCorpus('treebank.t2c') as corpus:
+    ...     for tree_id, positions in corpus.search_positions('NP < DT'):
+    ...         print(tree_id, positions)
+
+Labels are stored as text, so that trees whose labels are not strings
+come back with their labels converted by `str`.
+'''
+
+from __future__ import print_function, unicode_literals
+try:
+    from builtins import range, str
+except ImportError:
+    # tgrep.py warns that the `future` package is missing
+    pass
+import array
+import mmap
+import struct
+import sys
+import weakref
+from .tgrep import TgrepException, TgrepPattern, _PATTERN_CACHE, \
+    _SetEvaluator, _istree, _tgrep_ast_uses_positions, tgrep_positions
+
+_MAGIC = b'TGRC'
+_VERSION = 1
+# magic, version, byte order, number of trees, nodes and strings
+_HEADER = struct.Struct('<4sIIIII')
+# the node tables, in the order in which they are stored
+_NODE_TABLES = ('label', 'parent', 'first_child', 'next_sibling', 'end',
+                'child_rank', 'child_count')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+
+def _int_array(values=()):
+    '''Builds an array of 32-bit signed integers.'''
+    for typecode in 'il':
+        if array.array(typecode).itemsize == 4:
+            return array.array(str(typecode), values)
+    raise TgrepException('no 32-bit integer array type available')
+
+def write_binary_corpus(path, trees):
+    '''
+    Writes the given trees to a binary corpus file at `path` (see the
+    module documentation).
+    '''
+    strings = []
+    string_ids = {}
+    def intern(string):
+        '''Returns the id of `string` in the string table.'''
+        try:
+            return string_ids[string]
+        except KeyError:
+            string_ids[string] = len(strings)
+            strings.append(string)
+            return string_ids[string]
+    tables = dict((name, _int_array()) for name in _NODE_TABLES)
+    tree_offsets = _int_array([0])
+    for tree in trees:
+        offset = tree_offsets[-1]
+        node_id = 0
+        # each stack entry is a node, its parent and its child rank
+        stack = [(tree, -1, 0)]
+        last_child = {}
+        while stack:
+            node, parent, rank = stack.pop()
+            tables['parent'].append(parent)
+            tables['first_child'].append(-1)
+            tables['next_sibling'].append(-1)
+            tables['end'].append(node_id)
+            tables['child_rank'].append(rank)
+            if parent >= 0:
+                previous = last_child.get(parent)
+                if previous is None:
+                    tables['first_child'][offset + parent] = node_id
+                else:
+                    tables['next_sibling'][offset + previous] = node_id
+                last_child[parent] = node_id
+            if _istree(node):
+                tables['label'].append(intern(str(node.label())))
+                tables['child_count'].append(len(node))
+                stack.extend((child, node_id, k) for k, child in
+                             reversed(list(enumerate(node))))
+            else:
+                tables['label'].append(intern(str(node)))
+                tables['child_count'].append(-1)
+            node_id += 1
+        # every node's subtree ends where its last descendant's does;
+        # visiting nodes in reverse preorder sees descendants first
+        end = tables['end']
+        parents = tables['parent']
+        for child in range(offset + node_id - 1, offset, -1):
+            parent = offset + parents[child]
+            end[parent] = max(end[parent], end[child])
+        tree_offsets.append(offset + node_id)
+    encoded = [string.encode('utf-8') for string in strings]
+    string_offsets = _int_array([0])
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+    with open(path, 'wb') as outfile:
+        outfile.write(_HEADER.pack(_MAGIC, _VERSION,
+                                   _BYTE_ORDERS[sys.byteorder],
+                                   len(tree_offsets) - 1,
+                                   tree_offsets[-1], len(strings)))
+        # integer tables come first, so that they stay aligned
+        tree_offsets.tofile(outfile)
+        for name in _NODE_TABLES:
+            tables[name].tofile(outfile)
+        string_offsets.tofile(outfile)
+        outfile.write(b''.join(encoded))
+
+class _StringTable(object):
+    '''
+    The string table of a `BinaryCorpus`: a read-only sequence of the
+    strings stored in the file, each decoded from the mapped file the
+    first time it is looked up.
+    '''
+
+    def __init__(self, data, start, offsets):
+        self._data = data
+        self._start = start
+        self._offsets = offsets
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, string_id):
+        try:
+            return self._decoded[string_id]
+        except KeyError:
+            pass
+        if not 0 <= string_id < len(self):
+            raise IndexError('string id {0} out of range'.format(string_id))
+        start = self._start + self._offsets[string_id]
+        stop = self._start + self._offsets[string_id + 1]
+        string = self._decoded[string_id] = \
+            self._data[start:stop].decode('utf-8')
+        return string
+
+class BinaryTree(object):
+    '''
+    A view of a single tree in a `BinaryCorpus`.
+
+    A `BinaryTree` offers the same interface as
+    `nltk_tgrep.tgrep.TreeIndex` to the set-at-a-time search engine,
+    but reads the node tables of the corpus directly instead of
+    indexing an `nltk.tree.Tree`.
+    '''
+
+    def __init__(self, corpus, tree_id):
+        self.corpus = corpus
+        self.tree_id = tree_id
+        start = corpus._tree_offsets[tree_id]
+        stop = corpus._tree_offsets[tree_id + 1]
+        for name in _NODE_TABLES:
+            setattr(self, name, corpus._tables[name][start:stop])
+        self.parent_id = self.parent
+        self.end_id = self.end
+        self._label_ids = self._word_ids = None
+        corpus._trees.add(self)
+
+    def _release(self):
+        '''Releases the views of the node tables held by this tree.'''
+        for name in _NODE_TABLES:
+            table = getattr(self, name)
+            if isinstance(table, memoryview):
+                table.release()
+
+    def __len__(self):
+        return len(self.label)
+
+    def _index_labels(self):
+        '''Builds the inverted indices `label_ids` and `word_ids`.'''
+        strings = self.corpus.strings
+        label_ids = {}
+        word_ids = {}
+        for node_id, label in enumerate(self.label):
+            table = label_ids if self.child_count[node_id] >= 0 else word_ids
+            table.setdefault(strings[label], []).append(node_id)
+        self._label_ids = label_ids
+        self._word_ids = word_ids
+
+    @property
+    def label_ids(self):
+        '''
+        A dictionary mapping each node label in the tree onto the ids of
+        the tree nodes with that label, in preorder.
+        '''
+        if self._label_ids is None:
+            self._index_labels()
+        return self._label_ids
+
+    @property
+    def word_ids(self):
+        '''
+        A dictionary mapping each word in the tree onto the ids of the
+        leaves with that word, in preorder.
+        '''
+        if self._word_ids is None:
+            self._index_labels()
+        return self._word_ids
+
+    def ids_with_values(self, values):
+        '''
+        Returns the sorted ids of all nodes whose label (or, for leaves,
+        whose word) is one of the given `values`.
+        '''
+        ids = []
+        for value in values:
+            ids.extend(self.label_ids.get(value, ()))
+            ids.extend(self.word_ids.get(value, ()))
+        ids.sort()
+        return ids
+
+    def ids_matching(self, predicate):
+        '''
+        Returns the sorted ids of all nodes satisfying `predicate`, a
+        test on node names, which is called once for each distinct label
+        and word in the tree.
+        '''
+        ids = []
+        for table in (self.label_ids, self.word_ids):
+            for value, value_ids in table.items():
+                if predicate(value):
+                    ids.extend(value_ids)
+        ids.sort()
+        return ids
+
+    def is_tree(self, node_id):
+        '''Returns True if the node with the given id is not a leaf.'''
+        return self.child_count[node_id] >= 0
+
+    def num_children(self, node_id):
+        '''Returns the number of children of the node with the given id.'''
+        return max(self.child_count[node_id], 0)
+
+    def is_leaf(self, node_id):
+        '''
+        Returns True if the node with the given id dominates no other
+        node (see `nltk_tgrep.tgrep.treepositions_no_leaves`).
+        '''
+        return self.end[node_id] == node_id
+
+    def children_ids(self, node_id):
+        '''Yields the ids of the children of the given node, in order.'''
+        child = self.first_child[node_id]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def treeposition(self, node_id):
+        '''Returns the tree position of the node with the given id.'''
+        position = []
+        while node_id > 0:
+            position.append(self.child_rank[node_id])
+            node_id = self.parent[node_id]
+        return tuple(reversed(position))
+
+    def to_tree(self, node_id=0, tree_class=None):
+        '''
+        Builds the `nltk.tree.ParentedTree` (or other `tree_class`) for
+        the subtree rooted at the node with the given id (a string, for
+        a leaf).
+        '''
+        if tree_class is None:
+            import nltk.tree
+            tree_class = nltk.tree.ParentedTree
+        strings = self.corpus.strings
+        if self.child_count[node_id] < 0:
+            return strings[self.label[node_id]]
+        return tree_class(
+            strings[self.label[node_id]],
+            [self.to_tree(child, tree_class)
+             for child in self.children_ids(node_id)])
+
+def _view_match_ids(pattern, view, search_leaves):
+    '''
+    Returns the sorted ids of the nodes of the `BinaryTree` `view`
+    matching the `TgrepPattern` `pattern` (see
+    `BinaryCorpus.match_ids`).
+    '''
+    if pattern.uses_labels or _tgrep_ast_uses_positions(pattern.ast):
+        import nltk.tree
+        tree = view.to_tree(tree_class=nltk.tree.Tree)
+        positions = tgrep_positions(tree, pattern, search_leaves)
+        ids = {}
+        for node_id in range(len(view)):
+            ids[view.treeposition(node_id)] = node_id
+        return [ids[position] for position in positions]
+    ids = sorted(_SetEvaluator(pattern, view).matches(pattern.ast))
+    if not search_leaves:
+        ids = [i for i in ids if not view.is_leaf(i)]
+    return ids
+
+class BinaryCorpus(object):
+    '''
+    A binary corpus file (see `write_binary_corpus`), opened with
+    `mmap`.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as infile:
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, byte_order, num_trees, num_nodes,
+         num_strings) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise TgrepException('{0} is not a binary corpus'.format(path))
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            raise TgrepException('{0} was written on a machine with a '
+                                 'different byte order'.format(path))
+        # every memoryview of the mapping, which must all be released
+        # before it can be closed, and the `BinaryTree`s viewing it
+        self._views = []
+        self._trees = weakref.WeakSet()
+        offset = _HEADER.size
+        self._tree_offsets, offset = self._table(offset, num_trees + 1)
+        self._tables = {}
+        for name in _NODE_TABLES:
+            self._tables[name], offset = self._table(offset, num_nodes)
+        self._string_offsets, offset = self._table(offset, num_strings + 1)
+        self.strings = _StringTable(self._mmap, offset, self._string_offsets)
+
+    def _table(self, offset, length):
+        '''
+        Returns a view of the integer table of the given length stored
+        at `offset` in the file, and the offset following it.
+        '''
+        stop = offset + 4 * length
+        mapping = memoryview(self._mmap)
+        view = mapping[offset:stop]
+        self._views.extend([mapping, view])
+        try:
+            table = view.cast(str('i' if _int_array().typecode == 'i'
+                                  else 'l'))
+        except AttributeError:
+            # Python 2 cannot view a buffer as integers
+            table = _int_array()
+            table.fromstring(view.tobytes())
+        else:
+            self._views.append(table)
+        return table, stop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._tree_offsets) - 1
+
+    def close(self):
+        '''
+        Closes the corpus file.  Views of trees in the corpus (see
+        `view`) can no longer be used once it is closed.
+        '''
+        if self._mmap.closed:
+            return
+        for tree in list(self._trees):
+            tree._release()
+        # release derived views before the views they were taken from
+        for view in reversed(self._views):
+            if hasattr(view, 'release'):
+                view.release()
+        self._views = []
+        self._tree_offsets = self._string_offsets = self._tables = None
+        self._mmap.close()
+
+    def view(self, tree_id):
+        '''Returns the `BinaryTree` view of the tree with the given id.'''
+        if not 0 <= tree_id < len(self):
+            raise IndexError('tree id {0} out of range'.format(tree_id))
+        return BinaryTree(self, tree_id)
+
+    def tree(self, tree_id):
+        '''Builds the `nltk.tree.ParentedTree` with the given id.'''
+        return self.view(tree_id).to_tree()
+
+    def __getitem__(self, tree_id):
+        return self.tree(tree_id)
+
+    def match_ids(self, tgrep_string, tree_id, search_leaves=True):
+        '''
+        Returns the sorted ids of the nodes in the tree with the given
+        id matching the given TGrep search string (or compiled
+        `TgrepPattern`).
+
+        Search strings which use node labels or tree positions (such
+        as ``=x`` or ``N(0,)``) are evaluated on the rebuilt
+        `nltk.tree.Tree` instead.
+        '''
+        pattern = tgrep_string
+        if not isinstance(pattern, TgrepPattern):
+            pattern = _PATTERN_CACHE.compile(tgrep_string)
+        return _view_match_ids(pattern, self.view(tree_id), search_leaves)
+
+    def match_positions(self, tgrep_string, tree_id, search_leaves=True):
+        '''
+        Returns the tree positions of the nodes in the tree with the
+        given id matching the given TGrep search string (or compiled
+        `TgrepPattern`), in the order of `match_ids`.
+        '''
+        pattern = tgrep_string
+        if not isinstance(pattern, TgrepPattern):
+            pattern = _PATTERN_CACHE.compile(tgrep_string)
+        view = self.view(tree_id)
+        return [view.treeposition(i)
+                for i in _view_match_ids(pattern, view, search_leaves)]
+
+    def search_positions(self, tgrep_string, search_leaves=True):
+        '''
+        Searches the corpus for the given TGrep search string, and
+        yields a `(tree_id, positions)` pair for each tree containing a
+        match, where `positions` is the list of tree positions of the
+        matching nodes.
+        '''
+        if not isinstance(tgrep_string, TgrepPattern):
+            tgrep_string = _PATTERN_CACHE.compile(tgrep_string)
+        for tree_id in range(len(self)):
+            positions = self.match_positions(tgrep_string, tree_id,
+                                             search_leaves)
+            if positions:
+                yield tree_id, positions
+
+    def search_nodes(self, tgrep_string, search_leaves=True):
+        '''
+        Searches the corpus for the given TGrep search string, and
+        yields a `(tree_id, nodes)` pair for each tree containing a
+        match, where `nodes` is the list of matching nodes in the
+        `nltk.tree.ParentedTree` built for that tree.
+        '''
+        for tree_id, positions in self.search_positions(tgrep_string,
+                                                        search_leaves):
+            tree = self.tree(tree_id)
+            yield tree_id, [tree[position] for position in positions]
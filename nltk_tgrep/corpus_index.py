@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Persistent inverted index over a corpus of NLTK trees.
+
+A `CorpusIndex` is an SQLite database which maps every node label and
+every word in a collection of trees onto the ids of the trees
+containing it (its postings), and optionally maps every parent/child
+label pair onto the trees containing it.  Searching the index first
+extracts from the search string a query on these postings which every
+tree containing a match must satisfy (see `_tgrep_corpus_query`), and
+then only loads and searches the trees satisfying that query.  For
+instance, the search string ``NP < (DT < those)`` is only evaluated on
+the trees which contain the word ``those`` and the label pairs
+``(NP, DT)``::
+
+    >>> with CorpusIndex('treebank.idx', bigrams=True) as index:
+    ...     index.add(trees)
+    ...     for tree_id, positions in index.search_positions('NP < DT'):
+    ...         print(tree_id, positions)
+
+Trees are numbered consecutively in the order they are added; trees
+can be appended to an existing index at any time.  Stored trees are
+kept in bracketed form, so their node labels and words are stored as
+strings, and must not contain whitespace or parentheses.
+'''
+
+from __future__ import print_function, unicode_literals
+try:
+    from builtins import range, str
+except ImportError:
+    # tgrep.py warns that the `future` package is missing
+    pass
+import re
+import sys
+from .tgrep import TgrepException, TgrepPattern, _PATTERN_CACHE, \
+    _istree, _tgrep_head_constraint, _tgrep_is_name_test, \
+    _tgrep_literal_values, tgrep_nodes, tgrep_positions
+
+# posting kinds
+_LABEL = 0
+_WORD = 1
+
+# the characters which cannot be stored in a bracketed tree
+_UNSTORABLE = re.compile(r'[\s()]')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS trees (id INTEGER PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS postings (key TEXT, kind INTEGER, tree INTEGER);
+CREATE INDEX IF NOT EXISTS postings_key ON postings (key, kind);
+CREATE TABLE IF NOT EXISTS bigrams (parent TEXT, child TEXT, tree INTEGER);
+CREATE INDEX IF NOT EXISTS bigrams_key ON bigrams (parent, child);
+'''
+
+def _flatten_query(kind, queries):
+    '''
+    Builds a query of the given kind ('all' or 'any') from the given
+    list of queries, merging in any subqueries of the same kind.
+    '''
+    children = []
+    for query in queries:
+        if query[0] == kind:
+            children.extend(query[1])
+        else:
+            children.append(query)
+    return children[0] if len(children) == 1 else (kind, tuple(children))
+
+def _all_query(queries):
+    '''
+    Builds a query satisfied by the trees satisfying all of the given
+    queries; None stands for a query satisfied by every tree.
+    '''
+    queries = [query for query in queries if query is not None]
+    if not queries:
+        return None
+    return _flatten_query('all', queries)
+
+def _any_query(queries):
+    '''
+    Builds a query satisfied by the trees satisfying any of the given
+    queries; None stands for a query satisfied by every tree.
+    '''
+    queries = list(queries)
+    if not queries or any(query is None for query in queries):
+        return None
+    return _flatten_query('any', queries)
+
+def _tgrep_name_query(ast):
+    '''
+    Builds a query for the trees containing a node matching the given
+    node name AST (see `_tgrep_is_name_test`).
+    '''
+    values = _tgrep_literal_values(ast)
+    if values is not None:
+        return _any_query(('value', value) for value in sorted(values))
+    if ast[0] == 'any':
+        return None
+    return ('names', ast)
+
+def _tgrep_relation_query(head, operator, target, macros, _seen):
+    '''
+    Builds a query for the trees containing a node related to a node
+    with head constraint `head` by the given operator, where the
+    related node matches the pattern AST `target`.
+    '''
+    query = _tgrep_corpus_query(target, macros, None, _seen)
+    if head is None:
+        return query
+    if operator[0] == '<' and operator[:2] != '<<':
+        parents = _tgrep_literal_values(head)
+        children = _tgrep_literal_values(
+            _tgrep_head_constraint(target, macros) or ('any',))
+    elif operator[0] == '>' and operator[:2] != '>>':
+        parents = _tgrep_literal_values(
+            _tgrep_head_constraint(target, macros) or ('any',))
+        children = _tgrep_literal_values(head)
+    else:
+        return query
+    if parents is None or children is None:
+        return query
+    return _all_query([query, ('child', tuple(sorted(parents)),
+                               tuple(sorted(children)))])
+
+def _tgrep_corpus_query(ast, macros, head=None, _seen=()):
+    '''
+    Returns a query on the postings of a `CorpusIndex` which is
+    satisfied by every tree containing a node matching the given
+    pattern AST, or None if every tree might contain a match.
+
+    `macros` maps macro names onto their definitions, and `head` is
+    the head constraint (see `_tgrep_head_constraint`) of the node
+    the AST describes, if known.  Queries are nested tuples:
+
+    - `('value', value)` matches the trees containing a node label or
+      word `value`
+    - `('names', ast)` matches the trees containing a node label or
+      word which satisfies the node name AST `ast`
+    - `('child', parents, children)` matches the trees in which a
+      node with a label in `parents` has a child with a label (or word)
+      in `children`
+    - `('all', queries)` and `('any', queries)` are the conjunction and
+      disjunction of the given queries
+    '''
+    kind = ast[0]
+    if _tgrep_is_name_test(ast):
+        return _tgrep_name_query(ast)
+    elif kind == 'and':
+        head = _tgrep_head_constraint(ast, macros) or head
+        return _all_query(_tgrep_corpus_query(x, macros, head, _seen)
+                          for x in ast[1])
+    elif kind in ('or', 'node_or'):
+        return _any_query(_tgrep_corpus_query(x, macros, head, _seen)
+                          for x in ast[1])
+    elif kind == 'exprs':
+        return _any_query(_tgrep_corpus_query(x, macros, None, _seen)
+                          for x in ast[2])
+    elif kind == 'rel':
+        return _tgrep_relation_query(head, ast[1], ast[2], macros, _seen)
+    elif kind == 'bind':
+        return _tgrep_corpus_query(ast[1], macros, head, _seen)
+    elif kind == 'segment':
+        return _all_query(_tgrep_corpus_query(x, macros, None, _seen)
+                          for x in ast[2])
+    elif kind == 'macro':
+        # guard against recursive macro definitions
+        if ast[1] in macros and ast[1] not in _seen:
+            return _tgrep_corpus_query(macros[ast[1]], macros, head,
+                                       _seen + (ast[1],))
+    # negations, node label uses and tree positions say nothing about
+    # which labels and words a tree contains
+    return None
+
+class CorpusIndex(object):
+    '''
+    A persistent inverted index over a corpus of NLTK trees, stored
+    as an SQLite database at `path`.
+
+    If `bigrams` is True, the index also keeps postings for
+    parent/child label pairs, which let searches using the `<` and `>`
+    family of operators skip more trees.  If `store_trees` is True,
+    the trees themselves are stored in the index, and searches load
+    them from there; otherwise, the corpus must be passed to each
+    search.  Both settings are fixed when the index is created.
+    '''
+
+    def __init__(self, path, bigrams=False, store_trees=True):
+        import sqlite3
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._vocabulary = None
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                [('bigrams', str(int(bool(bigrams)))),
+                 ('store_trees', str(int(bool(store_trees))))])
+        meta = dict(self._connection.execute('SELECT name, value FROM meta'))
+        self.bigrams = meta['bigrams'] == '1'
+        self.store_trees = meta['store_trees'] == '1'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM trees').fetchone()[0]
+
+    def close(self):
+        '''Closes the index database.'''
+        self._connection.close()
+
+    def add(self, trees):
+        '''
+        Appends the given trees to the index, and returns the range of
+        tree ids assigned to them.
+        '''
+        connection = self._connection
+        with connection:
+            first = len(self)
+            tree_id = first - 1
+            for tree_id, tree in enumerate(trees, first):
+                labels = set()
+                words = set()
+                bigrams = set()
+                stack = [tree]
+                while stack:
+                    node = stack.pop()
+                    if not _istree(node):
+                        words.add(str(node))
+                        continue
+                    label = str(node.label())
+                    labels.add(label)
+                    for child in node:
+                        if _istree(child):
+                            bigrams.add((label, str(child.label())))
+                        stack.append(child)
+                data = None
+                if self.store_trees:
+                    if any(_UNSTORABLE.search(key)
+                           for key in labels | words):
+                        raise TgrepException(
+                            'cannot store tree {0}: its labels and words '
+                            'must not contain whitespace or '
+                            'parentheses'.format(tree_id))
+                    data = tree.pformat(margin=sys.maxsize)
+                connection.execute('INSERT INTO trees VALUES (?, ?)',
+                                   (tree_id, data))
+                connection.executemany(
+                    'INSERT INTO postings VALUES (?, ?, ?)',
+                    [(label, _LABEL, tree_id) for label in labels] +
+                    [(word, _WORD, tree_id) for word in words])
+                if self.bigrams:
+                    connection.executemany(
+                        'INSERT INTO bigrams VALUES (?, ?, ?)',
+                        [(parent, child, tree_id)
+                         for (parent, child) in bigrams])
+        self._vocabulary = None
+        return range(first, tree_id + 1)
+
+    def tree(self, tree_id, tree_class=None):
+        '''
+        Loads the tree with the given id from the index, as an
+        `nltk.tree.ParentedTree` (or other `tree_class`).
+        '''
+        if not self.store_trees:
+            raise TgrepException('trees are not stored in this index')
+        row = self._connection.execute('SELECT data FROM trees WHERE id = ?',
+                                       (tree_id,)).fetchone()
+        if row is None:
+            raise IndexError('tree id {0} out of range'.format(tree_id))
+        if tree_class is None:
+            import nltk.tree
+            tree_class = nltk.tree.ParentedTree
+        return tree_class.fromstring(row[0])
+
+    @property
+    def vocabulary(self):
+        '''The set of all node labels and words in the index.'''
+        if self._vocabulary is None:
+            self._vocabulary = set(key for (key,) in self._connection.execute(
+                'SELECT DISTINCT key FROM postings'))
+        return self._vocabulary
+
+    def _postings(self, key, kinds=(_LABEL, _WORD)):
+        '''Returns the set of ids of the trees containing `key`.'''
+        return set(tree_id for (tree_id,) in self._connection.execute(
+            'SELECT tree FROM postings WHERE key = ? AND kind IN ({0})'.format(
+                ', '.join(str(kind) for kind in kinds)), (key,)))
+
+    def _evaluate(self, pattern, query):
+        '''
+        Returns the set of ids of the trees satisfying the given query
+        (see `_tgrep_corpus_query`).
+        '''
+        kind = query[0]
+        if kind == 'value':
+            return self._postings(query[1])
+        elif kind == 'names':
+            # test each distinct label and word once
+            predicate = pattern.node_predicate(query[1])
+            tree_ids = set()
+            for key in self.vocabulary:
+                if predicate(key):
+                    tree_ids |= self._postings(key)
+            return tree_ids
+        elif kind == 'child':
+            _kind, parents, children = query
+            if not self.bigrams:
+                return self._evaluate(pattern, (
+                    'all', (_any_query(('value', x) for x in parents),
+                            _any_query(('value', x) for x in children))))
+            tree_ids = set()
+            for child in children:
+                # leaf children are not recorded as label pairs
+                tree_ids |= self._postings(child, (_WORD,))
+                for parent in parents:
+                    tree_ids.update(tree_id for (tree_id,) in
+                                    self._connection.execute(
+                                        'SELECT tree FROM bigrams WHERE '
+                                        'parent = ? AND child = ?',
+                                        (parent, child)))
+            return tree_ids
+        elif kind == 'all':
+            tree_ids = None
+            for subquery in query[1]:
+                subquery_ids = self._evaluate(pattern, subquery)
+                tree_ids = (subquery_ids if tree_ids is None
+                            else tree_ids & subquery_ids)
+                if not tree_ids:
+                    break
+            return tree_ids
+        elif kind == 'any':
+            tree_ids = set()
+            for subquery in query[1]:
+                tree_ids |= self._evaluate(pattern, subquery)
+            return tree_ids
+        raise TgrepException('unknown corpus index query {0!r}'.format(query))
+
+    def candidates(self, tgrep_string):
+        '''
+        Returns the sorted ids of the trees in the index which might
+        contain a match for the given TGrep search string (or
+        compiled `TgrepPattern`).
+        '''
+        pattern = tgrep_string
+        if not isinstance(pattern, TgrepPattern):
+            pattern = _PATTERN_CACHE.compile(tgrep_string)
+        query = _tgrep_corpus_query(pattern.ast, pattern.macros)
+        if query is None:
+            return list(range(len(self)))
+        return sorted(self._evaluate(pattern, query))
+
+    def _search(self, search, tgrep_string, trees, search_leaves,
+                tree_class=None):
+        '''
+        Runs `search` (`tgrep_positions` or `tgrep_nodes`) over the
+        candidate trees for the given search string, loading them from
+        the index as `tree_class` (see `tree`).
+        '''
+        if not isinstance(tgrep_string, TgrepPattern):
+            tgrep_string = _PATTERN_CACHE.compile(tgrep_string)
+        if trees is None and not self.store_trees:
+            raise TgrepException('trees are not stored in this index; '
+                                 'the corpus must be given')
+        for tree_id in self.candidates(tgrep_string):
+            tree = (self.tree(tree_id, tree_class) if trees is None
+                    else trees[tree_id])
+            results = search(tree, tgrep_string, search_leaves)
+            if results:
+                yield tree_id, results
+
+    def search_positions(self, tgrep_string, trees=None, search_leaves=True):
+        '''
+        Searches the indexed corpus for the given TGrep search string,
+        and yields a `(tree_id, positions)` pair for each tree
+        containing a match, where `positions` is the list of tree
+        positions of the matching nodes.  Trees are loaded from the
+        index unless the corpus is given as `trees`, a sequence
+        indexed by tree id.
+        '''
+        import nltk.tree
+        # only the nodes returned need parent pointers
+        return self._search(tgrep_positions, tgrep_string, trees,
+                            search_leaves, nltk.tree.Tree)
+
+    def search_nodes(self, tgrep_string, trees=None, search_leaves=True):
+        '''
+        Searches the indexed corpus for the given TGrep search string,
+        and yields a `(tree_id, nodes)` pair for each tree containing a
+        match, where `nodes` is the list of matching nodes (see
+        `search_positions`).
+        '''
+        return self._search(tgrep_nodes, tgrep_string, trees, search_leaves)
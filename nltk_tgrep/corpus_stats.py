@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Statistics of a corpus of NLTK trees, for estimating how many nodes a
+TGrep pattern matches.
+
+A `CorpusStatistics` counts the node labels and words of a collection
+of trees, the parent/child label pairs, and the fan-outs and depths of
+the nodes.  From these, it estimates the selectivity of a pattern (the
+fraction of the nodes in the corpus which match it), and the cost of
+testing a node against it.  Apart from the parent/child pairs, the
+estimates assume that the parts of a pattern hold independently of
+each other, and so are rough; they are meant for comparing patterns
+and subpatterns (see `nltk_tgrep.tgrep.tgrep_explain`), not for
+predicting exact counts::
+
+    >>> stats = CorpusStatistics(trees)
+    >>> stats.selectivity(tgrep_compile('NP < DT').ast)
+    0.0123...
+
+Given statistics, `nltk_tgrep.tgrep.tgrep_compile` orders the parts of
+conjunctions and disjunctions so that the cheapest and most decisive
+ones are tested first.
+'''
+
+from __future__ import division, print_function, unicode_literals
+from collections import Counter
+from .tgrep import TgrepException, TreeIndex, _istree, \
+    _tgrep_canonical_operator, _tgrep_head_constraint, \
+    _tgrep_is_name_test, _tgrep_literal_values, _tgrep_node_literal_value, \
+    _tgrep_node_predicate
+
+def _any_of(probability, count):
+    '''
+    Returns the probability that at least one of `count` independent
+    events, each of the given probability, occurs.
+    '''
+    if count <= 0:
+        return 0.0
+    return 1.0 - (1.0 - probability) ** count
+
+class CorpusStatistics(object):
+    '''
+    Node label, word and shape statistics of a corpus of trees.
+
+    `trees` may be any iterable of trees; more trees can be counted
+    later with `add`.  Leaves are counted as nodes, as they are
+    searched by default.  The statistics are:
+
+    - `num_trees`, `num_nodes`: the number of trees and of nodes
+    - `label_counts`: a `Counter` of the node labels and words
+    - `pair_counts`: a `Counter` of the `(parent label, child label
+      or word)` pairs of the parent/child relations in the trees
+    - `fanout_histogram`: a `Counter` mapping each number of children
+      onto the number of nodes (not counting leaves) with that many
+      children
+    - `depth_histogram`: a `Counter` mapping each depth onto the
+      number of nodes at that depth
+    '''
+
+    def __init__(self, trees=()):
+        self.num_trees = 0
+        self.num_nodes = 0
+        self.label_counts = Counter()
+        self.pair_counts = Counter()
+        self.fanout_histogram = Counter()
+        self.depth_histogram = Counter()
+        self.add(trees)
+
+    def add(self, trees):
+        '''Counts the given trees into the statistics.'''
+        for tree in trees:
+            if not _istree(tree):
+                continue
+            index = TreeIndex(tree)
+            self.num_trees += 1
+            self.num_nodes += len(index)
+            self.depth_histogram.update(index.depth)
+            values = [_tgrep_node_literal_value(node) for node in index.nodes]
+            self.label_counts.update(values)
+            for node_id, node in enumerate(index.nodes):
+                if _istree(node):
+                    self.fanout_histogram[len(node)] += 1
+                if node_id > 0:
+                    self.pair_counts[values[index.parent_id[node_id]],
+                                     values[node_id]] += 1
+
+    @property
+    def num_tree_nodes(self):
+        '''The number of nodes which are not leaves.'''
+        return sum(self.fanout_histogram.values())
+
+    @property
+    def total_depth(self):
+        '''The sum of the depths of all nodes.'''
+        return sum(depth * count
+                   for depth, count in self.depth_histogram.items())
+
+    @property
+    def mean_size(self):
+        '''The mean number of nodes in a tree.'''
+        return self.num_nodes / max(self.num_trees, 1)
+
+    @property
+    def mean_depth(self):
+        '''
+        The mean depth of a node; this is also the mean number of
+        nodes dominated by a node.
+        '''
+        return self.total_depth / max(self.num_nodes, 1)
+
+    @property
+    def mean_fanout(self):
+        '''The mean number of children of a node which is not a leaf.'''
+        return (self.num_nodes - self.num_trees) / max(self.num_tree_nodes, 1)
+
+    def _label_values(self, ast):
+        '''
+        Returns the labels and words in the corpus which satisfy the
+        given node name AST.
+        '''
+        values = _tgrep_literal_values(ast)
+        if values is not None:
+            return values
+        predicate = _tgrep_node_predicate(ast)
+        return set(value for value in self.label_counts if predicate(value))
+
+    def name_selectivity(self, ast):
+        '''
+        Returns the fraction of nodes in the corpus whose label (or
+        word) satisfies the given node name AST.
+        '''
+        if not self.num_nodes:
+            return 0.0
+        if ast[0] == 'any':
+            return 1.0
+        return sum(self.label_counts[value]
+                   for value in self._label_values(ast)) / self.num_nodes
+
+    def visits(self, operator):
+        '''
+        Returns the estimated number of nodes visited when looking for
+        the nodes which stand in the relation given by the tgrep
+        `operator` to a node.
+        '''
+        operator = _tgrep_canonical_operator(operator)
+        if operator in ('<', '$', '$..', '$,,'):
+            return self.mean_fanout
+        elif operator in ('<<', '>>'):
+            return self.mean_depth
+        elif operator in ('..', ',,'):
+            return self.mean_size / 2
+        elif operator in ('<<,', '<<\'', '<<:', '>>,', '>>\'', '>>:',
+                          '.', ','):
+            # paths down the left or right edge of a subtree
+            return max(self.mean_depth / max(self.mean_fanout, 1.0), 1.0)
+        return 1.0
+
+    def relation_selectivity(self, operator, selectivity):
+        '''
+        Returns the estimated fraction of nodes in the corpus which
+        stand in the relation given by the tgrep `operator` to some
+        node, where a fraction `selectivity` of all nodes match the
+        relation's target.
+        '''
+        if not self.num_nodes:
+            return 0.0
+        operator = _tgrep_canonical_operator(operator)
+        fanout = self.mean_fanout
+        depth = self.mean_depth
+        # the fractions of nodes which have children, and a parent
+        internal = self.num_tree_nodes / self.num_nodes
+        child = 1.0 - self.num_trees / self.num_nodes
+        if operator == '<':
+            return internal * _any_of(selectivity, fanout)
+        elif operator == '>':
+            return child * selectivity
+        elif operator == '<:' or (operator[0] == '<' and
+                                  operator[1:].lstrip('-').isdigit()):
+            return internal * selectivity
+        elif operator == '>:' or (operator[0] == '>' and
+                                  operator[1:].lstrip('-').isdigit()):
+            return child * selectivity / max(fanout, 1.0)
+        elif operator in ('<<', '>>'):
+            return _any_of(selectivity, depth)
+        elif operator in ('..', ',,'):
+            return _any_of(selectivity, self.mean_size / 2 - depth)
+        elif operator == '$':
+            return child * _any_of(selectivity, fanout - 1)
+        elif operator in ('$..', '$,,'):
+            return child * _any_of(selectivity, (fanout - 1) / 2)
+        elif operator in ('$.', '$,'):
+            return child * selectivity * (fanout - 1) / max(fanout, 1.0)
+        elif operator in ('<<,', '<<\'', '<<:', '>>,', '>>\'', '>>:',
+                          '.', ','):
+            return _any_of(selectivity, self.visits(operator))
+        raise TgrepException(
+            'cannot interpret tgrep operator "{0}"'.format(operator))
+
+    def _pair_selectivity(self, operator, head, target, macros):
+        '''
+        Returns the estimated fraction of the nodes satisfying the node
+        name AST `head` which are the parent (for `<`) or the child
+        (for `>`) of a node matching the pattern AST `target`, using
+        the parent/child label pair counts; or None, if this cannot be
+        estimated from the pairs.
+        '''
+        operator = _tgrep_canonical_operator(operator)
+        if operator not in ('<', '>'):
+            return None
+        target_head = _tgrep_head_constraint(target, macros or {})
+        if target_head is None:
+            return None
+        heads = _tgrep_literal_values(head)
+        targets = self._label_values(target_head)
+        if heads is None:
+            return None
+        head_count = sum(self.label_counts[value] for value in heads)
+        if not head_count:
+            return 0.0
+        if operator == '<':
+            pairs = [(x, y) for x in heads for y in targets]
+        else:
+            pairs = [(y, x) for x in heads for y in targets]
+        selectivity = min(1.0, sum(self.pair_counts[pair]
+                                   for pair in pairs) / head_count)
+        # scale by the fraction of the nodes satisfying the target's
+        # head constraint which satisfy the whole target
+        target_head_selectivity = self.name_selectivity(target_head)
+        if target_head_selectivity > 0:
+            selectivity *= min(1.0, self.selectivity(target, macros) /
+                               target_head_selectivity)
+        return selectivity
+
+    def selectivity(self, ast, macros=None, head=None, _seen=()):
+        '''
+        Returns the estimated fraction of nodes in the corpus which
+        match the given pattern AST (see
+        `nltk_tgrep.tgrep._tgrep_predicate`).  `macros` maps the names
+        of the macros in scope onto their definitions.
+
+        If `head` is a node name AST, the fraction is estimated among
+        the nodes satisfying it only: for instance, the selectivity
+        of `< DT` among `NP` nodes, from the number of `(NP, DT)` label
+        pairs.
+        '''
+        estimate = lambda x: self.selectivity(x, macros, head, _seen)
+        kind = ast[0]
+        if kind in ('any', 'literal', 'regex', 'icase', 'node_or'):
+            if kind == 'node_or' and not _tgrep_is_name_test(ast):
+                return estimate(('or', ast[1]))
+            return self.name_selectivity(ast)
+        elif kind in ('treepos', 'label_use'):
+            # a single node per tree
+            return 1.0 / max(self.mean_size, 1.0)
+        elif kind == 'macro':
+            if macros is None or ast[1] not in macros:
+                raise TgrepException('macro {0} not defined'.format(ast[1]))
+            if ast[1] in _seen:
+                raise TgrepException('macro {0} is recursive'.format(ast[1]))
+            return self.selectivity(macros[ast[1]], macros, head,
+                                    _seen + (ast[1],))
+        elif kind == 'bind':
+            return estimate(ast[1])
+        elif kind == 'rel':
+            if head is not None:
+                selectivity = self._pair_selectivity(ast[1], head, ast[2],
+                                                     macros)
+                if selectivity is not None:
+                    return selectivity
+            return self.relation_selectivity(ast[1], estimate(ast[2]))
+        elif kind == 'not':
+            return 1.0 - estimate(ast[1])
+        elif kind == 'and':
+            # the conjunct giving the head constraint is estimated over
+            # all nodes, and the others among the nodes satisfying it
+            result = 1.0
+            conjunct_head = None
+            for conjunct in ast[1]:
+                if conjunct_head is None:
+                    conjunct_head = _tgrep_head_constraint(conjunct,
+                                                           macros or {})
+                    if conjunct_head is not None:
+                        result *= estimate(conjunct)
+                        continue
+                result *= self.selectivity(conjunct, macros,
+                                           conjunct_head or head, _seen)
+            return result
+        elif kind == 'segment':
+            result = 1.0
+            for conjunct in ast[2]:
+                result *= self.selectivity(conjunct, macros, None, _seen)
+            return result
+        elif kind == 'or':
+            result = 1.0
+            for disjunct in ast[1]:
+                result *= 1.0 - estimate(disjunct)
+            return 1.0 - result
+        elif kind == 'exprs':
+            disjuncts = ast[2]
+            if len(disjuncts) == 1:
+                return self.selectivity(disjuncts[0], dict(ast[1]))
+            return self.selectivity(('or', disjuncts), dict(ast[1]))
+        raise TgrepException('cannot interpret pattern node {0!r}'.format(ast))
+
+    def cost(self, ast, macros=None, head=None, _seen=()):
+        '''
+        Returns the estimated cost of testing a node against the given
+        pattern AST, in tests of node names.  `macros` and `head` are
+        as for `selectivity`.
+        '''
+        estimate = lambda x: self.cost(x, macros, head, _seen)
+        kind = ast[0]
+        if kind == 'macro':
+            if macros is None or ast[1] not in macros:
+                raise TgrepException('macro {0} not defined'.format(ast[1]))
+            if ast[1] in _seen:
+                raise TgrepException('macro {0} is recursive'.format(ast[1]))
+            return self.cost(macros[ast[1]], macros, head, _seen + (ast[1],))
+        elif kind == 'node_or' and not _tgrep_is_name_test(ast):
+            return estimate(('or', ast[1]))
+        elif kind in ('bind', 'not'):
+            return estimate(ast[1])
+        elif kind == 'rel':
+            # the related nodes are visited until one matches
+            selectivity = self.selectivity(ast[2], macros, None, _seen)
+            visits = self.visits(ast[1])
+            if selectivity > 0:
+                visits = min(visits, 1.0 / selectivity)
+            return 1.0 + visits * self.cost(ast[2], macros, None, _seen)
+        elif kind in ('and', 'segment', 'or'):
+            # later parts are only tested if the earlier ones are true
+            # (for conjunctions) or false (for disjunctions)
+            parts = ast[2] if kind == 'segment' else ast[1]
+            result = 0.0
+            reached = 1.0
+            for part in parts:
+                result += reached * estimate(part)
+                selectivity = self.selectivity(part, macros, head, _seen)
+                reached *= selectivity if kind != 'or' else 1.0 - selectivity
+            return result
+        elif kind == 'exprs':
+            return sum(self.cost(x, dict(ast[1])) for x in ast[2])
+        return 1.0
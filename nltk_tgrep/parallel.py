@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Parallel corpus search over a pool of worker processes.
+
+`parallel_search_corpus` splits a corpus into chunks of trees, and
+searches the chunks in a `multiprocessing` pool.  Workers are sent the
+compiled pattern once, when they start (see `_init_worker`).  Only a
+bounded number of chunks is in flight at any time, so that the corpus
+may be an arbitrarily long iterable.
+
+Trees are pickled to be sent to the workers, which costs time in the
+main process.  A `nltk_tgrep.binary_corpus.BinaryCorpus` can be
+searched instead: workers then open the corpus file themselves, and are
+only sent ranges of tree ids, so that the main process does much less
+work per tree.  ``bench_parallel_search`` in ``benchmarks/bench_tgrep.py``
+times both with 1, 2 and one process per CPU; see the README for the
+timings measured so far.
+'''
+
+from __future__ import print_function, unicode_literals
+try:
+    from builtins import range
+except ImportError:
+    # tgrep.py warns that the `future` package is missing
+    pass
+from collections import deque
+from .binary_corpus import BinaryCorpus
+from .tgrep import TgrepException, TgrepPattern, _PATTERN_CACHE, _istree, \
+    tgrep_positions
+
+# per-process state of a worker
+_WORKER = {}
+
+def _init_worker(pattern, search_leaves, engine, corpus_path):
+    '''
+    Initialises a worker process: stores the `TgrepPattern` to search
+    for, and opens the binary corpus being searched, if any.
+    '''
+    _WORKER['pattern'] = pattern
+    _WORKER['search_leaves'] = search_leaves
+    _WORKER['engine'] = engine
+    _WORKER['corpus'] = (BinaryCorpus(corpus_path)
+                         if corpus_path is not None else None)
+
+def _search_chunk(chunk):
+    '''
+    Searches a chunk of the corpus in a worker process, and returns a
+    list of `(tree_index, positions)` pairs for the trees containing
+    matches.
+
+    `chunk` is a pair of the index of the first tree in the chunk and
+    either the list of trees in the chunk, or the index following the
+    last tree in the chunk, for binary corpora.
+    '''
+    start, trees = chunk
+    pattern = _WORKER['pattern']
+    search_leaves = _WORKER['search_leaves']
+    results = []
+    corpus = _WORKER['corpus']
+    if corpus is not None:
+        for tree_index in range(start, trees):
+            positions = corpus.match_positions(pattern, tree_index,
+                                               search_leaves)
+            if positions:
+                results.append((tree_index, positions))
+        return results
+    for tree_index, tree in enumerate(trees, start):
+        # trees arrive as plain `Tree`s (see `_picklable_tree`), which
+        # can be searched as they are
+        positions = tgrep_positions(tree, pattern, search_leaves,
+                                    _WORKER['engine'])
+        if positions:
+            results.append((tree_index, positions))
+    return results
+
+def _corpus_chunks(trees, chunksize):
+    '''
+    Splits the corpus into chunks, and yields for each one the trees in
+    the chunk (None, for binary corpora) and the chunk to send to a
+    worker (see `_search_chunk`).
+    '''
+    if isinstance(trees, BinaryCorpus):
+        for start in range(0, len(trees), chunksize):
+            yield None, (start, min(start + chunksize, len(trees)))
+        return
+    chunk = []
+    start = 0
+    for tree in trees:
+        chunk.append(tree)
+        if len(chunk) == chunksize:
+            yield chunk, (start, [_picklable_tree(x) for x in chunk])
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield chunk, (start, [_picklable_tree(x) for x in chunk])
+
+def _picklable_tree(tree):
+    '''
+    Returns a version of the tree which can be pickled cheaply: the
+    parent pointers of a `ParentedTree` make pickling it recursive.
+    '''
+    if _istree(tree):
+        # NLTK has been imported, if `tree` is a `Tree`
+        import nltk.tree
+        if type(tree) is not nltk.tree.Tree:
+            return nltk.tree.Tree.convert(tree)
+    return tree
+
+def _pop_ready(pending):
+    '''
+    Removes and returns the first entry in `pending` whose result is
+    ready; if there is none, removes the oldest entry, and waits for
+    its result.
+    '''
+    for k, entry in enumerate(pending):
+        if entry[1].ready():
+            del pending[k]
+            return entry
+    entry = pending.popleft()
+    entry[1].wait()
+    return entry
+
+def parallel_search_corpus(trees, tgrep_string, processes = None,
+                           chunksize = 100, ordered = True, limit = None,
+                           search_leaves = True, engine = 'node',
+                           parser = 'pyparsing'):
+    '''
+    Searches a corpus of trees for the given `tgrep_string` in
+    `processes` worker processes (by default, one per CPU), and
+    yields a `(tree_index, position, node)` triple for each match, like
+    `nltk_tgrep.tgrep.search_corpus`.
+
+    `trees` may be any iterable of trees, or a
+    `nltk_tgrep.binary_corpus.BinaryCorpus`.  The corpus is searched in
+    chunks of `chunksize` trees.  If `ordered` is True, matches are
+    yielded in corpus order; otherwise, the matches of the chunks which
+    have already been searched are yielded first, and when there are
+    none, those of the oldest chunk still being searched.  If `limit`
+    is given, the search stops after that many matches.
+    `tgrep_string` may be a search string or a `TgrepPattern`; search
+    strings are compiled in the main process with the given `parser`
+    (see `nltk_tgrep.tgrep.tgrep_compile`).
+
+    `engine` selects the search engine for trees (see
+    `nltk_tgrep.tgrep.tgrep_positions`); a binary corpus is always
+    searched with the set-at-a-time engine on its node tables (see
+    `nltk_tgrep.binary_corpus.BinaryCorpus.match_ids`), whatever the
+    `engine`.
+    '''
+    # report bad arguments and syntax errors before starting any workers
+    if engine not in ('node', 'set'):
+        raise TgrepException('unknown tgrep engine "{0}"'.format(engine))
+    pattern = tgrep_string
+    if not isinstance(pattern, TgrepPattern):
+        pattern = _PATTERN_CACHE.compile(tgrep_string, parser)
+    if limit is not None and limit <= 0:
+        return
+    import multiprocessing
+    corpus = trees if isinstance(trees, BinaryCorpus) else None
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (pattern, search_leaves, engine,
+                                 corpus.path if corpus is not None else None))
+    # keep every worker busy, without reading the whole corpus ahead
+    max_pending = 2 * (processes or multiprocessing.cpu_count())
+    chunks = _corpus_chunks(trees, chunksize)
+    pending = deque()
+    num_found = 0
+    try:
+        while True:
+            for chunk_trees, chunk in chunks:
+                pending.append((chunk_trees, pool.apply_async(_search_chunk,
+                                                              (chunk,)),
+                                chunk[0]))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            if ordered:
+                chunk_trees, result, start = pending.popleft()
+            else:
+                chunk_trees, result, start = _pop_ready(pending)
+            for tree_index, positions in result.get():
+                if chunk_trees is None:
+                    tree = corpus.tree(tree_index)
+                else:
+                    tree = chunk_trees[tree_index - start]
+                for position in positions:
+                    yield tree_index, position, tree[position]
+                    num_found += 1
+                    if limit is not None and num_found >= limit:
+                        return
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for the vectorized NumPy search engine.
+'''
+
+from __future__ import print_function, unicode_literals
+from nltk.tree import ParentedTree, Tree
+from .. import tgrep
+from ..array_forest import ArrayForest, _tgrep_ast_is_vectorizable
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CORPUS = [
+    '(S (NP (DT the) (NN dog)) (VP (VBD barked)))',
+    '(S (NP (DT those) (NNS cats)) (VP (VBD slept)))',
+    '(S (NP (PRP it)) (VP (VBD saw) (NP (DT a) (NN bird))))',
+    '(S (NP (NNP Kim)) (VP (VBD left) (EMPTY)))',
+]
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestArrayForest(unittest.TestCase):
+
+    '''
+    Class containing unit tests for array_forest.py.
+    '''
+
+    def setUp(self):
+        self.trees = [ParentedTree.fromstring(s) for s in CORPUS]
+        self.forest = ArrayForest(self.trees)
+
+    def test_arrays(self):
+        '''
+        Test the arrays encoding the trees of a forest.
+        '''
+        forest = self.forest
+        self.assertEqual(len(forest), 4)
+        self.assertEqual(forest.num_nodes, 9 + 9 + 12 + 8)
+        self.assertEqual(list(forest.tree_offsets), [0, 9, 18, 30, 38])
+        self.assertEqual([forest.strings[i] for i in forest.label[9:18]],
+                         ['S', 'NP', 'DT', 'those', 'NNS', 'cats', 'VP',
+                          'VBD', 'slept'])
+        self.assertEqual(list(forest.parent[9:18]),
+                         [-1, 9, 10, 11, 10, 13, 9, 15, 16])
+        self.assertEqual(list(forest.end[9:18]),
+                         [17, 14, 12, 12, 14, 14, 17, 17, 17])
+        self.assertEqual(list(forest.child_rank[9:18]),
+                         [0, 0, 0, 0, 1, 0, 1, 0, 0])
+        self.assertEqual(list(forest.tree_id[7:11]), [0, 0, 1, 1])
+        self.assertEqual(list(forest.is_tree[9:14]),
+                         [True, True, True, False, True])
+        self.assertEqual(forest.treeposition(14), (0, 1, 0))
+        self.assertEqual(forest.treeposition(9), ())
+        # the top of the left-most path down to `those` is the root,
+        # and down to `slept`, the VP
+        self.assertEqual(forest.leftmost_top[12], 9)
+        self.assertEqual(forest.leftmost_top[17], 15)
+
+    def test_search(self):
+        '''
+        Test that searching a forest gives the same results as
+        searching the trees.
+        '''
+        for search in ['NP < DT', 'NN|NNS', '/^NN/ . *', '* < those',
+                       '* !< DT', 'VP < (VBD . (NP < NN))', 'EMPTY',
+                       'S < (NP < NNP)', 'NP > VP', 'i@"kim"', '* $ *',
+                       'NP << NN', 'DT >> VP', 'NP .. VBD', 'VBD .. *',
+                       '* . EMPTY', 'VP [< EMPTY | << NN]', 'NP=x < DT',
+                       '@ N /^N/; S < @N', 'NP $ VP !<< PRP',
+                       # searched one tree at a time
+                       'VP <2 NP | <: VBD', 'NP=x , (VBD > (VP < =x))',
+                       'N(1,0)']:
+            for search_leaves in (True, False):
+                expected = [
+                    (i, tgrep.tgrep_positions(tree, search, search_leaves))
+                    for i, tree in enumerate(self.trees)]
+                expected = [(i, positions) for i, positions in expected
+                            if positions]
+                self.assertEqual(
+                    list(self.forest.search_positions(search,
+                                                      search_leaves)),
+                    expected, search)
+                self.assertEqual(
+                    list(self.forest.search_nodes(search, search_leaves)),
+                    [(i, [self.trees[i][position] for position in positions])
+                     for i, positions in expected], search)
+                self.assertEqual(
+                    self.forest.count(search, search_leaves),
+                    sum(len(positions) for _i, positions in expected), search)
+
+    def test_counts(self):
+        '''
+        Test counting the matches in each tree of a forest.
+        '''
+        pattern = tgrep.tgrep_compile('NP < DT')
+        self.assertEqual(list(self.forest.tree_counts(pattern)), [1, 1, 1, 0])
+        self.assertEqual(self.forest.count(pattern), 3)
+        self.assertEqual(list(self.forest.tree_counts('NP <, DT')),
+                         [1, 1, 1, 0])
+        self.assertEqual(ArrayForest([]).count('NP'), 0)
+        self.assertTrue(_tgrep_ast_is_vectorizable(
+            tgrep.tgrep_compile('NP << NN . VP').ast))
+        self.assertFalse(_tgrep_ast_is_vectorizable(
+            tgrep.tgrep_compile('@ N NP <, DT; S < @N').ast))
+        self.assertRaises(tgrep.TgrepException, ArrayForest, ['word'])
+
+    def test_unhashable_labels(self):
+        '''
+        Test that trees with unhashable node labels are searched one
+        tree at a time.
+        '''
+        trees = [Tree.fromstring('(S (NP (DT the) (NN dog)))'),
+                 Tree(['S'], [Tree('NP', ['it'])])]
+        forest = ArrayForest(trees)
+        self.assertIsNone(forest.strings)
+        self.assertEqual(list(forest.search_positions('NP')),
+                         [(0, [(0,)]), (1, [(0,)])])
+
+if __name__ == '__main__':
+    unittest.main()
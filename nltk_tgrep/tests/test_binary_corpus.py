@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for the binary corpus format.
+'''
+
+from __future__ import print_function, unicode_literals
+from nltk.tree import ParentedTree
+from .. import tgrep
+from ..binary_corpus import BinaryCorpus, write_binary_corpus
+import os
+import shutil
+import tempfile
+import unittest
+
+CORPUS = [
+    '(S (NP (DT the) (NN dog)) (VP (VBD barked)))',
+    '(S (NP (DT those) (NNS cats)) (VP (VBD slept)))',
+    '(S (NP (PRP it)) (VP (VBD saw) (NP (DT a) (NN bird))))',
+    '(S (NP (NNP Kim)) (VP (VBD left) (EMPTY)))',
+]
+
+class TestBinaryCorpus(unittest.TestCase):
+
+    '''
+    Class containing unit tests for binary_corpus.py.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'corpus.t2c')
+        self.trees = [ParentedTree.fromstring(s) for s in CORPUS]
+        write_binary_corpus(self.path, self.trees)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_node_tables(self):
+        '''
+        Test the node tables of a tree in a binary corpus.
+        '''
+        with BinaryCorpus(self.path) as corpus:
+            self.assertEqual(len(corpus), 4)
+            view = corpus.view(0)
+            self.assertEqual(len(view), 9)
+            self.assertEqual([corpus.strings[i] for i in view.label],
+                             ['S', 'NP', 'DT', 'the', 'NN', 'dog', 'VP',
+                              'VBD', 'barked'])
+            self.assertEqual(list(view.parent), [-1, 0, 1, 2, 1, 4, 0, 6, 7])
+            self.assertEqual(list(view.first_child),
+                             [1, 2, 3, -1, 5, -1, 7, 8, -1])
+            self.assertEqual(list(view.next_sibling),
+                             [-1, 6, 4, -1, -1, -1, -1, -1, -1])
+            self.assertEqual(list(view.end), [8, 5, 3, 3, 5, 5, 8, 8, 8])
+            self.assertEqual(list(view.child_count),
+                             [2, 2, 1, -1, 1, -1, 1, 1, -1])
+            self.assertEqual(view.treeposition(5), (0, 1, 0))
+            self.assertEqual(view.label_ids['NP'], [1])
+            self.assertEqual(view.word_ids['dog'], [5])
+            # the tree is only built on demand
+            for i, tree in enumerate(self.trees):
+                self.assertEqual(corpus.tree(i), tree)
+            self.assertTrue(isinstance(corpus[3], ParentedTree))
+            self.assertRaises(IndexError, corpus.view, 4)
+
+    def test_search(self):
+        '''
+        Test that searching a binary corpus gives the same results as
+        searching the trees.
+        '''
+        with BinaryCorpus(self.path) as corpus:
+            for search in ['NP < DT', 'NN|NNS', '/^NN/ . *', '* < those',
+                           '* !< DT', 'VP < (VBD . (NP < NN))', 'EMPTY',
+                           'S < (NP < NNP)', 'NP > VP', 'i@"kim"', '* $ *',
+                           'VP <2 NP | <: VBD', 'NP=x , (VBD > (VP < =x))',
+                           'N(1,0)', '@ N /^N/; S < @N']:
+                for search_leaves in (True, False):
+                    expected = [
+                        (i, tgrep.tgrep_positions(tree, search,
+                                                  search_leaves))
+                        for (i, tree) in enumerate(self.trees)]
+                    expected = [x for x in expected if x[1]]
+                    self.assertEqual(
+                        list(corpus.search_positions(search, search_leaves)),
+                        expected, search)
+            self.assertEqual(list(corpus.search_nodes('NN < bird')),
+                             [(2, [self.trees[2][1, 1, 1]])])
+            self.assertEqual(corpus.match_ids('NP', 2), [1, 7])
+
+    def test_close(self):
+        '''
+        Test that closing a binary corpus unmaps the file, even while
+        views of its trees are still in use.
+        '''
+        with BinaryCorpus(self.path) as corpus:
+            self.assertEqual(corpus.strings[1], 'NP')
+            self.assertEqual(len(corpus.strings), 22)
+            self.assertRaises(IndexError, lambda: corpus.strings[22])
+            view = corpus.view(2)
+            self.assertEqual(list(corpus.search_positions('NP=x < DT')),
+                             [(0, [(0,)]), (1, [(0,)]), (2, [(1, 1)])])
+            self.assertEqual(corpus.match_positions('NP', 2),
+                             [(0,), (1, 1)])
+        self.assertTrue(corpus._mmap.closed)
+        self.assertRaises(ValueError, lambda: view.label[0])
+        corpus.close()
+
+    def test_bad_file(self):
+        '''
+        Test opening a file which is not a binary corpus.
+        '''
+        with open(self.path, 'wb') as outfile:
+            outfile.write(b'(S (NP x))' * 10)
+        self.assertRaises(tgrep.TgrepException, BinaryCorpus, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for the persistent corpus index.
+'''
+
+from __future__ import print_function, unicode_literals
+from nltk.tree import ParentedTree, Tree
+from .. import tgrep
+from ..corpus_index import CorpusIndex, _tgrep_corpus_query
+import os
+import shutil
+import tempfile
+import unittest
+
+CORPUS = [
+    '(S (NP (DT the) (NN dog)) (VP (VBD barked)))',
+    '(S (NP (DT those) (NNS cats)) (VP (VBD slept)))',
+    '(S (NP (PRP it)) (VP (VBD saw) (NP (DT a) (NN bird))))',
+    '(S (NP (NNP Kim)) (VP (VBD left)))',
+]
+
+class TestCorpusIndex(unittest.TestCase):
+
+    '''
+    Class containing unit tests for corpus_index.py.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trees = [ParentedTree.fromstring(s) for s in CORPUS]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_index(self, **kwargs):
+        '''Opens a corpus index in the temporary directory.'''
+        return CorpusIndex(os.path.join(self.directory, 'corpus.idx'),
+                           **kwargs)
+
+    def test_corpus_query(self):
+        '''
+        Test extraction of postings queries from search strings.
+        '''
+        def query(search):
+            pattern = tgrep.tgrep_compile(search)
+            return _tgrep_corpus_query(pattern.ast, pattern.macros)
+        self.assertEqual(query('NP'), ('value', 'NP'))
+        self.assertEqual(query('*'), None)
+        self.assertEqual(query('* !< DT'), None)
+        self.assertEqual(query('NP << those'),
+                         ('all', (('value', 'NP'), ('value', 'those'))))
+        self.assertEqual(query('NP|VP'),
+                         ('any', (('value', 'NP'), ('value', 'VP'))))
+        self.assertEqual(query('/^N/ > S'),
+                         ('all', (('names', ('regex', '^N')), ('value', 'S'))))
+        self.assertEqual(query('NP < DT'),
+                         ('all', (('value', 'NP'), ('value', 'DT'),
+                                  ('child', ('NP',), ('DT',)))))
+        self.assertEqual(query('@ D DT; NP=n >, (S < @D)'),
+                         ('all', (('value', 'NP'), ('value', 'S'),
+                                  ('value', 'DT'),
+                                  ('child', ('S',), ('DT',)),
+                                  ('child', ('S',), ('NP',)))))
+        self.assertEqual(query('NP < DT | < PRP'), ('all', (
+            ('value', 'NP'),
+            ('any', (('all', (('value', 'DT'), ('child', ('NP',), ('DT',)))),
+                     ('all', (('value', 'PRP'),
+                              ('child', ('NP',), ('PRP',)))))))))
+
+    def test_search(self):
+        '''
+        Test that searching the index gives the same results as
+        searching every tree, while skipping trees.
+        '''
+        for bigrams in (False, True):
+            with self.open_index(bigrams=bigrams) as index:
+                self.assertEqual(index.add(self.trees[:2]), range(0, 2))
+                self.assertEqual(index.add(self.trees[2:]), range(2, 4))
+                self.assertEqual(len(index), 4)
+                self.assertEqual(index.tree(2), self.trees[2])
+                for search in ['NP < DT', 'NN|NNS', '/^NN/ . *', '* < those',
+                               '* !< DT', 'VP < (VBD . (NP < NN))',
+                               'S < (NP < NNP)', 'NP > VP', 'i@"kim"']:
+                    expected = [
+                        (i, tgrep.tgrep_positions(tree, search))
+                        for (i, tree) in enumerate(self.trees)
+                        if tgrep.tgrep_positions(tree, search)]
+                    self.assertEqual(list(index.search_positions(search)),
+                                     expected, search)
+                self.assertEqual(index.candidates('* < those'), [1])
+                self.assertEqual(index.candidates('NN|NNS'), [0, 1, 2])
+                self.assertEqual(index.candidates('* !< DT'), [0, 1, 2, 3])
+                self.assertEqual(index.candidates('NP < NN'), [0, 2])
+                self.assertEqual(index.candidates('VP < DT'),
+                                 [] if bigrams else [0, 1, 2])
+                self.assertEqual(list(index.search_nodes('NNP')),
+                                 [(3, [self.trees[3][0, 0]])])
+            os.remove(os.path.join(self.directory, 'corpus.idx'))
+
+    def test_persistence(self):
+        '''
+        Test reopening and appending to an index, and searching trees
+        which are not stored in the index.
+        '''
+        with self.open_index(bigrams=True, store_trees=False) as index:
+            index.add(self.trees[:3])
+            self.assertRaises(tgrep.TgrepException, list,
+                              index.search_positions('NP'))
+        # settings are kept from the index's creation
+        with self.open_index() as index:
+            self.assertTrue(index.bigrams)
+            self.assertFalse(index.store_trees)
+            self.assertEqual(len(index), 3)
+            index.add(self.trees[3:])
+            self.assertEqual(
+                list(index.search_positions('NP < NNP', self.trees)),
+                [(3, [(0,)])])
+            self.assertRaises(tgrep.TgrepException, index.tree, 0)
+
+    def test_stored_trees(self):
+        '''
+        Test that trees are stored in bracketed form, and loaded as the
+        tree class asked for.
+        '''
+        with self.open_index() as index:
+            index.add(self.trees)
+            self.assertEqual(
+                index._connection.execute(
+                    'SELECT data FROM trees WHERE id = 1').fetchone()[0],
+                CORPUS[1])
+            self.assertTrue(isinstance(index.tree(1), ParentedTree))
+            tree = index.tree(1, Tree)
+            self.assertEqual(type(tree), Tree)
+            self.assertEqual(tree, Tree.convert(self.trees[1]))
+            self.assertRaises(tgrep.TgrepException, index.add,
+                              [Tree('NP', ['big dog'])])
+            self.assertEqual(len(index), 4)
+
+if __name__ == '__main__':
+    unittest.main()
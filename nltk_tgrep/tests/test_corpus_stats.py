@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for the corpus statistics.
+'''
+
+from __future__ import division, print_function, unicode_literals
+from nltk.tree import Tree
+from .. import tgrep
+from ..corpus_stats import CorpusStatistics
+import unittest
+
+CORPUS = [
+    '(S (NP (DT the) (NN dog)) (VP (VBD barked)))',
+    '(S (NP (DT those) (NNS cats)) (VP (VBD slept)))',
+    '(S (NP (PRP it)) (VP (VBD saw) (NP (DT a) (NN bird))))',
+]
+
+class TestCorpusStatistics(unittest.TestCase):
+
+    '''
+    Class containing unit tests for corpus_stats.py.
+    '''
+
+    def setUp(self):
+        self.stats = CorpusStatistics(Tree.fromstring(s) for s in CORPUS)
+
+    def selectivity(self, search):
+        '''Returns the estimated selectivity of the search string.'''
+        return self.stats.selectivity(tgrep.tgrep_compile(search).ast)
+
+    def test_counts(self):
+        '''
+        Test counting labels, words and tree shapes.
+        '''
+        stats = self.stats
+        self.assertEqual(stats.num_trees, 3)
+        self.assertEqual(stats.num_nodes, 30)
+        self.assertEqual(stats.num_tree_nodes, 20)
+        self.assertEqual(stats.label_counts['NP'], 4)
+        self.assertEqual(stats.label_counts['dog'], 1)
+        self.assertEqual(stats.mean_fanout, 27 / 20)
+        self.assertEqual(stats.pair_counts['NP', 'DT'], 3)
+        self.assertEqual(stats.pair_counts['DT', 'the'], 1)
+        self.assertEqual(stats.pair_counts['S', 'DT'], 0)
+        self.assertEqual(stats.fanout_histogram, {1: 13, 2: 7})
+        self.assertEqual(stats.depth_histogram,
+                         {0: 3, 1: 6, 2: 9, 3: 10, 4: 2})
+        stats.add([Tree.fromstring('(S (NP (NN dog)))'), 'not a tree'])
+        self.assertEqual(stats.num_trees, 4)
+        self.assertEqual(stats.label_counts['dog'], 2)
+
+    def test_selectivity(self):
+        '''
+        Test estimating the selectivity of patterns.
+        '''
+        self.assertEqual(self.selectivity('NP'), 4 / 30)
+        self.assertEqual(self.selectivity('NP|VP'), 7 / 30)
+        self.assertEqual(self.selectivity('/^N/'), 7 / 30)
+        self.assertEqual(self.selectivity('i@/^np$/'), 4 / 30)
+        self.assertEqual(self.selectivity('*'), 1.0)
+        self.assertEqual(self.selectivity('@ N NP; @N'), 4 / 30)
+        for search in ['NP < DT', 'NP !<< JJ', 'S << NP .. VP', 'VP $ NP',
+                       'NP [> S | >> VP]', 'DT .. NN', 'NP=n : =n < DT',
+                       'NP <1 DT', 'DT >-1 NP', 'NN , DT']:
+            selectivity = self.selectivity(search)
+            self.assertTrue(0.0 <= selectivity <= 1.0, search)
+        # relations only ever narrow down their head
+        self.assertTrue(self.selectivity('NP < DT') < self.selectivity('NP'))
+        self.assertTrue(self.selectivity('NP < DT') > self.selectivity('NP < JJ'))
+        self.assertEqual(CorpusStatistics().selectivity(('literal', 'NP')), 0.0)
+        self.assertRaises(tgrep.TgrepException, self.selectivity, '@ A @A; @A')
+
+    def test_pair_selectivity(self):
+        '''
+        Test estimating relations from parent/child label pairs.
+        '''
+        # every NP has a child DT or PRP, but no NP has a child JJ
+        self.assertEqual(self.selectivity('NP < DT|PRP'), 4 / 30)
+        self.assertEqual(self.selectivity('NP < JJ'), 0.0)
+        self.assertEqual(self.selectivity('NP > S'), 3 / 30)
+        self.assertEqual(self.selectivity('NP < (DT < the)'), 4 / 30 * (3 / 4) * (1 / 3))
+        self.assertEqual(self.stats.selectivity(
+            ('rel', '<', ('literal', 'DT')), head=('literal', 'VP')), 0.0)
+
+    def test_reorder(self):
+        '''
+        Test ordering conjunctions and disjunctions by selectivity.
+        '''
+        trees = [Tree.fromstring(s) for s in CORPUS]
+        source = lambda pattern: tgrep._tgrep_ast_source(pattern.ast)
+        for search, reordered in [
+                ('NP < DT < NN', 'NP < NN < DT'),
+                ('NP [< DT | < PRP]', 'NP [< DT | < PRP]'),
+                ('VP [< NP | < VBD]', 'VP [< VBD | < NP]'),
+                ('S << NP << NNS', 'S << NNS << NP'),
+                ('@ N NP; @N < DT < NN', '@ N NP; @N < NN < DT'),
+                ('NP=n < DT < NN', 'NP=n < DT < NN'),
+                ('VBD; NNS', 'VBD; NNS'),
+                ('NP < NNS; NP < NN', 'NP < NN; NP < NNS')]:
+            pattern = tgrep.tgrep_compile(search, self.stats)
+            self.assertEqual(source(pattern), reordered)
+            self.assertEqual(pattern.tgrep_string, search)
+            for tree in trees:
+                for engine in ['node', 'set']:
+                    self.assertEqual(
+                        tgrep.tgrep_positions(tree, pattern, engine=engine),
+                        tgrep.tgrep_positions(tree, search, engine=engine))
+
+    def test_explain(self):
+        '''
+        Test annotating a search plan with selectivities.
+        '''
+        plan = tgrep.tgrep_explain('NP < DT', stats=self.stats)
+        self.assertEqual(plan.steps[1].selectivity, 4 / 30)
+        self.assertAlmostEqual(plan.steps[0].selectivity,
+                               self.selectivity('NP < DT'))
+        self.assertTrue(0.0 < plan.estimated_matches < 4 / 3)
+        self.assertTrue('estimated matches per tree' in str(plan))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for the cost of importing nltk_tgrep.
+'''
+
+from __future__ import print_function, unicode_literals
+from .. import tgrep
+import binascii
+import json
+import os
+import pickle
+import subprocess
+import sys
+import unittest
+
+# the modules which are only imported once they are needed
+HEAVY_MODULES = ['nltk', 'pyparsing', 'multiprocessing', 'sqlite3', 'numpy']
+
+# importing nltk_tgrep may take at most this fraction of the time it
+# takes to import nltk.tree afterwards; it takes well under a tenth
+MAX_IMPORT_FRACTION = 0.25
+
+# run in a fresh interpreter: prints the times taken to import
+# nltk_tgrep and then nltk.tree, and the heavy modules loaded after
+# importing nltk_tgrep, after unpickling and running a compiled
+# pattern, and after compiling a search string
+SCRIPT = '''
+import binascii, json, pickle, sys, time
+heavy = {heavy!r}
+loaded = lambda: [m for m in heavy if m in sys.modules]
+start = time.time()
+import nltk_tgrep
+result = {{'seconds': time.time() - start, 'import': loaded()}}
+pattern = pickle.loads(binascii.unhexlify({pattern!r}))
+start = time.time()
+from nltk.tree import Tree
+result['nltk_seconds'] = time.time() - start
+positions = nltk_tgrep.tgrep_positions(
+    Tree.fromstring('(S (NP (DT the) (NN dog)) (VP (VBD barked)))'), pattern)
+result['search'] = [list(position) for position in positions]
+result['unpickle'] = loaded()
+nltk_tgrep.tgrep_compile('NP < DT')
+result['compile'] = loaded()
+print(json.dumps(result))
+'''
+
+class TestImport(unittest.TestCase):
+
+    '''
+    Class containing unit tests for importing nltk_tgrep.
+    '''
+
+    def run_script(self):
+        '''Runs `SCRIPT`, and returns the results it prints.'''
+        pattern = pickle.dumps(tgrep.tgrep_compile('NP < DT'), 2)
+        script = SCRIPT.format(
+            heavy=HEAVY_MODULES,
+            pattern=binascii.hexlify(pattern).decode('ascii'))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        return json.loads(output.decode('utf-8'))
+
+    def test_lazy_import(self):
+        '''
+        Test that importing nltk_tgrep is fast compared to importing
+        NLTK, and that the heavy modules are only imported once they
+        are needed.
+        '''
+        # the first run may have to compile the package's bytecode
+        self.run_script()
+        result = self.run_script()
+        self.assertEqual(result['import'], [])
+        self.assertLess(result['seconds'],
+                        MAX_IMPORT_FRACTION * result['nltk_seconds'])
+        # searching with an unpickled pattern does not need pyparsing
+        self.assertEqual(result['search'], [[0]])
+        self.assertNotIn('pyparsing', result['unpickle'])
+        self.assertIn('pyparsing', result['compile'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Unit tests for parallel corpus search.
+'''
+
+from __future__ import print_function, unicode_literals
+from nltk.tree import ParentedTree
+from .. import tgrep
+from ..binary_corpus import BinaryCorpus, write_binary_corpus
+from ..parallel import parallel_search_corpus
+import os
+import pyparsing
+import shutil
+import tempfile
+import unittest
+
+def make_corpus(size):
+    '''Builds a small corpus of varied trees.'''
+    trees = []
+    for i in range(size):
+        words = ' '.join('(NN w{0})'.format(j) for j in range(i % 4 + 1))
+        trees.append(ParentedTree.fromstring(
+            '(S (NP (DT the) {0}) (VP (VB v{1})))'.format(words, i % 3)))
+    return trees
+
+class TestParallel(unittest.TestCase):
+
+    '''
+    Class containing unit tests for parallel.py.
+    '''
+
+    def setUp(self):
+        self.trees = make_corpus(50)
+
+    def test_parallel_search(self):
+        '''
+        Test that parallel search gives the same results as
+        search_corpus.
+        '''
+        for search in ['NP < (NN . NN)', 'VB < v1', '* !< *']:
+            expected = list(tgrep.search_corpus(self.trees, search))
+            results = list(parallel_search_corpus(iter(self.trees), search,
+                                                  processes=2, chunksize=7))
+            self.assertEqual(results, expected)
+            for (_i, _p, node), (_j, _q, expected_node) in zip(results,
+                                                                expected):
+                self.assertTrue(node is expected_node)
+            results = parallel_search_corpus(self.trees, search, processes=2,
+                                             chunksize=3, ordered=False)
+            self.assertEqual(sorted(results, key=lambda x: x[:2]), expected)
+        pattern = tgrep.tgrep_compile('VB < v2')
+        self.assertEqual(list(parallel_search_corpus(self.trees, pattern, 2,
+                                                     engine='set')),
+                         list(tgrep.search_corpus(self.trees, pattern)))
+
+    def test_limit(self):
+        '''
+        Test stopping a parallel search early.
+        '''
+        expected = list(tgrep.search_corpus(self.trees, 'NN'))
+        self.assertEqual(list(parallel_search_corpus(self.trees, 'NN', 2,
+                                                     chunksize=4, limit=10)),
+                         expected[:10])
+        self.assertEqual(len(list(parallel_search_corpus(
+            self.trees, 'NN', 2, chunksize=4, ordered=False, limit=10))), 10)
+        self.assertEqual(list(parallel_search_corpus(self.trees, 'NN',
+                                                     limit=0)), [])
+        # syntax errors are reported before any workers start
+        self.assertRaises(pyparsing.ParseException, list,
+                          parallel_search_corpus(self.trees, 'NN <', 2))
+        self.assertRaises(tgrep.TgrepException, list,
+                          parallel_search_corpus(self.trees, 'NN', 2,
+                                                 engine='bogus'))
+        self.assertRaises(tgrep.TgrepException, list,
+                          parallel_search_corpus(self.trees, 'NN < VB', 2,
+                                                 parser='lex'))
+        self.assertEqual(list(parallel_search_corpus(self.trees, 'NN $, DT', 2,
+                                                     parser='native')),
+                         list(tgrep.search_corpus(self.trees, 'NN $, DT')))
+        # patterns without a search string are pickled as their AST
+        pattern = tgrep.TgrepPattern(tgrep.tgrep_compile('NN').ast)
+        self.assertEqual(list(parallel_search_corpus(self.trees, pattern, 2)),
+                         expected)
+
+    def test_binary_corpus(self):
+        '''
+        Test parallel search of a binary corpus.
+        '''
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'corpus.t2c')
+            write_binary_corpus(path, self.trees)
+            with BinaryCorpus(path) as corpus:
+                results = list(parallel_search_corpus(corpus, 'NP < (NN . NN)',
+                                                      processes=2,
+                                                      chunksize=6))
+                # bad engines are reported before any workers start
+                self.assertRaises(tgrep.TgrepException, list,
+                                  parallel_search_corpus(corpus, 'NP', 2,
+                                                         engine='bogus'))
+            self.assertEqual(results, list(tgrep.search_corpus(
+                self.trees, 'NP < (NN . NN)')))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,7 +13,13 @@ try:
 except ImportError:
     print('Warning: nltk_tgrep may not work correctly on Python 2.* without the ')
     print('`future` package installed.')
-from nltk.tree import ParentedTree
+from nltk.tree import ParentedTree, Tree
+import ast
+import io
+import os
+import pickle
+import pyparsing
+import tokenize
 from .. import tgrep
 import unittest
 
@@ -619,5 +625,676 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(tgrep.tgrep_positions(tree, 'NN;;'),
                          [(0,2), (2,1)])
 
+    def test_plain_predicate(self):
+        '''
+        Test searching with a predicate function taking just a node.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (JJ big) (NN dog)) '
+            '(VP bit) (NP (DT a) (NN cat)))')
+        predicate = lambda n: isinstance(n, ParentedTree) and n.label() == 'NN'
+        self.assertEqual(tgrep.tgrep_positions(tree, predicate),
+                         [(0,2), (2,1)])
+        self.assertEqual(tgrep.tgrep_nodes(tree, predicate),
+                         [tree[0,2], tree[2,1]])
+        self.assertEqual([position for _i, position, _node in
+                          tgrep.search_corpus([tree, tree[0]], predicate)],
+                         [(0,2), (2,1), (2,)])
+        self.assertEqual(tgrep.tgrep_count(tree, predicate), 2)
+        self.assertTrue(tgrep.tgrep_exists(tree, predicate))
+        self.assertEqual(tgrep.tgrep_first(tree, predicate), (0,2))
+
+    def test_pattern_cache(self):
+        '''
+        Test that search strings are compiled once and then served from
+        the LRU cache.
+        '''
+        cache = tgrep.TgrepPatternCache(maxsize=2)
+        pred = cache.compile('NP < DT')
+        self.assertTrue(cache.compile(b' NP < DT ') is pred)
+        self.assertEqual(cache.info(), tgrep.CacheInfo(1, 1, 0, 2, 1))
+        cache.compile('NN')
+        cache.compile('VP')
+        self.assertEqual(cache.info(), tgrep.CacheInfo(1, 3, 1, 2, 2))
+        # 'NP < DT' was least recently used, and has been evicted
+        self.assertFalse(cache.compile('NP < DT') is pred)
+        cache.resize(0)
+        self.assertEqual(cache.info().currsize, 0)
+        cache.compile('NN')
+        self.assertEqual(cache.info().currsize, 0)
+        cache.clear()
+        self.assertEqual(cache.info(), tgrep.CacheInfo(0, 0, 0, 0, 0))
+
+    def test_positions_use_cache(self):
+        '''
+        Test that tgrep_positions compiles search strings through the
+        module-level cache.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (JJ big) (NN dog)) '
+            '(VP bit) (NP (DT a) (NN cat)))')
+        tgrep.tgrep_cache_clear()
+        for _ in range(3):
+            self.assertEqual(tgrep.tgrep_positions(tree, 'NP < DT'),
+                             [(0,), (2,)])
+        info = tgrep.tgrep_cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        # failed compilations are not cached
+        self.assertRaises(tgrep.TgrepException,
+                          tgrep.tgrep_positions, tree, '* >>> S')
+        self.assertEqual(tgrep.tgrep_cache_info().currsize, 1)
+
+    def test_tree_index(self):
+        '''
+        Test the structural information recorded by TreeIndex.
+        '''
+        tree = ParentedTree.fromstring('(S (NP (DT the) (NN dog)) (VP barked))')
+        index = tgrep.TreeIndex(tree)
+        self.assertEqual([index.treeposition(i) for i in range(len(index))],
+                         tree.treepositions())
+        self.assertEqual(index.end_id, [7, 5, 3, 3, 5, 5, 7, 7])
+        self.assertEqual(index.parent_id, [-1, 0, 1, 2, 1, 4, 0, 6])
+        self.assertEqual(index.depth, [0, 1, 2, 3, 2, 3, 1, 2])
+        self.assertEqual(index.child_rank, [0, 0, 0, 0, 1, 0, 1, 0])
+        self.assertEqual(index.first_leaf, [0, 0, 0, 0, 1, 1, 2, 2])
+        self.assertEqual(index.last_leaf, [2, 1, 0, 0, 1, 1, 2, 2])
+        np_id = index.node_id(tree[0])
+        vp_id = index.node_id(tree[1])
+        self.assertTrue(index.dominates(np_id, index.node_id(tree[0, 1])))
+        self.assertFalse(index.dominates(np_id, vp_id))
+        self.assertTrue(index.precedes(np_id, vp_id))
+        self.assertTrue(index.is_sister(np_id, vp_id))
+        # leaves cannot be identified
+        self.assertEqual(index.node_id(tree[0, 0, 0]), None)
+        self.assertEqual(list(index.ancestors(tree[0, 0, 0])), [])
+
+    def test_tree_index_relations(self):
+        '''
+        Test that searching with a TreeIndex gives the same results as
+        evaluating predicates directly with ParentedTree methods.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (A (B (C w1) (D w2)) (C (A w3))) (B (D (C w4) (A w5)) '
+            '(B w6) (C (B (D w7)))) (D (A w8) (C w9)))')
+        operators = ['<', '>', '<,', '>,', '<2', '>2', '<\'', '>\'',
+                     '<-2', '>-2', '<:', '>:', '<<', '>>', '<<,', '>>,',
+                     '<<\'', '>>\'', '<<:', '>>:', '.', ',', '..', ',,',
+                     '$', '$.', '$,', '$..', '$,,']
+        for operator in operators:
+            for search in ['* {0} B', 'A !{0} (C {0} D)', '* {0} w5']:
+                search = search.format(operator)
+                pred = tgrep.tgrep_compile(search)
+                self.assertEqual(tgrep.tgrep_positions(tree, search),
+                                 [pos for pos in tree.treepositions()
+                                  if pred(tree[pos])], search)
+
+    def test_set_engine(self):
+        '''
+        Test that the set-at-a-time engine gives the same results as
+        the node-at-a-time engine.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (A (B (C w1) (D w2)) (C (A w3))) (B (D (C w4) (A w5)) '
+            '(B w6) (C (B (D w7)))) (D (A w8) (C w9)))')
+        searches = ['B', '* < C', 'A << (C . D) | > S', '* !<< (D $ C)',
+                    '/[AB]/ .. (C <, w4) & !> S', 'i@"b" >>, (A $.. B)',
+                    '* <<\' w5 ,, (A > D)', '@ X /[CD]/; @X !>>: B',
+                    'B=b < C : =b .. D', 'N(1,0) | C >-2 B']
+        for search in searches:
+            for search_leaves in (True, False):
+                self.assertEqual(
+                    tgrep.tgrep_positions(tree, search, search_leaves),
+                    tgrep.tgrep_positions(tree, search, search_leaves,
+                                          engine='set'), search)
+        self.assertEqual(tgrep.tgrep_nodes(tree, 'C < w9', engine='set'),
+                         [tree[2, 1]])
+        self.assertRaises(tgrep.TgrepException, tgrep.tgrep_positions,
+                          tree, 'B', engine='fast')
+        self.assertRaises(tgrep.TgrepException, tgrep.tgrep_positions,
+                          tree, '@ X B; @Y', engine='set')
+
+    def test_label_index(self):
+        '''
+        Test the label index of TreeIndex, and that searches only visit
+        the nodes satisfying the head constraint of the pattern.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (NN dog)) (VP (VB saw) (NP (DT a) (NN NP))))')
+        index = tgrep.TreeIndex(tree)
+        self.assertEqual(index.label_ids['NP'], [1, 9])
+        self.assertEqual(index.word_ids['NP'], [13])
+        self.assertEqual(index.ids_with_values(['NP', 'VB']), [1, 7, 9, 13])
+        seen = []
+        predicate = tgrep.tgrep_compile('/^N/')
+        self.assertEqual(index.ids_matching(lambda n: (seen.append(n) or
+                                                      predicate(n))),
+                         [1, 4, 9, 12, 13])
+        # one call per distinct label and word
+        self.assertEqual(len(seen), 11)
+        # head constraints
+        for search, head in [('NP < DT', ('literal', 'NP')),
+                             ('/^N/ | VB $ *', ('node_or', (('regex', '^N'),
+                                                            ('literal', 'VB')))),
+                             ('@ X VP; @X=x < NP', ('literal', 'VP')),
+                             ('* < NP', None),
+                             ('N(0,) | NP', None),
+                             ('NP=n < DT : =n .. VP', ('literal', 'NP')),
+                             ('NP; VP', ('node_or', (('literal', 'NP'),
+                                                     ('literal', 'VP'))))]:
+            self.assertEqual(tgrep.tgrep_compile(search).head, head, search)
+        pattern = tgrep.tgrep_compile('NP < NN')
+        self.assertEqual(pattern.candidate_ids(index), [1, 9, 13])
+        self.assertEqual(tgrep.tgrep_compile('* < NN').candidate_ids(index),
+                         None)
+        visited = []
+        visit = tgrep.TgrepPattern(pattern.ast, 'NP < NN')
+        visit.predicate = lambda n, m=None, l=None: (visited.append(n) or
+                                                      pattern(n, m, l))
+        self.assertEqual(tgrep.tgrep_positions(tree, visit),
+                         [(0,), (1, 1)])
+        self.assertEqual(len(visited), 3)
+        # unhashable labels disable the index without changing results
+        tree = ParentedTree([1], [ParentedTree('NP', ['x'])])
+        self.assertEqual(tgrep.TreeIndex(tree).label_ids, None)
+        self.assertEqual(tgrep.tgrep_positions(tree, 'NP < x'), [(0,)])
+
+    def test_iter_search(self):
+        '''
+        Test the generator versions of tgrep_positions and tgrep_nodes.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (NN dog)) (VP (VB saw) (NP (DT a) (NN cat))))')
+        for search in ['NP', '* < DT', 'NN . *', '/^N/=n >, =n']:
+            for engine in ('node', 'set'):
+                positions = tgrep.iter_tgrep_positions(tree, search,
+                                                       engine=engine)
+                self.assertFalse(isinstance(positions, list))
+                self.assertEqual(list(positions),
+                                 tgrep.tgrep_positions(tree, search))
+                self.assertEqual(list(tgrep.iter_tgrep_nodes(tree, search,
+                                                             engine=engine)),
+                                 tgrep.tgrep_nodes(tree, search))
+        # matches are found lazily
+        matches = tgrep.iter_tgrep_nodes(tree, 'NP')
+        self.assertTrue(next(matches) is tree[0])
+        self.assertTrue(next(matches) is tree[1, 1])
+        self.assertRaises(StopIteration, next, matches)
+        self.assertEqual(list(tgrep.iter_tgrep_positions('word', 'NP')), [])
+
+    def test_search_corpus(self):
+        '''
+        Test searching a corpus of trees.
+        '''
+        trees = [ParentedTree.fromstring(s) for s in [
+            '(S (NP (DT the) (NN dog)) (VP barked))',
+            '(S (NP (PRP it)) (VP (VB saw) (NP (DT a) (NN cat))))',
+            '(S (VP (VB go)))']]
+        results = tgrep.search_corpus(iter(trees), 'NP < DT')
+        self.assertFalse(isinstance(results, list))
+        self.assertEqual(list(results), [(0, (0,), trees[0][0]),
+                                         (1, (1, 1), trees[1][1, 1])])
+        for index, position, node in tgrep.search_corpus(trees, '* < VB',
+                                                         engine='set'):
+            self.assertTrue(trees[index][position] is node)
+        self.assertEqual(list(tgrep.search_corpus(trees, 'XP')), [])
+
+    def test_pickle_pattern(self):
+        '''
+        Test pickling compiled patterns.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (JJ big) (NN dog)) (VP bit) (NP (DT a) (NN cat)))')
+        searches = ['NP < DT', '@ N /^N/; @N=n !$,, =n', 'i@"np" | VP',
+                    '* < (DT . (JJ|NN))', 'N(2,1)', 'NP=x <, (DT $. NN=y) : =y , =x']
+        patterns = [tgrep.tgrep_compile(search) for search in searches]
+        data = pickle.dumps(patterns, pickle.HIGHEST_PROTOCOL)
+        # unpickling does not parse the search strings again
+        parse = tgrep._parse_tgrep_string
+        def fail(*args):
+            raise AssertionError('search string parsed')
+        tgrep._parse_tgrep_string = fail
+        try:
+            unpickled = pickle.loads(data)
+        finally:
+            tgrep._parse_tgrep_string = parse
+        for search, pattern, copy in zip(searches, patterns, unpickled):
+            self.assertTrue(isinstance(copy, tgrep.TgrepPattern))
+            self.assertEqual(copy.ast, pattern.ast)
+            self.assertEqual(copy.tgrep_string, search)
+            self.assertEqual(tgrep.tgrep_positions(tree, copy),
+                             tgrep.tgrep_positions(tree, pattern))
+            self.assertEqual(copy(tree[0]), pattern(tree[0]))
+
+    def test_pattern_set(self):
+        '''
+        Test searching for several patterns at once.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (JJ big) (NN dog)) (VP (VB bit) (NP (DT a) '
+            '(NN cat))))')
+        searches = ['NP < DT', '@ D DT; VP < (NP < @D)', '@ D DT; @D',
+                    '* < (NP < DT)', 'NP=n < (NN , (* > =n))', 'XX < @Z',
+                    'N(1,)', 'cat', '/^N/ !< JJ']
+        pattern_set = tgrep.PatternSet(searches)
+        self.assertEqual(len(pattern_set), len(searches))
+        for search_leaves in (True, False):
+            self.assertEqual(pattern_set.positions(tree, search_leaves),
+                             [tgrep.tgrep_positions(tree, search,
+                                                    search_leaves)
+                              for search in searches])
+        self.assertEqual(pattern_set.nodes(tree)[7], [tree[1, 1, 1, 0]])
+        self.assertEqual(pattern_set.positions('cat'), [[]] * len(searches))
+        # macros are expanded, so that shared subpatterns are equal
+        self.assertEqual(pattern_set._asts[0],
+                         ('exprs', (), (('and', (('literal', 'NP'),
+                                                  ('rel', '<',
+                                                   ('literal', 'DT')))),)))
+        self.assertEqual(pattern_set._asts[1][2][0][1][1][2],
+                         pattern_set._asts[0][2][0])
+        # patterns using labels, and patterns with broken macros, are
+        # searched on their own
+        self.assertEqual(pattern_set._asts[4], None)
+        self.assertEqual(pattern_set._asts[5], None)
+        self.assertRaises(tgrep.TgrepException, tgrep.PatternSet(
+            ['@ X Y; @Z']).positions, tree)
+
+    def test_memoization(self):
+        '''
+        Test that memoizing subpattern results gives the same results,
+        and evaluates each memoized subpattern once per node.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (JJ big) (NN dog)) (VP (VB bit) (NP (DT a) '
+            '(NN cat))) (PP (IN of) (NP (DT the) (NN man))))')
+        macros = {'D': ('rel', '<', ('literal', 'DT')), 'L': ('bind',
+                                                           ('any',), 'x')}
+        self.assertTrue(tgrep._tgrep_ast_is_memoizable(
+            ('and', (('literal', 'NP'), ('macro', 'D'))), macros))
+        self.assertFalse(tgrep._tgrep_ast_is_memoizable(('literal', 'NP'),
+                                                        macros))
+        self.assertFalse(tgrep._tgrep_ast_is_memoizable(
+            ('and', (('macro', 'L'), ('macro', 'D'))), macros))
+        self.assertFalse(tgrep._tgrep_ast_is_memoizable(('macro', 'E'),
+                                                        macros))
+        searches = ['* << (NP < DT)', 'S < (* << (NP < DT))',
+                    '* << (NP=n < DT) < (* < =n)', '@ D NP < DT; * >> @D',
+                    '* << (NP=x < DT) : =x .. (VP << (NP < DT))',
+                    '* !<< (NP < DT) | ,, (NN > NP)']
+        try:
+            for search in searches:
+                tgrep.tgrep_set_memoization(False)
+                expected = tgrep.tgrep_positions(tree, search)
+                tgrep.tgrep_set_memoization(True)
+                self.assertEqual(tgrep.tgrep_positions(tree, search),
+                                 expected, search)
+            # count the evaluations of the subpattern NP < DT
+            calls = []
+            relation = tgrep._tgrep_relation_predicate
+            def counting_relation(operator, predicate):
+                pred = relation(operator, predicate)
+                if operator != '<':
+                    return pred
+                return lambda n, m=None, l=None: (calls.append(n) or
+                                                  pred(n, m, l))
+            tgrep._tgrep_relation_predicate = counting_relation
+            try:
+                pattern = tgrep.tgrep_compile('* !<< (NP < IN)')
+            finally:
+                tgrep._tgrep_relation_predicate = relation
+            expected = tgrep.tgrep_positions(tree, pattern)
+            # once per NP node, rather than once per NP node below each
+            # node in the tree
+            self.assertEqual(len(calls), 3)
+            del calls[:]
+            tgrep.tgrep_set_memoization(False)
+            self.assertEqual(tgrep.tgrep_positions(tree, pattern), expected)
+            self.assertEqual(len(calls), 5)
+        finally:
+            tgrep.tgrep_set_memoization(True)
+
+    def test_lazy_relations(self):
+        '''
+        Test that the nodes related to a node are enumerated lazily,
+        nearest first, so that relation predicates stop at the first
+        related node that matches.
+        '''
+        tree = ParentedTree.fromstring('(NN end)')
+        for _ in range(50):
+            tree = ParentedTree('VP', [ParentedTree('DT', ['the']), tree])
+        tree = ParentedTree('S', [tree])
+        bottom = tree[(0,) + (1,) * 50]
+        index = tgrep.TreeIndex(tree)
+        for navigator in [tgrep._PARENTED_TREE_NAVIGATOR, index]:
+            ancestors = navigator.ancestors(bottom)
+            self.assertFalse(isinstance(ancestors, list))
+            self.assertTrue(next(ancestors) is bottom.parent())
+            self.assertTrue(next(navigator.after(tree[0, 0])) is tree[0, 1])
+            self.assertTrue(next(navigator.descendants(tree)) is tree[0])
+            self.assertTrue(
+                next(navigator.rightmost_descendants(tree[0, 1])) is
+                tree[0, 1, 1])
+        calls = []
+        def predicate(n, m=None, l=None):
+            calls.append(n)
+            return True
+        for operator in ['<<', '>>', '..', ',,', '<<,', '<<\'', '.', ',']:
+            del calls[:]
+            relation = tgrep._tgrep_relation_predicate(operator, predicate)
+            self.assertTrue(relation(tree[0, 1, 1, 0]))
+            self.assertEqual(len(calls), 1)
+
+    def test_leftmost_rightmost_identity(self):
+        '''
+        Test that >>, and >>' compare nodes by identity, and not by
+        equality of subtrees.
+        '''
+        tree = ParentedTree.fromstring('(S (A (B w)) (C (A (B w))))')
+        predicate = tgrep.tgrep_compile('B >>, S')
+        self.assertEqual([pos for pos in tree.treepositions()
+                          if predicate(tree[pos])], [(0, 0)])
+        self.assertEqual(tgrep.tgrep_positions(tree, 'B >>, S'), [(0, 0)])
+        tree = ParentedTree.fromstring('(S (A (B w)) (C (B w)))')
+        predicate = tgrep.tgrep_compile('B >>\' S')
+        self.assertEqual([pos for pos in tree.treepositions()
+                          if predicate(tree[pos])], [(1, 0)])
+        self.assertEqual(tgrep.tgrep_positions(tree, 'B >>\' S'), [(1, 0)])
+        self.assertTrue(tgrep._PARENTED_TREE_NAVIGATOR.is_rightmost_descendant(
+            tree[1, 0], tree))
+        self.assertFalse(tgrep._PARENTED_TREE_NAVIGATOR.is_rightmost_descendant(
+            tree[0, 0], tree))
+
+    def test_plain_tree(self):
+        '''
+        Test that a plain Tree can be searched without converting it to
+        a ParentedTree.
+        '''
+        string = ('(S (A (B (C w1) (D w2)) (C (A w3))) (B (D (C w4) (A w5)) '
+                  '(B w6) (C (B (D w7)))) (D (A w8) (C w9)))')
+        ptree = ParentedTree.fromstring(string)
+        tree = Tree.fromstring(string)
+        operators = ['<', '>', '<,', '>,', '<2', '>2', '<\'', '>\'',
+                     '<-2', '>-2', '<:', '>:', '<<', '>>', '<<,', '>>,',
+                     '<<\'', '>>\'', '<<:', '>>:', '.', ',', '..', ',,',
+                     '$', '$.', '$,', '$..', '$,,']
+        for operator in operators:
+            for search in ['* {0} B'.format(operator),
+                           'A !{0} (C {0} D)'.format(operator)]:
+                for engine in ['node', 'set']:
+                    self.assertEqual(
+                        tgrep.tgrep_positions(tree, search, engine=engine),
+                        tgrep.tgrep_positions(ptree, search, engine=engine))
+        for search in ['N(1,0)', 'B|N(2,)', 'C > N(0,)', 'N(0,0,0,0)',
+                       'N(5,)', 'B=x . (C > =x)']:
+            self.assertEqual(tgrep.tgrep_positions(tree, search),
+                             tgrep.tgrep_positions(ptree, search))
+        self.assertEqual(tgrep.tgrep_positions(tree, 'N(1,0)'), [(1, 0)])
+        self.assertEqual(tgrep.tgrep_positions(tree, 'N(1,0)', engine='set'),
+                         [(1, 0)])
+        self.assertEqual(tgrep.tgrep_positions(tree, 'N(0,0,0,0)'), [])
+
+    @unittest.skipUnless(hasattr(pyparsing, 'Located'),
+                         'profiling requires pyparsing 3.0 or later')
+    def test_profile(self):
+        '''
+        Test profiling the subpatterns of a search.
+        '''
+        tree = ParentedTree.fromstring(
+            '(S (NP (DT the) (NN dog)) (VP (VBD barked) (PP (IN at) '
+            '(NP (DT a) (JJ big) (NN cat)))))')
+        search = 'NP < DT !<< JJ'
+        with tgrep.tgrep_profile() as profile:
+            self.assertEqual(tgrep.tgrep_positions(tree, search), [(0,)])
+            # profiling accumulates over searches, with any engine
+            self.assertEqual(tgrep.tgrep_positions(tree, search,
+                                                   engine='set'), [(0,)])
+        report = profile.report()
+        self.assertEqual(list(report.keys()),
+                         [(0, 14), (0, 2), (3, 7), (5, 7), (8, 14), (12, 14)])
+        for (start, end), entry in report.items():
+            self.assertEqual(entry.source, search[start:end])
+        # only the two NP nodes are tested
+        self.assertEqual(report[(0, 14)].calls, 4)
+        self.assertEqual(report[(0, 14)].true, 2)
+        self.assertEqual(report[(0, 14)].visited, None)
+        self.assertEqual(report[(3, 7)].kind, 'rel')
+        self.assertEqual(report[(3, 7)].visited, 4)
+        # the negated relation searches all 7 nodes below the first NP
+        self.assertEqual(report[(8, 14)].kind, 'not')
+        self.assertEqual(report[(8, 14)].calls, 4)
+        self.assertEqual(report[(8, 14)].true, 2)
+        self.assertEqual(report[(8, 14)].visited, 14)
+        self.assertEqual(report[(12, 14)].calls, 14)
+        self.assertTrue(report[(0, 14)].time >= report[(8, 14)].time)
+        self.assertTrue(search in str(profile))
+        # macros are profiled where they are defined and used
+        with tgrep.tgrep_profile() as profile:
+            search = '@ N NN|NNS; NP < @N'
+            self.assertEqual([(i, position) for i, position, _node in
+                              tgrep.search_corpus([tree, tree], search)],
+                             [(0, (0,)), (0, (1, 1, 1)),
+                              (1, (0,)), (1, (1, 1, 1))])
+            tgrep.tgrep_positions(tree, 'VP')
+        self.assertRaises(tgrep.TgrepException, profile.report)
+        report = profile.report(search)
+        self.assertEqual([entry.source for entry in report.values()],
+                         [search, 'NN|NNS', 'NP < @N', 'NP', '< @N', '@N'])
+        self.assertEqual(report[(4, 10)].calls, report[(17, 19)].calls)
+        self.assertEqual(profile.report('VP')[(0, 2)].true, 1)
+        # searches are not profiled outside the block
+        tgrep.tgrep_positions(tree, 'VP')
+        self.assertEqual(profile.report('VP')[(0, 2)].calls, 1)
+
+    def test_explain(self):
+        '''
+        Test explaining the plan of a search.
+        '''
+        plan = tgrep.tgrep_explain('@ D DT|PRP; NP <, @D %.. (JJ !>, ADJP)')
+        self.assertEqual(plan.source, 'NP <1 DT|PRP $.. (JJ !>1 ADJP)')
+        self.assertEqual([(step.depth, step.text) for step in plan.steps],
+                         [(0, 'and'), (1, 'NP'), (1, '<1'), (2, 'DT|PRP'),
+                          (1, '$..'), (2, 'and'), (3, 'JJ'), (3, '!>1'),
+                          (4, 'ADJP')])
+        self.assertEqual([step.cost for step in plan.steps if step.cost],
+                         ['O(1)', 'O(b)', 'O(1)'])
+        self.assertEqual(plan.quadratic, [])
+        self.assertEqual(plan.steps[0].selectivity, None)
+        self.assertEqual(plan.estimated_matches, None)
+        # the normalised search string has the same meaning
+        self.assertEqual(tgrep.tgrep_compile(plan.source).ast,
+                         tgrep.tgrep_compile('NP <1 DT|PRP $.. '
+                                             '(JJ !>1 ADJP)').ast)
+        # relations scanning the whole tree for every node are
+        # quadratic with the node engine, but not with the set engine
+        plan = tgrep.tgrep_explain('S << NP .. VP')
+        self.assertEqual([step.text for step in plan.quadratic], ['<<', '..'])
+        self.assertTrue('* quadratic' in str(plan))
+        self.assertEqual(tgrep.tgrep_explain('S << NP .. VP',
+                                             engine='set').quadratic, [])
+        # ... except when the set engine falls back on the node engine
+        plan = tgrep.tgrep_explain('S=s << NP : =s .. VP', engine='set')
+        self.assertEqual(plan.engine, 'node')
+        self.assertEqual(len(plan.quadratic), 2)
+        self.assertRaises(tgrep.TgrepException, tgrep.tgrep_explain, 'NP',
+                          engine='nope')
+        self.assertRaises(tgrep.TgrepException, tgrep.tgrep_explain, '@D')
+
+    def test_matches(self):
+        '''
+        Test that matches carry the node labels bound by the search.
+        '''
+        tree = Tree.fromstring('(S (NP (DT the) (NN dog)) '
+                               '(VP (VBD saw) (NP (DT a) (NN cat))))')
+        matches = list(tgrep.tgrep_matches(
+            tree, 'S=s < /NP/=n : =s < /VP/=v'))
+        self.assertEqual(len(matches), 1)
+        match = matches[0]
+        self.assertEqual(match.position, ())
+        self.assertIs(match.node, tree)
+        self.assertEqual(match.label_positions,
+                         {'s': (), 'n': (0,), 'v': (1,)})
+        self.assertEqual(match.label_nodes,
+                         {'s': tree, 'n': tree[0], 'v': tree[1]})
+        # each match has its own bindings, also with the set engine
+        for engine in ['node', 'set']:
+            matches = list(tgrep.tgrep_matches(tree, 'NP=x < (DT=d < __)',
+                                               engine=engine))
+            self.assertEqual([m.position for m in matches], [(0,), (1, 1)])
+            self.assertEqual([m.label_positions for m in matches],
+                             [{'x': (0,), 'd': (0, 0)},
+                              {'x': (1, 1), 'd': (1, 1, 0)}])
+            matches = list(tgrep.tgrep_matches(tree, 'NP < DT',
+                                               engine=engine))
+            self.assertEqual([(m.position, m.label_positions)
+                              for m in matches], [((0,), {}), ((1, 1), {})])
+        # bound leaves have no known position
+        match = next(tgrep.tgrep_matches(tree, 'DT < the=w'))
+        self.assertEqual(match.label_positions, {'w': None})
+        self.assertEqual(match.label_nodes, {'w': 'the'})
+        # labels bound by an alternative which fails are not kept
+        tree = Tree.fromstring('(S (NP (NNP Kim)) (VP (VBD left)))')
+        matches = list(tgrep.tgrep_matches(tree, '__=n < DT ; NP'))
+        self.assertEqual([(m.position, m.label_nodes) for m in matches],
+                         [((0,), {})])
+        matches = list(tgrep.tgrep_matches(tree, 'NP=n < DT ; NP=m'))
+        self.assertEqual([m.label_positions for m in matches], [{'m': (0,)}])
+
+    def test_short_circuit(self):
+        '''
+        Test the searches which stop once their answer is known.
+        '''
+        tree = Tree.fromstring('(S (NP (DT the) (NN dog)) '
+                               '(VP (VBD saw) (NP (DT a) (NN cat))))')
+        for engine in ['node', 'set']:
+            self.assertTrue(tgrep.tgrep_exists(tree, 'NP < DT', engine=engine))
+            self.assertFalse(tgrep.tgrep_exists(tree, 'NP < JJ',
+                                                engine=engine))
+            self.assertEqual(tgrep.tgrep_first(tree, 'NP', engine=engine),
+                             (0,))
+            self.assertEqual(tgrep.tgrep_first(tree, 'S', engine=engine), ())
+            self.assertIsNone(tgrep.tgrep_first(tree, 'JJ', engine=engine))
+            self.assertEqual(tgrep.tgrep_count(tree, '__', engine=engine), 14)
+            self.assertEqual(tgrep.tgrep_count(tree, '__', False,
+                                               engine=engine), 9)
+            self.assertEqual(tgrep.tgrep_count(tree, 'NP', engine=engine,
+                                               limit=1), 1)
+            self.assertEqual(tgrep.tgrep_positions(tree, '/^N/', limit=2,
+                                                   engine=engine),
+                             [(0,), (0, 1)])
+            self.assertEqual(tgrep.tgrep_nodes(tree, 'NN', limit=0,
+                                               engine=engine), [])
+        self.assertFalse(tgrep.tgrep_exists('word', 'NP'))
+        self.assertIsNone(tgrep.tgrep_first('word', 'NP'))
+        self.assertEqual(tgrep.tgrep_count('word', 'NP'), 0)
+        # the node engine stops testing nodes at the first match
+        pattern = tgrep.tgrep_compile('/^N/')
+        tested = []
+        def predicate(n, m=None, l=None):
+            tested.append(n)
+            return pattern(n, m, l)
+        self.assertTrue(tgrep.tgrep_exists(tree, predicate))
+        self.assertEqual(tested, [tree, tree[0]])
+        del tested[:]
+        self.assertEqual(tgrep.tgrep_positions(tree, predicate, limit=2),
+                         [(0,), (0, 1)])
+        self.assertEqual(len(tested), 5)
+        # corpora
+        trees = [Tree.fromstring(s) for s in ['(S (NP x) (VP y))',
+                                              '(S (VP y))',
+                                              '(S (NP x) (NP z))']]
+        self.assertEqual(list(tgrep.filter_corpus(trees, 'NP')),
+                         [(0, trees[0]), (2, trees[2])])
+        self.assertEqual([(i, p) for i, p, _n in
+                          tgrep.search_corpus(trees, 'NP', limit=2)],
+                         [(0, (0,)), (2, (0,))])
+        self.assertEqual(list(tgrep.search_corpus(trees, 'NP', limit=0)), [])
+
+    def test_name_tests(self):
+        '''
+        Test the specialised tests on node names.
+        '''
+        names = ['NP', 'NP-SBJ', 'XNP', 'np', 'NP\n', 'VP', '']
+        expected = {
+            'NP|VP': ['NP', 'VP'],
+            '/^NP/': ['NP', 'NP-SBJ', 'NP\n'],
+            '/NP$/': ['NP', 'XNP', 'NP\n'],
+            '/^NP$/': ['NP', 'NP\n'],
+            '/NP/': ['NP', 'NP-SBJ', 'XNP', 'NP\n'],
+            '/^$/': [''],
+            '//': names,
+            '/^N.$/': ['NP', 'NP\n'],
+            'i@"np"': ['NP', 'np'],
+            'i@/^n/': ['NP', 'NP-SBJ', 'np', 'NP\n'],
+            'NP|/^V/|i@"xnp"': ['NP', 'XNP', 'VP'],
+            'XNP|__': names,
+        }
+        for search, matches in expected.items():
+            ast = tgrep.tgrep_compile(search).ast[2][0]
+            predicate = tgrep._tgrep_node_predicate(ast)
+            test = tgrep._tgrep_name_test(ast)
+            for _repeat in range(2):
+                self.assertEqual([x for x in names if predicate(x)], matches,
+                                 search)
+                self.assertEqual([x for x in names if predicate(Tree(x, []))],
+                                 matches, search)
+                self.assertEqual([x for x in names if test(x)], matches,
+                                 search)
+        # regular expressions are run once per distinct name
+        tested = []
+        def test(s):
+            tested.append(s)
+            return s.startswith('N')
+        cached = tgrep._tgrep_cached_test(test)
+        self.assertEqual([cached(x) for x in ['NP', 'VP', 'NP', 'NN', 'VP']],
+                         [True, False, True, True, False])
+        self.assertEqual(tested, ['NP', 'VP', 'NN'])
+
+    def test_native_parser(self):
+        '''
+        Test that the native parser builds the same tokens and patterns
+        as pyparsing, and rejects the same search strings.
+        '''
+        searches = ['@ NP /^NP/;\n@ NN /^NN/;\n@NP [!< NP | < @NN] !$.. @NN',
+                    'S < @SBJ=s < (@VP=v < (@VB $.. @OBJ)) : =s .. =v',
+                    '"A<<:B"<<:"A $.. B"<"A>3B"<C # comment',
+                    'N(0, 1 ,2,) | i@"np" | i@/^v/ < __',
+                    "'NP=x [< DT & !< JJ | $ *] ;; NN",
+                    'NP !<, DT <- /^N/ >>\' S $,, (VP <2 __) <<: NN',
+                    '* !> __ <1 * <-1 *', 'NP =x', 'N(0)', '(NP',
+                    'NP < DT |', '@ A B', '', 'S <<']
+        # also try every string in these tests, most of which are
+        # search strings
+        with io.open(os.path.splitext(__file__)[0] + '.py',
+                     encoding='utf-8') as source:
+            searches.extend(ast.literal_eval(token[1]) for token in
+                            tokenize.generate_tokens(source.readline)
+                            if token[0] == tokenize.STRING)
+        for search in searches:
+            results = []
+            for parser in ['pyparsing', 'native']:
+                try:
+                    results.append((tgrep.tgrep_tokenize(search, parser),
+                                    tgrep.tgrep_compile(search,
+                                                        parser=parser).ast))
+                except Exception as error:
+                    results.append((type(error), str(error)))
+            self.assertEqual(results[0], results[1], search)
+        cache = tgrep.TgrepPatternCache()
+        self.assertEqual(cache.compile('NP < DT', parser='native').ast,
+                         tgrep.tgrep_compile('NP < DT').ast)
+        self.assertRaises(pyparsing.ParseException, tgrep.tgrep_compile,
+                          'S <<', parser='native')
+        self.assertRaises(tgrep.TgrepException, tgrep.tgrep_compile, 'NP',
+                          parser='lex')
+        # the search functions compile search strings with the parser
+        tree = ParentedTree.fromstring('(S (NP (DT the) (NN dog)))')
+        self.assertEqual(tgrep.tgrep_positions(tree, 'NN $, DT',
+                                               parser='native'), [(0, 1)])
+        for search in [tgrep.tgrep_positions, tgrep.tgrep_nodes,
+                       tgrep.tgrep_count, tgrep.tgrep_exists]:
+            self.assertRaises(tgrep.TgrepException, search, tree,
+                              'DT $. NN', parser='lex')
+        self.assertRaises(tgrep.TgrepException, list, tgrep.tgrep_matches(
+            tree, 'DT $. NN', parser='lex'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -27,8 +27,9 @@ TGrep search implementation for NTLK trees.
 (c) 16 March, 2013 Will Roberts <wildwilhelm@gmail.com>.
 
 This module supports TGrep2 syntax for matching parts of NLTK Trees.
-Note that many tgrep operators require the tree passed to be a
-ParentedTree.
+Searches (`tgrep_positions`, etc.) work on any `nltk.tree.Tree`; note
+that when a predicate built by `tgrep_compile` is called directly on a
+node, many tgrep operators require the tree to be a ParentedTree.
 
 Tgrep tutorial:
 http://www.stanford.edu/dept/linguistics/corpora/cas-tut-tgrep.html
@@ -58,6 +59,26 @@ specified in a call to a predicate.  Predicates which call other
 predicates must always pass the value of these arguments on.  The
 top-level predicate (constructed by `_tgrep_exprs_action`) binds the
 macro definitions to `m` and initialises `l` to an empty dictionary.
+
+Search strings are first parsed into a small AST of nested tuples (see
+`_tgrep_predicate`), which `tgrep_compile` turns into these predicate
+functions.  The AST can also be evaluated directly, by a second,
+set-at-a-time search engine (see `_SetEvaluator`), which computes the
+set of matching nodes for every subpattern once per tree.
+
+When searching with `tgrep_positions`, the tree is first indexed by a
+`TreeIndex`, which is carried along in `l`; relation predicates use it
+to look up parents, ancestors, preceding nodes, etc. by integer
+arithmetic, so that a plain `nltk.tree.Tree` can be searched without
+first converting it to a `ParentedTree`.  Predicates called directly
+on a node, without an index, fall back on the methods of
+`ParentedTree`.  The index also maps node
+labels and words onto nodes, so that a search only visits the nodes
+which satisfy the head constraint of the pattern (e.g. ``NP`` in
+``NP < DT``).  `l` also carries a memo table, in which the results of
+the inner subpatterns of relations (e.g. ``NP < DT`` in
+``S << (NP < DT)``) are kept per node for the duration of a search,
+as long as they neither bind nor use node labels.
 '''
 
 from __future__ import print_function, unicode_literals
@@ -66,14 +87,15 @@ try:
 except ImportError:
     print('Warning: nltk_tgrep may not work correctly on Python 2.* without the')
     print('`future` package installed.')
+from collections import OrderedDict, namedtuple
+import contextlib
 import functools
-import nltk.tree
-try:
-    import pyparsing
-except ImportError:
-    print('Warning: nltk_tgrep will not work without the `pyparsing` package')
-    print('installed.')
+import itertools
+import operator
 import re
+import sys
+import threading
+import time
 
 class TgrepException(Exception):
     '''Tgrep exception type.'''
@@ -81,102 +103,154 @@ class TgrepException(Exception):
 
 def ancestors(node):
     '''
-    Returns the list of all nodes dominating the given tree node.
+    Yields all nodes dominating the given tree node, nearest first.
     This method will not work with leaf nodes, since there is no way
     to recover the parent.
     '''
-    results = []
     try:
         current = node.parent()
     except AttributeError:
         # if node is a leaf, we cannot retrieve its parent
-        return results
-    while current:
-        results.append(current)
+        return
+    while current is not None:
+        yield current
         current = current.parent()
-    return results
 
 def unique_ancestors(node):
     '''
-    Returns the list of all nodes dominating the given node, where
-    there is only a single path of descent.
+    Yields all nodes dominating the given node, where there is only a
+    single path of descent, nearest first.
     '''
-    results = []
     try:
         current = node.parent()
     except AttributeError:
         # if node is a leaf, we cannot retrieve its parent
-        return results
-    while current and len(current) == 1:
-        results.append(current)
+        return
+    while current is not None and len(current) == 1:
+        yield current
         current = current.parent()
-    return results
 
 def _descendants(node):
     '''
-    Returns the list of all nodes which are descended from the given
-    tree node in some way.
+    Yields all nodes which are descended from the given tree node in
+    some way, in preorder (depth first, not nearest first).
     '''
-    try:
-        treepos = node.treepositions()
-    except AttributeError:
-        return []
-    return [node[x] for x in treepos[1:]]
+    if not _istree(node):
+        return
+    # a stack of iterators over the children of the nodes on the path
+    # down to the current node
+    stack = [iter(node)]
+    while stack:
+        for child in stack[-1]:
+            yield child
+            if _istree(child):
+                stack.append(iter(child))
+            break
+        else:
+            stack.pop()
 
 def _leftmost_descendants(node):
     '''
-    Returns the set of all nodes descended in some way through
-    left branches from this node.
+    Yields all nodes descended in some way through left branches from
+    this node, nearest first.
+    '''
+    while _istree(node) and len(node):
+        node = node[0]
+        yield node
+
+def _rightmost_descendants(node):
+    '''
+    Yields all nodes descended in some way through right branches from
+    this node, nearest first.
+    '''
+    while _istree(node) and len(node):
+        node = node[-1]
+        yield node
+
+def _leftmost_ancestors(node):
+    '''
+    Yields all nodes of which the given node is a left-most
+    descendant, nearest first.
     '''
     try:
-        treepos = node.treepositions()
+        current = node.parent()
     except AttributeError:
-        return []
-    return [node[x] for x in treepos[1:] if all(y == 0 for y in x)]
+        return
+    # `node` stays a left-most descendant for as long as each step up
+    # is from a first child (`parent_index` compares by identity)
+    while current is not None and node.parent_index() == 0:
+        yield current
+        node = current
+        current = current.parent()
 
-def _rightmost_descendants(node):
+def _rightmost_ancestors(node):
     '''
-    Returns the set of all nodes descended in some way through
-    right branches from this node.
+    Yields all nodes of which the given node is a right-most
+    descendant, nearest first.
     '''
     try:
-        rightmost_leaf = max(node.treepositions())
+        current = node.parent()
     except AttributeError:
-        return []
-    return [node[rightmost_leaf[:i]] for i in range(1, len(rightmost_leaf) + 1)]
+        return
+    while current is not None and node.parent_index() == len(current) - 1:
+        yield current
+        node = current
+        current = current.parent()
+
+# `nltk.tree.Tree`, once NLTK has been imported (see `_istree`)
+_TREE_CLASS = None
 
 def _istree(obj):
     '''Predicate to check whether `obj` is a nltk.tree.Tree.'''
-    return isinstance(obj, nltk.tree.Tree)
+    if _TREE_CLASS is None:
+        return _find_tree_class() and isinstance(obj, _TREE_CLASS)
+    return isinstance(obj, _TREE_CLASS)
+
+def _find_tree_class():
+    '''
+    Looks up `nltk.tree.Tree` for `_istree`, and returns True if it has
+    been found.  NLTK is slow to import, and this module never needs
+    to import it: until something else has, no object can be a `Tree`.
+    '''
+    global _TREE_CLASS
+    module = sys.modules.get('nltk.tree')
+    _TREE_CLASS = getattr(module, 'Tree', None)
+    return _TREE_CLASS is not None
 
 def _unique_descendants(node):
     '''
-    Returns the list of all nodes descended from the given node, where
-    there is only a single path of descent.
+    Yields all nodes descended from the given node, where there is
+    only a single path of descent, nearest first.
     '''
-    results = []
-    current = node
-    while current and _istree(current) and len(current) == 1:
-        current = current[0]
-        results.append(current)
-    return results
+    while _istree(node) and len(node) == 1:
+        node = node[0]
+        yield node
 
 def _before(node):
     '''
-    Returns the set of all nodes that are before the given node.
+    Yields all nodes that are before the given node, in preorder,
+    starting from the root (so the furthest first).  This is the
+    order in which the nodes are tested, and so decides which node a
+    node label such as ``=x`` is bound to.
     '''
     try:
         pos = node.treeposition()
         tree = node.root()
     except AttributeError:
-        return []
-    return [tree[x] for x in tree.treepositions()
-            if x[:len(pos)] < pos[:len(x)]]
+        return
+    # the nodes before `node` are the left sisters of its ancestors
+    # (and of itself), with their descendants
+    for idx in pos:
+        for sister_idx in range(idx):
+            sister = tree[sister_idx]
+            yield sister
+            for descendant in _descendants(sister):
+                yield descendant
+        tree = tree[idx]
 
 def _immediately_before(node):
     '''
-    Returns the set of all nodes that are immediately before the given
-    node.
+    Yields all nodes that are immediately before the given node.
 
     Tree node A immediately precedes node B if the last terminal
     symbol (word) produced by A immediately precedes the first
@@ -186,34 +260,42 @@ def _immediately_before(node):
         pos = node.treeposition()
         tree = node.root()
     except AttributeError:
-        return []
+        return
     # go "upwards" from pos until there is a place we can go to the left
     idx = len(pos) - 1
     while 0 <= idx and pos[idx] == 0:
         idx -= 1
     if idx < 0:
-        return []
+        return
     pos = list(pos[:idx + 1])
     pos[-1] -= 1
     before = tree[pos]
-    return [before] + _rightmost_descendants(before)
+    yield before
+    for descendant in _rightmost_descendants(before):
+        yield descendant
 
 def _after(node):
     '''
-    Returns the set of all nodes that are after the given node.
+    Yields all nodes that are after the given node, in preorder.
     '''
     try:
-        pos = node.treeposition()
-        tree = node.root()
+        current = node.parent()
     except AttributeError:
-        return []
-    return [tree[x] for x in tree.treepositions()
-            if x[:len(pos)] > pos[:len(x)]]
+        return
+    # the nodes after `node` are the right sisters of itself and of
+    # its ancestors, with their descendants
+    while current is not None:
+        for sister_idx in range(node.parent_index() + 1, len(current)):
+            sister = current[sister_idx]
+            yield sister
+            for descendant in _descendants(sister):
+                yield descendant
+        node = current
+        current = current.parent()
 
 def _immediately_after(node):
     '''
-    Returns the set of all nodes that are immediately after the given
-    node.
+    Yields all nodes that are immediately after the given node.
 
     Tree node A immediately follows node B if the first terminal
     symbol (word) produced by A immediately follows the last
@@ -224,7 +306,7 @@ def _immediately_after(node):
         tree = node.root()
         current = node.parent()
     except AttributeError:
-        return []
+        return
     # go "upwards" from pos until there is a place we can go to the
     # right
     idx = len(pos) - 1
@@ -232,35 +314,543 @@ def _immediately_after(node):
         idx -= 1
         current = current.parent()
     if idx < 0:
-        return []
+        return
     pos = list(pos[:idx + 1])
     pos[-1] += 1
     after = tree[pos]
-    return [after] + _leftmost_descendants(after)
+    yield after
+    for descendant in _leftmost_descendants(after):
+        yield descendant
+
+class TreeIndex(object):
+    '''
+    A structural index over a tree, built in a single preorder
+    traversal.
+
+    Every position in the tree (including leaves) is numbered by its
+    preorder id, so that `nodes[i]` is the `i`th node visited by
+    `tree.treepositions()`.  For each id `i`, the index records:
+
+    - `end_id[i]`: the id of the last node in the subtree rooted at `i`
+    - `parent_id[i]`: the id of the parent node (-1 for the root)
+    - `depth[i]`: the length of the node's tree position
+    - `child_rank[i]`: the index of the node in its parent
+    - `first_leaf[i]`, `last_leaf[i]`: the offsets of the first and
+      last leaves (words) produced by the node
+
+    With this, dominance, precedence and sisterhood become integer
+    comparisons: `i` dominates `j` iff `i < j <= end_id[i]`; `i`
+    precedes `j` iff `end_id[i] < j`; and `i` and `j` are sisters iff
+    they are distinct and have the same parent id.
+
+    Tree nodes are looked up by object identity.  Leaves are bare
+    strings, which cannot be told apart in this way, and so (as with
+    `ParentedTree`) relations looking upwards or sideways from a leaf
+    never hold.
+
+    A `TreeIndex` also provides the same structural queries on nodes
+    (`parent`, `ancestors`, `after`, etc.) that the relation
+    predicates use with `ParentedTree` objects, so that the tree
+    indexed may be a plain `nltk.tree.Tree`.  (A subtree object which
+    occurs more than once in a plain `Tree` is only found at its last
+    occurrence.)
+    '''
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.nodes = nodes = []
+        self.parent_id = parent_id = []
+        self.depth = depth = []
+        self.child_rank = child_rank = []
+        self.first_leaf = first_leaf = []
+        self._ids = ids = {}
+        num_leaves = 0
+        stack = [(tree, -1, 0, 0)]
+        while stack:
+            node, parent, node_depth, rank = stack.pop()
+            node_id = len(nodes)
+            nodes.append(node)
+            parent_id.append(parent)
+            depth.append(node_depth)
+            child_rank.append(rank)
+            first_leaf.append(num_leaves)
+            if _istree(node):
+                ids[id(node)] = node_id
+                # push the children in reverse, so that they are
+                # visited left to right
+                stack.extend((node[k], node_id, node_depth + 1, k)
+                             for k in range(len(node) - 1, -1, -1))
+            else:
+                num_leaves += 1
+        # children have higher ids than their parents, so a reverse
+        # sweep sees every subtree end before its parent's
+        self.end_id = end_id = list(range(len(nodes)))
+        for node_id in range(len(nodes) - 1, 0, -1):
+            parent = parent_id[node_id]
+            if end_id[parent] < end_id[node_id]:
+                end_id[parent] = end_id[node_id]
+        self.last_leaf = [first_leaf[end] - (1 if _istree(nodes[end]) else 0)
+                          for end in end_id]
+        # the label and word indices are built on demand
+        self._label_ids = self._word_ids = False
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node_id(self, node):
+        '''
+        Returns the preorder id of the given tree node, or None if
+        `node` is a leaf or is not part of the indexed tree.
+        '''
+        return self._ids.get(id(node))
+
+    def treeposition(self, node_id):
+        '''Returns the tree position of the node with the given id.'''
+        position = []
+        while node_id > 0:
+            position.append(self.child_rank[node_id])
+            node_id = self.parent_id[node_id]
+        return tuple(reversed(position))
+
+    def position_id(self, position):
+        '''
+        Returns the id of the node at the given tree position, or None
+        if there is no node there.
+        '''
+        node_id = 0
+        end_id = self.end_id
+        for rank in position:
+            if rank >= self.num_children(node_id):
+                return None
+            # skip over the subtrees of the left sisters
+            node_id += 1
+            for _ in range(rank):
+                node_id = end_id[node_id] + 1
+        return node_id
+
+    def _index_labels(self):
+        '''Builds the inverted indices `label_ids` and `word_ids`.'''
+        label_ids = {}
+        word_ids = {}
+        try:
+            for node_id, node in enumerate(self.nodes):
+                if _istree(node):
+                    label_ids.setdefault(node.label(), []).append(node_id)
+                else:
+                    word_ids.setdefault(str(node), []).append(node_id)
+        except TypeError:
+            # node labels which are not hashable cannot be indexed
+            label_ids = word_ids = None
+        self._label_ids = label_ids
+        self._word_ids = word_ids
+
+    @property
+    def label_ids(self):
+        '''
+        A dictionary mapping each node label in the tree onto the ids of
+        the tree nodes with that label, in preorder; or None, if the
+        tree has node labels which cannot be indexed.
+        '''
+        if self._label_ids is False:
+            self._index_labels()
+        return self._label_ids
+
+    @property
+    def word_ids(self):
+        '''
+        A dictionary mapping each word in the tree onto the ids of the
+        leaves with that word, in preorder; or None (see `label_ids`).
+        '''
+        if self._word_ids is False:
+            self._index_labels()
+        return self._word_ids
+
+    def ids_with_values(self, values):
+        '''
+        Returns the sorted ids of all nodes whose label (or, for leaves,
+        whose word) is one of the given `values`.
+        '''
+        ids = []
+        for value in values:
+            ids.extend(self.label_ids.get(value, ()))
+            ids.extend(self.word_ids.get(value, ()))
+        ids.sort()
+        return ids
+
+    def ids_matching(self, predicate):
+        '''
+        Returns the sorted ids of all nodes satisfying `predicate`, a
+        test on node names, which is called only once for each distinct
+        label and word in the tree.
+        '''
+        ids = []
+        for table in (self.label_ids, self.word_ids):
+            for value_ids in table.values():
+                if predicate(self.nodes[value_ids[0]]):
+                    ids.extend(value_ids)
+        ids.sort()
+        return ids
+
+    def children_ids(self, node_id):
+        '''Yields the ids of the children of the given node, in order.'''
+        end = self.end_id[node_id]
+        child = node_id + 1
+        while child <= end:
+            yield child
+            child = self.end_id[child] + 1
+
+    def is_leaf(self, node_id):
+        '''
+        Returns True if the node with the given id dominates no other
+        node (see `treepositions_no_leaves`).
+        '''
+        return self.end_id[node_id] == node_id
+
+    def is_tree(self, node_id):
+        '''Returns True if the node with the given id is a Tree.'''
+        return _istree(self.nodes[node_id])
+
+    def num_children(self, node_id):
+        '''Returns the number of children of the node with the given id.'''
+        node = self.nodes[node_id]
+        return len(node) if _istree(node) else 0
+
+    def dominates(self, i, j):
+        '''Returns True if node `i` is a proper ancestor of node `j`.'''
+        return i < j <= self.end_id[i]
+
+    def precedes(self, i, j):
+        '''Returns True if node `i` precedes node `j`.'''
+        return self.end_id[i] < j
+
+    def is_sister(self, i, j):
+        '''Returns True if nodes `i` and `j` are distinct sisters.'''
+        return i != j and self.parent_id[i] == self.parent_id[j]
+
+    # structural queries on nodes, mirroring `_ParentedTreeNavigator`
+
+    def parent(self, node):
+        '''Returns the parent of `node`, or None.'''
+        node_id = self._ids.get(id(node))
+        if not node_id:
+            return None
+        return self.nodes[self.parent_id[node_id]]
+
+    def parent_index(self, node):
+        '''Returns the index of `node` in its parent, or None.'''
+        node_id = self._ids.get(id(node))
+        if not node_id:
+            return None
+        return self.child_rank[node_id]
+
+    def node_treeposition(self, node):
+        '''Returns the tree position of `node`, or None.'''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return None
+        return self.treeposition(node_id)
+
+    def ancestors(self, node):
+        '''Yields all nodes dominating `node`, nearest first.'''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, parent_id = self.nodes, self.parent_id
+        node_id = parent_id[node_id]
+        while node_id >= 0:
+            yield nodes[node_id]
+            node_id = parent_id[node_id]
+
+    def unique_ancestors(self, node):
+        '''
+        Yields the nodes dominating `node` along a single path of
+        descent, nearest first.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, parent_id = self.nodes, self.parent_id
+        node_id = parent_id[node_id]
+        while node_id >= 0 and len(nodes[node_id]) == 1:
+            yield nodes[node_id]
+            node_id = parent_id[node_id]
+
+    def descendants(self, node):
+        '''
+        Yields all nodes dominated by `node`, in preorder (depth
+        first, not nearest first).
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes = self.nodes
+        for descendant_id in range(node_id + 1, self.end_id[node_id] + 1):
+            yield nodes[descendant_id]
+
+    def leftmost_descendants(self, node):
+        '''Yields the nodes on the leftmost path down from `node`.'''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, end_id = self.nodes, self.end_id
+        # the first child of a node always has the following id
+        while end_id[node_id] > node_id:
+            node_id += 1
+            yield nodes[node_id]
+
+    def rightmost_descendants(self, node):
+        '''Yields the nodes on the rightmost path down from `node`.'''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return iter(())
+        return self._path_down(node_id, self.end_id[node_id])
+
+    def _path_down(self, top_id, bottom_id):
+        '''
+        Returns an iterator over the nodes on the path from `top_id`
+        (exclusive) down to `bottom_id` (inclusive), top first.
+        '''
+        path = []
+        parent_id = self.parent_id
+        while bottom_id != top_id:
+            path.append(bottom_id)
+            bottom_id = parent_id[bottom_id]
+        nodes = self.nodes
+        return (nodes[node_id] for node_id in reversed(path))
+
+    @staticmethod
+    def unique_descendants(node):
+        '''
+        Yields the nodes dominated by `node` along a single path of
+        descent.
+        '''
+        return _unique_descendants(node)
+
+    def before(self, node):
+        '''
+        Yields all nodes preceding `node`, in preorder, starting from
+        the root (so the furthest first); see `_before`.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, end_id = self.nodes, self.end_id
+        for before_id in range(node_id):
+            # skip the ancestors of `node`
+            if end_id[before_id] < node_id:
+                yield nodes[before_id]
+
+    def after(self, node):
+        '''Yields all nodes following `node`, in preorder.'''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes = self.nodes
+        for after_id in range(self.end_id[node_id] + 1, len(nodes)):
+            yield nodes[after_id]
+
+    def immediately_before(self, node):
+        '''
+        Yields the nodes whose last leaf immediately precedes the first
+        leaf of `node`; see `_immediately_before`.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return iter(())
+        # go upwards until there is a place we can go to the left
+        while node_id > 0 and self.child_rank[node_id] == 0:
+            node_id = self.parent_id[node_id]
+        if node_id <= 0:
+            return iter(())
+        # the node just before `node_id` in preorder is the bottom of
+        # the rightmost path down from its left sister
+        parent = self.parent_id[node_id]
+        return self._path_down(parent, node_id - 1)
+
+    def immediately_after(self, node):
+        '''
+        Yields the nodes whose first leaf immediately follows the last
+        leaf of `node`; see `_immediately_after`.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        # the node just after the subtree in preorder is the right
+        # sister of the nearest ancestor(-or-self) which has one
+        after_id = self.end_id[node_id] + 1
+        if after_id >= len(self.nodes):
+            return
+        after = self.nodes[after_id]
+        yield after
+        for descendant in self.leftmost_descendants(after):
+            yield descendant
+
+    def leftmost_ancestors(self, node):
+        '''
+        Yields the nodes of which `node` is a left-most descendant,
+        nearest first.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, parent_id, child_rank = (self.nodes, self.parent_id,
+                                        self.child_rank)
+        while node_id > 0 and child_rank[node_id] == 0:
+            node_id = parent_id[node_id]
+            yield nodes[node_id]
+
+    def rightmost_ancestors(self, node):
+        '''
+        Yields the nodes of which `node` is a right-most descendant,
+        nearest first.
+        '''
+        node_id = self._ids.get(id(node))
+        if node_id is None:
+            return
+        nodes, parent_id, end_id = self.nodes, self.parent_id, self.end_id
+        # a right-most descendant ends its ancestor's subtree
+        while node_id > 0 and end_id[parent_id[node_id]] == end_id[node_id]:
+            node_id = parent_id[node_id]
+            yield nodes[node_id]
+
+    def is_leftmost_descendant(self, node, ancestor):
+        '''
+        Returns True if `node` is a left-most descendant of `ancestor`.
+        '''
+        i = self._ids.get(id(ancestor))
+        j = self._ids.get(id(node))
+        # stepping down to a first child always adds one to the
+        # preorder id; stepping to any other child adds more
+        return (i is not None and j is not None and
+                self.dominates(i, j) and
+                j - i == self.depth[j] - self.depth[i])
+
+    def is_rightmost_descendant(self, node, ancestor):
+        '''
+        Returns True if `node` is a right-most descendant of
+        `ancestor`.
+        '''
+        i = self._ids.get(id(ancestor))
+        j = self._ids.get(id(node))
+        return (i is not None and j is not None and
+                self.dominates(i, j) and
+                self.end_id[i] == self.end_id[j])
+
+class _ParentedTreeNavigator(object):
+    '''
+    Answers the structural queries of a `TreeIndex` using the methods
+    of `nltk.tree.ParentedTree`.  This is used when a predicate is
+    called directly on a node, without a `TreeIndex`.
+    '''
+
+    @staticmethod
+    def parent(node):
+        '''Returns the parent of `node`, or None.'''
+        try:
+            return node.parent()
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def parent_index(node):
+        '''Returns the index of `node` in its parent, or None.'''
+        try:
+            return node.parent_index()
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def node_treeposition(node):
+        '''Returns the tree position of `node`, or None.'''
+        try:
+            return node.treeposition()
+        except AttributeError:
+            return None
+
+    ancestors = staticmethod(ancestors)
+    unique_ancestors = staticmethod(unique_ancestors)
+    descendants = staticmethod(_descendants)
+    leftmost_descendants = staticmethod(_leftmost_descendants)
+    rightmost_descendants = staticmethod(_rightmost_descendants)
+    unique_descendants = staticmethod(_unique_descendants)
+    before = staticmethod(_before)
+    after = staticmethod(_after)
+    immediately_before = staticmethod(_immediately_before)
+    immediately_after = staticmethod(_immediately_after)
+
+    leftmost_ancestors = staticmethod(_leftmost_ancestors)
+    rightmost_ancestors = staticmethod(_rightmost_ancestors)
+
+    @staticmethod
+    def is_leftmost_descendant(node, ancestor):
+        '''
+        Returns True if `node` is a left-most descendant of `ancestor`.
+        '''
+        return any(x is ancestor for x in _leftmost_ancestors(node))
+
+    @staticmethod
+    def is_rightmost_descendant(node, ancestor):
+        '''
+        Returns True if `node` is a right-most descendant of
+        `ancestor`.
+        '''
+        return any(x is ancestor for x in _rightmost_ancestors(node))
+
+_PARENTED_TREE_NAVIGATOR = _ParentedTreeNavigator()
+
+class _LabelDict(dict):
+    '''
+    The dictionary `l` passed to predicates, mapping node labels onto
+    nodes in the tree.  During a search, it also carries the
+    `TreeIndex` of the tree being searched, and the table of memoized
+    subpattern results (see `_tgrep_memoized_predicate`), or None if
+    memoization is disabled.  When the top-level predicate of a
+    pattern matches a node, it stores the labels bound by the match in
+    `bindings` (see `tgrep_matches`).
+    '''
+    __slots__ = ('index', 'memo', 'bindings')
+
+    def __init__(self, index=None, memo=None):
+        super(_LabelDict, self).__init__()
+        self.index = index
+        self.memo = memo
+        self.bindings = None
+
+def _navigator(l):
+    '''
+    Returns the object which answers structural queries for the
+    predicates: the `TreeIndex` carried by the label dictionary `l`
+    if there is one, or the `ParentedTree` methods otherwise.
+    '''
+    index = getattr(l, 'index', None)
+    return _PARENTED_TREE_NAVIGATOR if index is None else index
 
 def _tgrep_node_literal_value(node):
     '''
     Gets the string value of a given parse tree node, for comparison
     using the tgrep node literal predicates.
     '''
-    return (node.label() if _istree(node) else str(node))
+    # `_istree`, inlined: this is called for every node tested.  Node
+    # names are not interned into per-tree integer ids: looking a
+    # node's id up by `id(node)` costs more than `node.label()` and a
+    # string comparison, and memoization (see
+    # `_tgrep_memoized_predicate`) already keeps most nodes from being
+    # tested more than a few times per search
+    if _TREE_CLASS is None and not _find_tree_class():
+        return str(node)
+    return (node.label() if isinstance(node, _TREE_CLASS) else str(node))
 
 def _tgrep_macro_use_action(_s, _l, tokens):
     '''
-    Builds a lambda function which looks up the macro name used.
+    Builds an AST node which looks up the macro name used.
     '''
     assert len(tokens) == 1
     assert tokens[0][0] == '@'
-    macro_name = tokens[0][1:]
-    def macro_use(n, m=None, l=None):
-        if m is None or macro_name not in m:
-            raise TgrepException('macro {0} not defined'.format(macro_name))
-        return m[macro_name](n, m, l)
-    return macro_use
+    return ('macro', tokens[0][1:])
 
 def _tgrep_node_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
+    Builds an AST node representing a predicate on a tree node
     depending on the name of its node.
     '''
     # print 'node tokens: ', tokens
@@ -271,38 +861,31 @@ def _tgrep_node_action(_s, _l, tokens):
         # disjunctive definition of a node name
         assert list(set(tokens[1::2])) == ['|']
         # recursively call self to interpret each node name definition
-        tokens = [_tgrep_node_action(None, None, [node])
-                  for node in tokens[::2]]
-        # capture tokens and return the disjunction
-        return (lambda t: lambda n, m=None, l=None: any(f(n, m, l) for f in t))(tokens)
+        return ('node_or', tuple(_tgrep_node_action(None, None, [node])
+                                 for node in tokens[::2]))
     else:
-        if hasattr(tokens[0], '__call__'):
+        if isinstance(tokens[0], tuple):
             # this is a previously interpreted parenthetical node
-            # definition (lambda function)
+            # definition (AST node)
             return tokens[0]
         elif tokens[0] == '*' or tokens[0] == '__':
-            return lambda n, m=None, l=None: True
+            return ('any',)
         elif tokens[0].startswith('"'):
             assert tokens[0].endswith('"')
             node_lit = tokens[0][1:-1].replace('\\"', '"').replace('\\\\', '\\')
-            return (lambda s: lambda n, m=None, l=None: _tgrep_node_literal_value(n) == s)(node_lit)
+            return ('literal', node_lit)
         elif tokens[0].startswith('/'):
             assert tokens[0].endswith('/')
-            node_lit = tokens[0][1:-1]
-            return (lambda r: lambda n, m=None, l=None:
-                    r.search(_tgrep_node_literal_value(n)))(re.compile(node_lit))
+            return ('regex', tokens[0][1:-1])
         elif tokens[0].startswith('i@'):
-            node_func = _tgrep_node_action(_s, _l, [tokens[0][2:].lower()])
-            return (lambda f: lambda n, m=None, l=None:
-                    f(_tgrep_node_literal_value(n).lower()))(node_func)
+            return ('icase', _tgrep_node_action(_s, _l, [tokens[0][2:].lower()]))
         else:
-            return (lambda s: lambda n, m=None, l=None:
-                    _tgrep_node_literal_value(n) == s)(tokens[0])
+            return ('literal', tokens[0])
 
 def _tgrep_parens_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    from a parenthetical notation.
+    Builds an AST node representing a predicate on a tree node from a
+    parenthetical notation.
     '''
     # print 'parenthetical tokens: ', tokens
     assert len(tokens) == 3
@@ -312,19 +895,15 @@ def _tgrep_parens_action(_s, _l, tokens):
 
 def _tgrep_nltk_tree_pos_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    which returns true if the node is located at a specific tree
-    position.
+    Builds an AST node representing a predicate on a tree node which
+    returns true if the node is located at a specific tree position.
     '''
     # recover the tuple from the parsed sting
-    node_tree_position = tuple(int(x) for x in tokens if x.isdigit())
-    # capture the node's tree position
-    return (lambda i: lambda n, m=None, l=None: (hasattr(n, 'treeposition') and
-                                                 n.treeposition() == i))(node_tree_position)
+    return ('treepos', tuple(int(x) for x in tokens if x.isdigit()))
 
 def _tgrep_relation_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
+    Builds an AST node representing a predicate on a tree node
     depending on its relation to other nodes in the tree.
     '''
     # print 'relation tokens: ', tokens
@@ -342,176 +921,33 @@ def _tgrep_relation_action(_s, _l, tokens):
         # process operator-node relation expressions
         assert len(tokens) == 2
         operator, predicate = tokens
-        # A < B       A is the parent of (immediately dominates) B.
-        if operator == '<':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                any(predicate(x, m, l) for x in n))
-        # A > B       A is the child of B.
-        elif operator == '>':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                bool(n.parent()) and
-                                                predicate(n.parent(), m, l))
-        # A <, B      Synonymous with A <1 B.
-        elif operator == '<,' or operator == '<1':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                bool(list(n)) and
-                                                predicate(n[0], m, l))
-        # A >, B      Synonymous with A >1 B.
-        elif operator == '>,' or operator == '>1':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                bool(n.parent()) and
-                                                (n is n.parent()[0]) and
-                                                predicate(n.parent(), m, l))
-        # A <N B      B is the Nth child of A (the first child is <1).
-        elif operator[0] == '<' and operator[1:].isdigit():
-            idx = int(operator[1:])
-            # capture the index parameter
-            retval = (lambda i: lambda n, m=None, l=None: (_istree(n) and
-                                                           bool(list(n)) and
-                                                           0 <= i < len(n) and
-                                                           predicate(n[i], m, l)))(idx - 1)
-        # A >N B      A is the Nth child of B (the first child is >1).
-        elif operator[0] == '>' and operator[1:].isdigit():
-            idx = int(operator[1:])
-            # capture the index parameter
-            retval = (lambda i: lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                           bool(n.parent()) and
-                                                           0 <= i < len(n.parent()) and
-                                                           (n is n.parent()[i]) and
-                                                           predicate(n.parent(), m, l)))(idx - 1)
-        # A <' B      B is the last child of A (also synonymous with A <-1 B).
-        # A <- B      B is the last child of A (synonymous with A <-1 B).
-        elif operator == '<\'' or operator == '<-' or operator == '<-1':
-            retval = lambda n, m=None, l=None: (_istree(n) and bool(list(n))
-                                                and predicate(n[-1], m, l))
-        # A >' B      A is the last child of B (also synonymous with A >-1 B).
-        # A >- B      A is the last child of B (synonymous with A >-1 B).
-        elif operator == '>\'' or operator == '>-' or operator == '>-1':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                bool(n.parent()) and
-                                                (n is n.parent()[-1]) and
-                                                predicate(n.parent(), m, l))
-        # A <-N B 	  B is the N th-to-last child of A (the last child is <-1).
-        elif operator[:2] == '<-' and operator[2:].isdigit():
-            idx = -int(operator[2:])
-            # capture the index parameter
-            retval = (lambda i: lambda n, m=None, l=None: (_istree(n) and
-                                                           bool(list(n)) and
-                                                           0 <= (i + len(n)) < len(n) and
-                                                           predicate(n[i + len(n)], m, l)))(idx)
-        # A >-N B 	  A is the N th-to-last child of B (the last child is >-1).
-        elif operator[:2] == '>-' and operator[2:].isdigit():
-            idx = -int(operator[2:])
-            # capture the index parameter
-            retval = (lambda i: lambda n, m=None, l=None:
-                          (hasattr(n, 'parent') and
-                           bool(n.parent()) and
-                           0 <= (i + len(n.parent())) < len(n.parent()) and
-                           (n is n.parent()[i + len(n.parent())]) and
-                           predicate(n.parent(), m, l)))(idx)
-        # A <: B      B is the only child of A
-        elif operator == '<:':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                len(n) == 1 and
-                                                predicate(n[0], m, l))
-        # A >: B      A is the only child of B.
-        elif operator == '>:':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                bool(n.parent()) and
-                                                len(n.parent()) == 1 and
-                                                predicate(n.parent(), m, l))
-        # A << B      A dominates B (A is an ancestor of B).
-        elif operator == '<<':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                any(predicate(x, m, l) for x in _descendants(n)))
-        # A >> B      A is dominated by B (A is a descendant of B).
-        elif operator == '>>':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in ancestors(n))
-        # A <<, B     B is a left-most descendant of A.
-        elif operator == '<<,' or operator == '<<1':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                any(predicate(x, m, l)
-                                                    for x in _leftmost_descendants(n)))
-        # A >>, B     A is a left-most descendant of B.
-        elif operator == '>>,':
-            retval = lambda n, m=None, l=None: any((predicate(x, m, l) and
-                                                    n in _leftmost_descendants(x))
-                                                   for x in ancestors(n))
-        # A <<' B     B is a right-most descendant of A.
-        elif operator == '<<\'':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                any(predicate(x, m, l)
-                                                    for x in _rightmost_descendants(n)))
-        # A >>' B     A is a right-most descendant of B.
-        elif operator == '>>\'':
-            retval = lambda n, m=None, l=None: any((predicate(x, m, l) and
-                                                    n in _rightmost_descendants(x))
-                                                   for x in ancestors(n))
-        # A <<: B     There is a single path of descent from A and B is on it.
-        elif operator == '<<:':
-            retval = lambda n, m=None, l=None: (_istree(n) and
-                                                any(predicate(x, m, l)
-                                                    for x in _unique_descendants(n)))
-        # A >>: B     There is a single path of descent from B and A is on it.
-        elif operator == '>>:':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in unique_ancestors(n))
-        # A . B       A immediately precedes B.
-        elif operator == '.':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l)
-                                                   for x in _immediately_after(n))
-        # A , B       A immediately follows B.
-        elif operator == ',':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l)
-                                                   for x in _immediately_before(n))
-        # A .. B      A precedes B.
-        elif operator == '..':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in _after(n))
-        # A ,, B      A follows B.
-        elif operator == ',,':
-            retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in _before(n))
-        # A $ B       A is a sister of B (and A != B).
-        elif operator == '$' or operator == '%':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                bool(n.parent()) and
-                                                any(predicate(x, m, l)
-                                                    for x in n.parent() if x is not n))
-        # A $. B      A is a sister of and immediately precedes B.
-        elif operator == '$.' or operator == '%.':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'right_sibling') and
-                                                bool(n.right_sibling()) and
-                                                predicate(n.right_sibling(), m, l))
-        # A $, B      A is a sister of and immediately follows B.
-        elif operator == '$,' or operator == '%,':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'left_sibling') and
-                                                bool(n.left_sibling()) and
-                                                predicate(n.left_sibling(), m, l))
-        # A $.. B     A is a sister of and precedes B.
-        elif operator == '$..' or operator == '%..':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                hasattr(n, 'parent_index') and
-                                                bool(n.parent()) and
-                                                any(predicate(x, m, l) for x in
-                                                    n.parent()[n.parent_index() + 1:]))
-        # A $,, B     A is a sister of and follows B.
-        elif operator == '$,,' or operator == '%,,':
-            retval = lambda n, m=None, l=None: (hasattr(n, 'parent') and
-                                                hasattr(n, 'parent_index') and
-                                                bool(n.parent()) and
-                                                any(predicate(x, m, l) for x in
-                                                    n.parent()[:n.parent_index()]))
-        else:
-            raise TgrepException(
-                'cannot interpret tgrep operator "{0}"'.format(operator))
-    # now return the built function
+        retval = ('rel', operator, predicate)
+    # now return the built AST node
     if negated:
-        return (lambda r: (lambda n, m=None, l=None: not r(n, m, l)))(retval)
+        return ('not', retval)
     else:
         return retval
 
+def _tgrep_flatten(kind, tokens):
+    '''
+    Builds an AST node of the given kind ('and' or 'or') from the
+    given list of AST nodes, merging in any child nodes of the same
+    kind.  A single node is returned unchanged.
+    '''
+    if len(tokens) == 1:
+        return tokens[0]
+    children = []
+    for token in tokens:
+        if token[0] == kind:
+            children.extend(token[1])
+        else:
+            children.append(token)
+    return (kind, tuple(children))
+
 def _tgrep_conjunction_action(_s, _l, tokens, join_char = '&'):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    from the conjunction of several other such lambda functions.
+    Builds an AST node representing a predicate on a tree node from
+    the conjunction of several other such AST nodes.
 
     This is prototypically called for expressions like
     (`tgrep_rel_conjunction`)::
@@ -534,15 +970,11 @@ def _tgrep_conjunction_action(_s, _l, tokens, join_char = '&'):
     # filter out the ampersand
     tokens = [x for x in tokens if x != join_char]
     # print 'relation conjunction tokens: ', tokens
-    if len(tokens) == 1:
-        return tokens[0]
-    else:
-        return (lambda ts: lambda n, m=None, l=None: all(predicate(n, m, l)
-                                                         for predicate in ts))(tokens)
+    return _tgrep_flatten('and', tokens)
 
 def _tgrep_segmented_pattern_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a segmented pattern.
+    Builds an AST node representing a segmented pattern.
 
     Called for expressions like (`tgrep_expr_labeled`)::
 
@@ -564,21 +996,10 @@ def _tgrep_segmented_pattern_action(_s, _l, tokens):
     `_tgrep_node_label_use_action` and
     `_tgrep_node_label_pred_use_action`.
     '''
-    # tokens[0] is a string containing the node label
-    node_label = tokens[0]
-    # tokens[1:] is an (optional) list of predicates which must all
-    # hold of the bound node
-    reln_preds = tokens[1:]
-    def pattern_segment_pred(n, m=None, l=None):
-        '''This predicate function ignores its node argument.'''
-        # look up the bound node using its label
-        if l is None or node_label not in l:
-            raise TgrepException('node_label ={0} not bound in pattern'.format(
-                node_label))
-        node = l[node_label]
-        # match the relation predicates against the node
-        return all(pred(node, m, l) for pred in reln_preds)
-    return pattern_segment_pred
+    # tokens[0] is a string containing the node label; tokens[1:] is
+    # an (optional) list of predicates which must all hold of the
+    # bound node
+    return ('segment', tokens[0], tuple(tokens[1:]))
 
 def _tgrep_node_label_use_action(_s, _l, tokens):
     '''
@@ -600,8 +1021,8 @@ def _tgrep_node_label_use_action(_s, _l, tokens):
 
 def _tgrep_node_label_pred_use_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    which describes the use of a previously bound node label.
+    Builds an AST node representing a predicate on a tree node which
+    describes the use of a previously bound node label.
 
     Called for expressions like (`tgrep_node_label_use_pred`)::
 
@@ -614,21 +1035,12 @@ def _tgrep_node_label_pred_use_action(_s, _l, tokens):
     '''
     assert len(tokens) == 1
     assert tokens[0].startswith('=')
-    node_label = tokens[0][1:]
-    def node_label_use_pred(n, m=None, l=None):
-        # look up the bound node using its label
-        if l is None or node_label not in l:
-            raise TgrepException('node_label ={0} not bound in pattern'.format(
-                node_label))
-        node = l[node_label]
-        # truth means the given node is this node
-        return n is node
-    return node_label_use_pred
+    return ('label_use', tokens[0][1:])
 
 def _tgrep_bind_node_label_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    which can optionally bind a matching node into the tgrep2 string's
+    Builds an AST node representing a predicate on a tree node which
+    can optionally bind a matching node into the tgrep2 string's
     label_dict.
 
     Called for expressions like (`tgrep_node_expr2`)::
@@ -644,34 +1056,19 @@ def _tgrep_bind_node_label_action(_s, _l, tokens):
         # a tgrep_node_label, a string value containing the node label
         assert len(tokens) == 3
         assert tokens[1] == '='
-        node_pred = tokens[0]
-        node_label = tokens[2]
-        def node_label_bind_pred(n, m=None, l=None):
-            if node_pred(n, m, l):
-                # bind `n` into the dictionary `l`
-                if l is None:
-                    raise TgrepException(
-                        'cannot bind node_label {0}: label_dict is None'.format(
-                            node_label))
-                l[node_label] = n
-                return True
-            else:
-                return False
-        return node_label_bind_pred
+        # plain node names have not been interpreted yet
+        return ('bind', _tgrep_node_action(None, None, [tokens[0]]),
+                tokens[2])
 
 def _tgrep_rel_disjunction_action(_s, _l, tokens):
     '''
-    Builds a lambda function representing a predicate on a tree node
-    from the disjunction of several other such lambda functions.
+    Builds an AST node representing a predicate on a tree node from
+    the disjunction of several other such AST nodes.
     '''
     # filter out the pipe
     tokens = [x for x in tokens if x != '|']
     # print 'relation disjunction tokens: ', tokens
-    if len(tokens) == 1:
-        return tokens[0]
-    elif len(tokens) == 2:
-        return (lambda a, b: lambda n, m=None, l=None:
-                a(n, m, l) or b(n, m, l))(tokens[0], tokens[1])
+    return _tgrep_flatten('or', tokens)
 
 def _macro_defn_action(_s, _l, tokens):
     '''
@@ -683,38 +1080,1124 @@ def _macro_defn_action(_s, _l, tokens):
 
 def _tgrep_exprs_action(_s, _l, tokens):
     '''
-    This is the top-lebel node in a tgrep2 search string; the
-    predicate function it returns binds together all the state of a
-    tgrep2 search string.
+    This is the top-lebel node in a tgrep2 search string; the AST node
+    it returns binds together all the state of a tgrep2 search
+    string.
 
-    Builds a lambda function representing a predicate on a tree node
-    from the disjunction of several tgrep expressions.  Also handles
-    macro definitions and macro name binding, and node label
-    definitions and node label binding.
+    Builds an AST node representing a predicate on a tree node from
+    the disjunction of several tgrep expressions, together with the
+    macro definitions they use.
     '''
-    if len(tokens) == 1:
-        return lambda n, m=None, l=None: tokens[0](n, None, {})
     # filter out all the semicolons
     tokens = [x for x in tokens if x != ';']
-    # collect all macro definitions
-    macro_dict = {}
-    macro_defs = [tok for tok in tokens if isinstance(tok, dict)]
-    for macro_def in macro_defs:
-        macro_dict.update(macro_def)
+    # collect all macro definitions, in order
+    macros = tuple(item for tok in tokens if isinstance(tok, dict)
+                   for item in tok.items())
     # collect all tgrep expressions
-    tgrep_exprs = [tok for tok in tokens if not isinstance(tok, dict)]
-    # create a new scope for the node label dictionary
+    tgrep_exprs = tuple(tok for tok in tokens if not isinstance(tok, dict))
+    return ('exprs', macros, tgrep_exprs)
+
+def _tgrep_predicate(ast, macros=None, profile=None):
+    '''
+    Builds a lambda function representing the predicate on a tree node
+    described by the given pattern AST.
+
+    Pattern ASTs are built by the parse actions above out of nested
+    tuples, each beginning with a string giving the kind of the node:
+
+    - `('any',)`, `('literal', s)`, `('regex', r)`, `('icase', node)`,
+      `('node_or', nodes)` and `('treepos', position)` test the name
+      or position of a node
+    - `('macro', name)` is the use of a macro
+    - `('bind', node, label)` binds a node label; `('label_use',
+      label)` is true of the node bound to the label
+    - `('rel', operator, node)` is a relation to another node
+    - `('not', expr)`, `('and', exprs)` and `('or', exprs)` combine
+      other predicates
+    - `('segment', label, exprs)` is a segmented pattern
+    - `('exprs', macros, exprs)` is a whole search string, with its
+      macro definitions as `(name, ast)` pairs
+
+    `macros` maps the names of the macros in scope onto their
+    definitions; it is used to decide which subpatterns may be
+    memoized (see `_tgrep_memoized_predicate`).  If a `profile` (see
+    `_TgrepPatternProfile`) is given, the predicates of the
+    subpatterns are instrumented to count their calls.
+    '''
+    kind = ast[0]
+    if kind in ('any', 'literal', 'regex', 'icase', 'node_or', 'treepos'):
+        predicate = _tgrep_node_predicate(ast, macros, profile)
+    elif kind == 'macro':
+        predicate = _tgrep_macro_use_predicate(ast[1])
+    elif kind == 'label_use':
+        predicate = _tgrep_node_label_use_predicate(ast[1])
+    elif kind == 'bind':
+        predicate = _tgrep_bind_node_label_predicate(
+            _tgrep_predicate(ast[1], macros, profile), ast[2])
+    elif kind == 'rel':
+        target = _tgrep_predicate(ast[2], macros, profile)
+        if _tgrep_ast_is_memoizable(ast[2], macros):
+            target = _tgrep_memoized_predicate(target)
+        if profile is not None:
+            target = profile.count_visits(ast, target)
+        predicate = _tgrep_relation_predicate(ast[1], target)
+    elif kind == 'not':
+        predicate = (lambda r: (lambda n, m=None, l=None: not r(n, m, l)))(
+            _tgrep_predicate(ast[1], macros, profile))
+    elif kind == 'and':
+        predicate = (lambda ts: lambda n, m=None, l=None: all(
+            predicate(n, m, l) for predicate in ts))(
+                [_tgrep_predicate(x, macros, profile) for x in ast[1]])
+    elif kind == 'or':
+        predicate = (lambda ts: lambda n, m=None, l=None: any(
+            predicate(n, m, l) for predicate in ts))(
+                [_tgrep_predicate(x, macros, profile) for x in ast[1]])
+    elif kind == 'segment':
+        predicate = _tgrep_segmented_pattern_predicate(
+            ast[1], [_tgrep_predicate(x, macros, profile) for x in ast[2]])
+    elif kind == 'exprs':
+        predicate = _tgrep_exprs_predicate(ast[1], ast[2], profile)
+    else:
+        raise TgrepException('cannot interpret pattern node {0!r}'.format(ast))
+    if profile is not None:
+        predicate = profile.instrument(ast, predicate)
+    return predicate
+
+def _tgrep_node_predicate(ast, macros=None, profile=None):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    depending on the name (or tree position) of its node.
+    '''
+    kind = ast[0]
+    if kind == 'any':
+        return lambda n, m=None, l=None: True
+    elif kind == 'literal':
+        return (lambda s: lambda n, m=None, l=None:
+                _tgrep_node_literal_value(n) == s)(ast[1])
+    elif _tgrep_literal_values(ast) is not None:
+        # a disjunction of literals
+        return _tgrep_literal_set_predicate(
+            frozenset(_tgrep_literal_values(ast)))
+    elif _tgrep_is_name_test(ast):
+        return (lambda t: lambda n, m=None, l=None:
+                t(_tgrep_node_literal_value(n)))(_tgrep_name_test(ast))
+    elif kind == 'node_or':
+        # capture the disjuncts and return the disjunction
+        return (lambda t: lambda n, m=None, l=None: any(f(n, m, l) for f in t))(
+            [_tgrep_node_predicate(x, macros, profile) for x in ast[1]])
+    elif kind == 'treepos':
+        # capture the node's tree position
+        return (lambda i: lambda n, m=None, l=None:
+                _navigator(l).node_treeposition(n) == i)(ast[1])
+    else:
+        # macros, labels, etc. inside a node name disjunction
+        return _tgrep_predicate(ast, macros, profile)
+
+def _tgrep_literal_set_predicate(values):
+    '''
+    Builds a lambda function testing whether the name of a tree node
+    is one of the given `values`.
+    '''
+    def literal_set_pred(n, m=None, l=None):
+        try:
+            return _tgrep_node_literal_value(n) in values
+        except TypeError:
+            # an unhashable label, which cannot equal a string
+            return False
+    return literal_set_pred
+
+# the regular expressions which `_tgrep_regex_test` turns into string
+# comparisons: a literal string, optionally anchored at either end
+_TGREP_PLAIN_REGEX = re.compile('(\\^?)([^.^$*+?{}\\[\\]\\\\|()]*)(\\$?)\\Z')
+
+# the number of distinct node names for which `_tgrep_cached_test`
+# remembers the result of a test
+_NAME_TEST_CACHE_SIZE = 10000
+
+def _tgrep_name_test(ast):
+    '''
+    Builds a function testing a node name string (see
+    `_tgrep_node_literal_value`) against the given node name AST, which
+    must be a test on node names only (see `_tgrep_is_name_test`).
+
+    Literals and disjunctions of literals become string comparisons
+    and set lookups, and simple regular expressions become string
+    method calls (see `_tgrep_regex_test`).  Other regular
+    expressions, and case-insensitive tests, are run at most once per
+    distinct node name (see `_tgrep_cached_test`).
+    '''
+    kind = ast[0]
+    if kind == 'any':
+        return lambda s: True
+    elif kind == 'literal':
+        return functools.partial(operator.eq, ast[1])
+    elif kind == 'regex':
+        return _tgrep_regex_test(ast[1])
+    elif kind == 'icase':
+        # the name is lowercased once per distinct name
+        return (lambda t: _tgrep_cached_test(lambda s: t(s.lower())))(
+            _tgrep_name_test(ast[1]))
+    # a disjunction
+    if any(x[0] == 'any' for x in ast[1]):
+        return lambda s: True
+    values = frozenset(x[1] for x in ast[1] if x[0] == 'literal')
+    tests = [_tgrep_name_test(x) for x in ast[1] if x[0] != 'literal']
+    def disjunction_test(s):
+        if s in values:
+            return True
+        for test in tests:
+            if test(s):
+                return True
+        return False
+    return disjunction_test
+
+def _tgrep_regex_test(regex):
+    '''
+    Builds a function testing whether `re.search` would find the
+    given regular expression in a string.  A regular expression which
+    is a literal string, optionally anchored by ``^`` and/or ``$``,
+    becomes a substring test, `str.startswith`, `str.endswith` or a
+    comparison; other regular expressions are run at most once per
+    distinct string.
+    '''
+    plain = _TGREP_PLAIN_REGEX.match(regex)
+    if plain is None:
+        return _tgrep_cached_test(re.compile(regex).search)
+    start, text, end = plain.groups()
+    # `$` also matches before a newline at the end of the string
+    ends = (text, text + '\n')
+    if start and end:
+        return frozenset(ends).__contains__
+    elif start:
+        return operator.methodcaller('startswith', text)
+    elif end:
+        return operator.methodcaller('endswith', ends)
+    return operator.methodcaller('__contains__', text)
+
+def _tgrep_cached_test(test):
+    '''
+    Wraps a test on node name strings, so that it is run at most once
+    per distinct string (as long as there are no more than
+    `_NAME_TEST_CACHE_SIZE` of them); node names repeat a great deal
+    within a tree and across a corpus.
+    '''
+    cache = {}
+    def cached_test(s):
+        try:
+            result = cache.get(s)
+        except TypeError:
+            # an unhashable label
+            return bool(test(s))
+        if result is None:
+            if len(cache) >= _NAME_TEST_CACHE_SIZE:
+                cache.clear()
+            result = cache[s] = bool(test(s))
+        return result
+    return cached_test
+
+def _tgrep_macro_use_predicate(macro_name):
+    '''
+    Builds a lambda function which looks up the macro name used.
+    '''
+    def macro_use(n, m=None, l=None):
+        if m is None or macro_name not in m:
+            raise TgrepException('macro {0} not defined'.format(macro_name))
+        return m[macro_name](n, m, l)
+    return macro_use
+
+def _tgrep_parent_relation(predicate, index_test):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    which is true if the node\'s parent satisfies `predicate`, and
+    `index_test(i, size)` holds of the node\'s index `i` in its parent
+    and the number of children `size` of the parent.
+    '''
+    def parent_relation_pred(n, m=None, l=None):
+        nav = _navigator(l)
+        parent = nav.parent(n)
+        return (parent is not None and
+                index_test(nav.parent_index(n), len(parent)) and
+                predicate(parent, m, l))
+    return parent_relation_pred
+
+def _tgrep_sister_relation(predicate, sisters):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    which is true if any of the node\'s sisters selected by
+    `sisters(parent, i)` satisfies `predicate`, where `i` is the
+    node\'s index in its parent.
+    '''
+    def sister_relation_pred(n, m=None, l=None):
+        nav = _navigator(l)
+        parent = nav.parent(n)
+        return (parent is not None and
+                any(predicate(x, m, l)
+                    for x in sisters(parent, nav.parent_index(n))))
+    return sister_relation_pred
+
+def _tgrep_relation_predicate(operator, predicate):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    depending on its relation (given by the tgrep `operator`) to other
+    nodes in the tree satisfying `predicate`.
+    '''
+    # A < B       A is the parent of (immediately dominates) B.
+    if operator == '<':
+        retval = lambda n, m=None, l=None: (_istree(n) and
+                                            any(predicate(x, m, l) for x in n))
+    # A > B       A is the child of B.
+    elif operator == '>':
+        retval = _tgrep_parent_relation(predicate, lambda i, size: True)
+    # A <, B      Synonymous with A <1 B.
+    elif operator == '<,' or operator == '<1':
+        retval = lambda n, m=None, l=None: (_istree(n) and
+                                            bool(list(n)) and
+                                            predicate(n[0], m, l))
+    # A >, B      Synonymous with A >1 B.
+    elif operator == '>,' or operator == '>1':
+        retval = _tgrep_parent_relation(predicate, lambda i, size: i == 0)
+    # A <N B      B is the Nth child of A (the first child is <1).
+    elif operator[0] == '<' and operator[1:].isdigit():
+        idx = int(operator[1:])
+        # capture the index parameter
+        retval = (lambda i: lambda n, m=None, l=None: (_istree(n) and
+                                                       bool(list(n)) and
+                                                       0 <= i < len(n) and
+                                                       predicate(n[i], m, l)))(idx - 1)
+    # A >N B      A is the Nth child of B (the first child is >1).
+    elif operator[0] == '>' and operator[1:].isdigit():
+        idx = int(operator[1:])
+        # capture the index parameter
+        retval = _tgrep_parent_relation(
+            predicate, (lambda j: lambda i, size: i == j)(idx - 1))
+    # A <' B      B is the last child of A (also synonymous with A <-1 B).
+    # A <- B      B is the last child of A (synonymous with A <-1 B).
+    elif operator == '<\'' or operator == '<-' or operator == '<-1':
+        retval = lambda n, m=None, l=None: (_istree(n) and bool(list(n))
+                                            and predicate(n[-1], m, l))
+    # A >' B      A is the last child of B (also synonymous with A >-1 B).
+    # A >- B      A is the last child of B (synonymous with A >-1 B).
+    elif operator == '>\'' or operator == '>-' or operator == '>-1':
+        retval = _tgrep_parent_relation(predicate,
+                                        lambda i, size: i == size - 1)
+    # A <-N B 	  B is the N th-to-last child of A (the last child is <-1).
+    elif operator[:2] == '<-' and operator[2:].isdigit():
+        idx = -int(operator[2:])
+        # capture the index parameter
+        retval = (lambda i: lambda n, m=None, l=None: (_istree(n) and
+                                                       bool(list(n)) and
+                                                       0 <= (i + len(n)) < len(n) and
+                                                       predicate(n[i + len(n)], m, l)))(idx)
+    # A >-N B 	  A is the N th-to-last child of B (the last child is >-1).
+    elif operator[:2] == '>-' and operator[2:].isdigit():
+        idx = -int(operator[2:])
+        # capture the index parameter
+        retval = _tgrep_parent_relation(
+            predicate, (lambda j: lambda i, size: i == size + j)(idx))
+    # A <: B      B is the only child of A
+    elif operator == '<:':
+        retval = lambda n, m=None, l=None: (_istree(n) and
+                                            len(n) == 1 and
+                                            predicate(n[0], m, l))
+    # A >: B      A is the only child of B.
+    elif operator == '>:':
+        retval = _tgrep_parent_relation(predicate, lambda i, size: size == 1)
+    # A << B      A dominates B (A is an ancestor of B).
+    elif operator == '<<':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).descendants(n))
+    # A >> B      A is dominated by B (A is a descendant of B).
+    elif operator == '>>':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).ancestors(n))
+    # A <<, B     B is a left-most descendant of A.
+    elif operator == '<<,' or operator == '<<1':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).leftmost_descendants(n))
+    # A >>, B     A is a left-most descendant of B.
+    elif operator == '>>,':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).leftmost_ancestors(n))
+    # A <<' B     B is a right-most descendant of A.
+    elif operator == '<<\'':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).rightmost_descendants(n))
+    # A >>' B     A is a right-most descendant of B.
+    elif operator == '>>\'':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).rightmost_ancestors(n))
+    # A <<: B     There is a single path of descent from A and B is on it.
+    elif operator == '<<:':
+        retval = lambda n, m=None, l=None: (_istree(n) and
+                                            any(predicate(x, m, l)
+                                                for x in _unique_descendants(n)))
+    # A >>: B     There is a single path of descent from B and A is on it.
+    elif operator == '>>:':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).unique_ancestors(n))
+    # A . B       A immediately precedes B.
+    elif operator == '.':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).immediately_after(n))
+    # A , B       A immediately follows B.
+    elif operator == ',':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).immediately_before(n))
+    # A .. B      A precedes B.
+    elif operator == '..':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).after(n))
+    # A ,, B      A follows B.
+    elif operator == ',,':
+        retval = lambda n, m=None, l=None: any(predicate(x, m, l) for x in
+                                               _navigator(l).before(n))
+    # A $ B       A is a sister of B (and A != B).
+    elif operator == '$' or operator == '%':
+        retval = _tgrep_sister_relation(
+            predicate, lambda p, i: (x for j, x in enumerate(p) if j != i))
+    # A $. B      A is a sister of and immediately precedes B.
+    elif operator == '$.' or operator == '%.':
+        retval = _tgrep_sister_relation(predicate,
+                                        lambda p, i: p[i + 1:i + 2])
+    # A $, B      A is a sister of and immediately follows B.
+    elif operator == '$,' or operator == '%,':
+        retval = _tgrep_sister_relation(
+            predicate, lambda p, i: p[i - 1:i] if i > 0 else [])
+    # A $.. B     A is a sister of and precedes B.
+    elif operator == '$..' or operator == '%..':
+        retval = _tgrep_sister_relation(predicate, lambda p, i: p[i + 1:])
+    # A $,, B     A is a sister of and follows B.
+    elif operator == '$,,' or operator == '%,,':
+        retval = _tgrep_sister_relation(predicate, lambda p, i: p[:i])
+    else:
+        raise TgrepException(
+            'cannot interpret tgrep operator "{0}"'.format(operator))
+    return retval
+
+def _tgrep_segmented_pattern_predicate(node_label, reln_preds):
+    '''
+    Builds a lambda function representing a segmented pattern (see
+    `_tgrep_segmented_pattern_action`).
+    '''
+    def pattern_segment_pred(n, m=None, l=None):
+        '''This predicate function ignores its node argument.'''
+        # look up the bound node using its label
+        if l is None or node_label not in l:
+            raise TgrepException('node_label ={0} not bound in pattern'.format(
+                node_label))
+        node = l[node_label]
+        # match the relation predicates against the node
+        return all(pred(node, m, l) for pred in reln_preds)
+    return pattern_segment_pred
+
+def _tgrep_node_label_use_predicate(node_label):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    which describes the use of a previously bound node label (see
+    `_tgrep_node_label_pred_use_action`).
+    '''
+    def node_label_use_pred(n, m=None, l=None):
+        # look up the bound node using its label
+        if l is None or node_label not in l:
+            raise TgrepException('node_label ={0} not bound in pattern'.format(
+                node_label))
+        node = l[node_label]
+        # truth means the given node is this node
+        return n is node
+    return node_label_use_pred
+
+def _tgrep_bind_node_label_predicate(node_pred, node_label):
+    '''
+    Builds a lambda function representing a predicate on a tree node
+    which binds a node matching `node_pred` into the tgrep2 string\'s
+    label_dict.
+    '''
+    def node_label_bind_pred(n, m=None, l=None):
+        if node_pred(n, m, l):
+            # bind `n` into the dictionary `l`
+            if l is None:
+                raise TgrepException(
+                    'cannot bind node_label {0}: label_dict is None'.format(
+                        node_label))
+            l[node_label] = n
+            return True
+        else:
+            return False
+    return node_label_bind_pred
+
+def _tgrep_exprs_predicate(macros, exprs, profile=None):
+    '''
+    Builds the top-level predicate function of a tgrep2 search string,
+    which binds together all the state of the search string.
+
+    The predicate is the disjunction of the predicates of the tgrep
+    expressions `exprs`; it binds the macro definitions (`macros`) to
+    `m`, and creates a new scope `l` for node labels for each
+    expression, so that labels bound by an expression which fails to
+    match are not seen by the others.
+    '''
+    macros = dict(macros)
+    macro_dict = dict((name, _tgrep_predicate(ast, macros, profile))
+                      for name, ast in macros.items())
+    tgrep_exprs = [_tgrep_predicate(ast, macros, profile) for ast in exprs]
     def top_level_pred(n, m=macro_dict, l=None):
-        label_dict = {}
+        index = getattr(l, 'index', None)
+        memo = getattr(l, 'memo', None)
         # bind macro definitions and OR together all tgrep_exprs
-        return any(predicate(n, m, label_dict) for predicate in tgrep_exprs)
+        for predicate in tgrep_exprs:
+            # create a new scope for the node label dictionary
+            label_dict = _LabelDict(index, memo)
+            if predicate(n, m, label_dict):
+                if isinstance(l, _LabelDict):
+                    # pass the labels bound by the match back out
+                    l.bindings = label_dict
+                return True
+        return False
     return top_level_pred
 
-def _build_tgrep_parser(set_parse_actions = True):
+def _tgrep_ast_relations(ast, macros, _seen=()):
+    '''
+    Returns None if the given pattern AST binds or uses node labels,
+    directly or through the definitions of its macros (or uses a macro
+    which is undefined or recursive); otherwise, returns True if it
+    involves a relation to other nodes, and False if not.
+    '''
+    has_relation = False
+    for x in _tgrep_ast_walk(ast):
+        if x[0] in ('bind', 'label_use', 'segment'):
+            return None
+        elif x[0] == 'rel':
+            has_relation = True
+        elif x[0] == 'macro':
+            if macros is None or x[1] not in macros or x[1] in _seen:
+                return None
+            macro_relations = _tgrep_ast_relations(macros[x[1]], macros,
+                                                   _seen + (x[1],))
+            if macro_relations is None:
+                return None
+            has_relation = has_relation or macro_relations
+    return has_relation
+
+def _tgrep_ast_is_memoizable(ast, macros):
+    '''
+    Returns True if the results of the given pattern AST may be
+    memoized per node during a search: that is, if it neither binds nor
+    uses node labels, and involves a relation to other nodes (tests on
+    nodes alone are cheaper to repeat than to look up).
+    '''
+    return bool(_tgrep_ast_relations(ast, macros))
+
+def _tgrep_memoized_predicate(predicate):
+    '''
+    Wraps the predicate of a memoizable subpattern (see
+    `_tgrep_ast_is_memoizable`) so that it is evaluated at most once
+    per node during a search.  Results are kept in the memo table
+    carried by the label dictionary `l` (see `_LabelDict`), keyed by
+    node identity.
+    '''
+    key = object()
+    def memoized_pred(n, m=None, l=None):
+        memo = getattr(l, 'memo', None)
+        if memo is None:
+            return predicate(n, m, l)
+        try:
+            results = memo[key]
+        except KeyError:
+            results = memo[key] = {}
+        try:
+            return results[id(n)]
+        except KeyError:
+            result = results[id(n)] = predicate(n, m, l)
+            return result
+    return memoized_pred
+
+def _tgrep_ast_walk(ast):
+    '''
+    Yields the given pattern AST node and all of the AST nodes below
+    it, including the definitions of macros.
+    '''
+    stack = [ast]
+    while stack:
+        ast = stack.pop()
+        yield ast
+        kind = ast[0]
+        if kind in ('not', 'bind', 'icase'):
+            stack.append(ast[1])
+        elif kind in ('and', 'or', 'node_or'):
+            stack.extend(ast[1])
+        elif kind == 'rel':
+            stack.append(ast[2])
+        elif kind == 'segment':
+            stack.extend(ast[2])
+        elif kind == 'exprs':
+            stack.extend(x for _name, x in ast[1])
+            stack.extend(ast[2])
+
+def _tgrep_ast_uses_labels(ast):
+    '''
+    Returns True if the given pattern AST uses node labels (as opposed
+    to merely binding them), either through `=label` node names or
+    segmented patterns.
+    '''
+    return any(x[0] in ('label_use', 'segment') for x in _tgrep_ast_walk(ast))
+
+def _tgrep_ast_binds_labels(ast):
+    '''
+    Returns True if the given pattern AST binds node labels (e.g.
+    ``NP=n``).
+    '''
+    return any(x[0] == 'bind' for x in _tgrep_ast_walk(ast))
+
+def _tgrep_ast_uses_positions(ast):
+    '''
+    Returns True if the given pattern AST selects nodes by their tree
+    position (the `N(...)` syntax).
+    '''
+    return any(x[0] == 'treepos' for x in _tgrep_ast_walk(ast))
+
+def _tgrep_is_name_test(ast):
+    '''
+    Returns True if the given pattern AST is a test on node names
+    only, which depends on nothing but the literal value of the node
+    (see `_tgrep_node_literal_value`).
+    '''
+    if ast[0] == 'node_or':
+        return all(_tgrep_is_name_test(x) for x in ast[1])
+    return ast[0] in ('any', 'literal', 'regex', 'icase')
+
+def _tgrep_literal_values(ast):
+    '''
+    Returns the set of node names accepted by the given node name
+    AST, if it is a literal or a disjunction of literals; otherwise,
+    returns None.
+    '''
+    if ast[0] == 'literal':
+        return set([ast[1]])
+    if ast[0] == 'node_or':
+        values = set()
+        for disjunct in ast[1]:
+            disjunct_values = _tgrep_literal_values(disjunct)
+            if disjunct_values is None:
+                return None
+            values.update(disjunct_values)
+        return values
+    return None
+
+def _tgrep_head_constraint(ast, macros, _seen=()):
+    '''
+    Returns a node name AST (see `_tgrep_is_name_test`) which every
+    node matching the given pattern AST must satisfy, or None if
+    there is no such constraint.
+
+    This is the test on the head node of the pattern: for instance,
+    the head constraint of `NP < DT` is `NP`, and that of
+    `/^S/ | VP < NN` is `/^S/ | VP`.  `macros` maps macro names onto
+    their definitions, so that macro uses can be expanded.
+    '''
+    kind = ast[0]
+    if kind in ('literal', 'regex', 'icase'):
+        return ast
+    elif kind in ('node_or', 'exprs'):
+        disjuncts = ast[1] if kind == 'node_or' else ast[2]
+        heads = [_tgrep_head_constraint(x, macros, _seen) for x in disjuncts]
+        if any(head is None for head in heads):
+            return None
+        return heads[0] if len(heads) == 1 else ('node_or', tuple(heads))
+    elif kind == 'and':
+        for conjunct in ast[1]:
+            head = _tgrep_head_constraint(conjunct, macros, _seen)
+            if head is not None:
+                return head
+    elif kind == 'bind':
+        return _tgrep_head_constraint(ast[1], macros, _seen)
+    elif kind == 'macro':
+        # guard against recursive macro definitions
+        if ast[1] in macros and ast[1] not in _seen:
+            return _tgrep_head_constraint(macros[ast[1]], macros,
+                                          _seen + (ast[1],))
+    return None
+
+def _tgrep_expand_macros(ast, macros, _seen=()):
+    '''
+    Returns a copy of the given pattern AST in which every macro use
+    is replaced by the macro's definition, from the dictionary
+    `macros`.  Raises TgrepException if a macro is undefined or
+    defined in terms of itself.
+    '''
+    expand = lambda x: _tgrep_expand_macros(x, macros, _seen)
+    kind = ast[0]
+    if kind == 'macro':
+        if ast[1] not in macros:
+            raise TgrepException('macro {0} not defined'.format(ast[1]))
+        if ast[1] in _seen:
+            raise TgrepException('macro {0} is recursive'.format(ast[1]))
+        return _tgrep_expand_macros(macros[ast[1]], macros, _seen + (ast[1],))
+    elif kind in ('not', 'icase'):
+        return (kind, expand(ast[1]))
+    elif kind == 'bind':
+        return (kind, expand(ast[1]), ast[2])
+    elif kind in ('and', 'or', 'node_or'):
+        return _tgrep_flatten(kind, [expand(x) for x in ast[1]])
+    elif kind in ('rel', 'segment'):
+        children = ast[2] if kind == 'segment' else (ast[2],)
+        children = tuple(expand(x) for x in children)
+        return (kind, ast[1], children if kind == 'segment' else children[0])
+    elif kind == 'exprs':
+        return ('exprs', (), tuple(_tgrep_expand_macros(x, dict(ast[1]))
+                                   for x in ast[2]))
+    return ast
+
+def _tgrep_reorder_ast(ast, stats, macros, head=None):
+    '''
+    Returns a copy of the given pattern AST in which the parts of each
+    conjunction and disjunction are ordered by their estimated cost
+    and selectivity under the given corpus statistics (see
+    `nltk_tgrep.corpus_stats.CorpusStatistics`), so that the parts
+    most likely to decide the result cheaply are tested first.
+
+    Conjunctions and disjunctions which bind or use node labels
+    (directly or through their macros) are left in order, since
+    labels are bound as the parts are tested.  `macros` maps macro
+    names onto their definitions, and `head` is the head constraint
+    of the node the AST describes, if known.
+    '''
+    reorder = lambda x: _tgrep_reorder_ast(x, stats, macros, head)
+    kind = ast[0]
+    if kind in ('and', 'or'):
+        if kind == 'and':
+            head = _tgrep_head_constraint(ast, macros) or head
+        parts = [_tgrep_reorder_ast(x, stats, macros, head) for x in ast[1]]
+        if _tgrep_ast_relations(ast, macros) is not None:
+            def rank(part):
+                # the expected cost of testing the part, per test
+                # which decides the result of the whole
+                selectivity = stats.selectivity(part, macros, head)
+                if kind == 'and':
+                    selectivity = 1.0 - selectivity
+                cost = stats.cost(part, macros, head)
+                return cost / selectivity if selectivity > 0 else float('inf')
+            parts.sort(key=rank)
+        return (kind, tuple(parts))
+    elif kind in ('not', 'icase'):
+        return (kind, reorder(ast[1]))
+    elif kind == 'bind':
+        return (kind, reorder(ast[1]), ast[2])
+    elif kind == 'rel':
+        return (kind, ast[1], _tgrep_reorder_ast(ast[2], stats, macros))
+    elif kind == 'segment':
+        return (kind, ast[1], tuple(_tgrep_reorder_ast(x, stats, macros)
+                                    for x in ast[2]))
+    elif kind == 'exprs':
+        macros = dict(ast[1])
+        exprs = tuple(_tgrep_reorder_ast(x, stats, macros) for x in ast[2])
+        if _tgrep_ast_relations(ast, macros) is not None:
+            exprs = _tgrep_reorder_ast(('or', exprs), stats, macros)[1]
+        return (kind, tuple((name, _tgrep_reorder_ast(x, stats, macros))
+                            for name, x in ast[1]), exprs)
+    return ast
+
+# the operators which are synonyms of others, mapped onto the
+# spelling used by `tgrep_explain`
+_TGREP_OPERATOR_SYNONYMS = {
+    '<,': '<1', '>,': '>1', '<\'': '<-1', '<-': '<-1', '>\'': '>-1',
+    '>-': '>-1', '<<1': '<<,', '%': '$', '%.': '$.', '%,': '$,',
+    '%..': '$..', '%,,': '$,,',
+}
+
+def _tgrep_canonical_operator(operator):
+    '''
+    Returns the canonical spelling of the given tgrep operator (e.g.,
+    `<1` for `<,`).
+    '''
+    return _TGREP_OPERATOR_SYNONYMS.get(operator, operator)
+
+def _tgrep_canonical_ast(ast):
+    '''
+    Returns a copy of the given pattern AST in which every relation
+    operator has its canonical spelling (see
+    `_tgrep_canonical_operator`).
+    '''
+    kind = ast[0]
+    if kind == 'rel':
+        return ('rel', _tgrep_canonical_operator(ast[1]),
+                _tgrep_canonical_ast(ast[2]))
+    elif kind in ('not', 'icase'):
+        return (kind, _tgrep_canonical_ast(ast[1]))
+    elif kind == 'bind':
+        return (kind, _tgrep_canonical_ast(ast[1]), ast[2])
+    elif kind in ('and', 'or', 'node_or'):
+        return (kind, tuple(_tgrep_canonical_ast(x) for x in ast[1]))
+    elif kind == 'segment':
+        return (kind, ast[1], tuple(_tgrep_canonical_ast(x) for x in ast[2]))
+    elif kind == 'exprs':
+        return (kind, tuple((name, _tgrep_canonical_ast(x))
+                            for name, x in ast[1]),
+                tuple(_tgrep_canonical_ast(x) for x in ast[2]))
+    return ast
+
+# node names which can be written without quotes
+_TGREP_BARE_LITERAL = re.compile('[^][ \r\t\n;:.,&|<>()$!@%\'^=#"/]'
+                                 '[^][ \r\t\n;:.,&|<>()$!@%\'^=#]*$')
+
+def _tgrep_ast_source(ast):
+    '''
+    Returns a TGrep search string for the given pattern AST, which
+    parses back into the same AST (up to the spelling of node names).
+    '''
+    source = _tgrep_ast_source
+    kind = ast[0]
+    if kind == 'any':
+        return '__'
+    elif kind == 'literal':
+        if _TGREP_BARE_LITERAL.match(ast[1]) and ast[1] not in ('*', '__'):
+            return ast[1]
+        return '"{0}"'.format(ast[1].replace('\\', '\\\\').replace('"', '\\"'))
+    elif kind == 'regex':
+        return '/{0}/'.format(ast[1])
+    elif kind == 'icase':
+        if ast[1][0] == 'literal':
+            return 'i@"{0}"'.format(
+                ast[1][1].replace('\\', '\\\\').replace('"', '\\"'))
+        return 'i@' + source(ast[1])
+    elif kind == 'node_or':
+        return '|'.join(source(x) for x in ast[1])
+    elif kind == 'treepos':
+        return 'N({0}{1})'.format(','.join(str(x) for x in ast[1]),
+                                  ',' if len(ast[1]) == 1 else '')
+    elif kind == 'macro':
+        return '@' + ast[1]
+    elif kind == 'label_use':
+        return '=' + ast[1]
+    elif kind == 'bind':
+        return '{0}={1}'.format(source(ast[1]), ast[2])
+    elif kind == 'rel':
+        target = source(ast[2])
+        if ast[2][0] in ('and', 'or', 'not', 'rel', 'segment'):
+            target = '(' + target + ')'
+        return '{0} {1}'.format(ast[1], target)
+    elif kind == 'not':
+        if ast[1][0] == 'and':
+            return '![{0}]'.format(source(ast[1]))
+        return '!' + source(ast[1])
+    elif kind == 'and':
+        return ' '.join((': ' if x[0] == 'segment' else '') + source(x)
+                        for x in ast[1])
+    elif kind == 'or':
+        return '[{0}]'.format(' | '.join(source(x) for x in ast[1]))
+    elif kind == 'segment':
+        return ' '.join(['=' + ast[1]] + [source(x) for x in ast[2]])
+    elif kind == 'exprs':
+        return '; '.join(['@ {0} {1}'.format(name, source(x))
+                          for name, x in ast[1]] +
+                         [source(x) for x in ast[2]])
+    raise TgrepException('cannot interpret pattern node {0!r}'.format(ast))
+
+def _tgrep_relation_join(index, operator, targets):
+    '''
+    Returns the set of ids of the tree nodes in `index` which stand in
+    the relation given by the tgrep `operator` to some node in the set
+    of node ids `targets`.
+
+    This is the set-at-a-time counterpart of
+    `_tgrep_relation_predicate`: instead of visiting the related nodes
+    of each candidate node, it visits the related nodes of each target
+    node once.
+    '''
+    parent_id = index.parent_id
+    end_id = index.end_id
+    child_rank = index.child_rank
+    num_nodes = len(index)
+    istree = index.is_tree
+    num_children = index.num_children
+    def nth_child(i, pos):
+        '''Returns the id of the `pos`th child of node `i`, or None.'''
+        if not istree(i) or not 0 <= pos < num_children(i):
+            return None
+        for k, child in enumerate(index.children_ids(i)):
+            if k == pos:
+                return child
+    def parents_where(test):
+        '''Parents of targets, where test(i, size) holds of the target.'''
+        return set(parent_id[j] for j in targets
+                   if j > 0 and test(child_rank[j], num_children(parent_id[j])))
+    def children_where(pos_of_size):
+        '''Children of targets at position pos_of_size(size).'''
+        result = set()
+        for j in targets:
+            if istree(j):
+                child = nth_child(j, pos_of_size(num_children(j)))
+                if child is not None and istree(child):
+                    result.add(child)
+        return result
+    result = set()
+    # A < B       A is the parent of (immediately dominates) B.
+    if operator == '<':
+        return parents_where(lambda i, size: True)
+    # A > B       A is the child of B.
+    elif operator == '>':
+        for j in targets:
+            if istree(j):
+                result.update(c for c in index.children_ids(j) if istree(c))
+    # A <, B      Synonymous with A <1 B.
+    elif operator == '<,' or operator == '<1':
+        return parents_where(lambda i, size: i == 0)
+    # A >, B      Synonymous with A >1 B.
+    elif operator == '>,' or operator == '>1':
+        return children_where(lambda size: 0)
+    # A <N B      B is the Nth child of A (the first child is <1).
+    elif operator[0] == '<' and operator[1:].isdigit():
+        idx = int(operator[1:]) - 1
+        return parents_where(lambda i, size: i == idx)
+    # A >N B      A is the Nth child of B (the first child is >1).
+    elif operator[0] == '>' and operator[1:].isdigit():
+        idx = int(operator[1:]) - 1
+        return children_where(lambda size: idx)
+    # A <' B      B is the last child of A (also synonymous with A <-1 B).
+    # A <- B      B is the last child of A (synonymous with A <-1 B).
+    elif operator == '<\'' or operator == '<-' or operator == '<-1':
+        return parents_where(lambda i, size: i == size - 1)
+    # A >' B      A is the last child of B (also synonymous with A >-1 B).
+    # A >- B      A is the last child of B (synonymous with A >-1 B).
+    elif operator == '>\'' or operator == '>-' or operator == '>-1':
+        return children_where(lambda size: size - 1)
+    # A <-N B 	  B is the N th-to-last child of A (the last child is <-1).
+    elif operator[:2] == '<-' and operator[2:].isdigit():
+        idx = -int(operator[2:])
+        return parents_where(lambda i, size: i == size + idx)
+    # A >-N B 	  A is the N th-to-last child of B (the last child is >-1).
+    elif operator[:2] == '>-' and operator[2:].isdigit():
+        idx = -int(operator[2:])
+        return children_where(lambda size: size + idx)
+    # A <: B      B is the only child of A
+    elif operator == '<:':
+        return parents_where(lambda i, size: size == 1)
+    # A >: B      A is the only child of B.
+    elif operator == '>:':
+        return children_where(lambda size: 0 if size == 1 else -1)
+    # A << B      A dominates B (A is an ancestor of B).
+    elif operator == '<<':
+        for j in targets:
+            # stop as soon as we reach an ancestor which is already
+            # known, since all of its ancestors will be known too
+            j = parent_id[j]
+            while j >= 0 and j not in result:
+                result.add(j)
+                j = parent_id[j]
+    # A >> B      A is dominated by B (A is a descendant of B).
+    elif operator == '>>':
+        covered = -1
+        for j in sorted(targets):
+            if j > covered:
+                result.update(k for k in range(j + 1, end_id[j] + 1)
+                              if istree(k))
+                covered = end_id[j]
+    # A <<, B     B is a left-most descendant of A.
+    elif operator == '<<,' or operator == '<<1':
+        for j in targets:
+            while j > 0 and child_rank[j] == 0:
+                j = parent_id[j]
+                result.add(j)
+    # A >>, B     A is a left-most descendant of B.
+    elif operator == '>>,':
+        for j in targets:
+            # the first child of a node always has the following id
+            while end_id[j] > j:
+                j += 1
+                if istree(j):
+                    result.add(j)
+    # A <<' B     B is a right-most descendant of A.
+    elif operator == '<<\'':
+        for j in targets:
+            while j > 0 and end_id[j] == end_id[parent_id[j]]:
+                j = parent_id[j]
+                result.add(j)
+    # A >>' B     A is a right-most descendant of B.
+    elif operator == '>>\'':
+        for j in targets:
+            k = end_id[j]
+            while k != j and k >= 0:
+                if istree(k):
+                    result.add(k)
+                k = parent_id[k]
+    # A <<: B     There is a single path of descent from A and B is on it.
+    elif operator == '<<:':
+        for j in targets:
+            while j > 0 and num_children(parent_id[j]) == 1:
+                j = parent_id[j]
+                result.add(j)
+    # A >>: B     There is a single path of descent from B and A is on it.
+    elif operator == '>>:':
+        for j in targets:
+            while istree(j) and num_children(j) == 1:
+                j += 1
+                if istree(j):
+                    result.add(j)
+    # A . B       A immediately precedes B.
+    elif operator == '.':
+        for j in targets:
+            # find the top of the left-most path leading down to j ...
+            while j > 0 and child_rank[j] == 0:
+                j = parent_id[j]
+            # ... which immediately follows every node whose subtree
+            # ends just before it
+            k = j - 1
+            while j > 0 and k >= 0 and end_id[k] == j - 1:
+                if istree(k):
+                    result.add(k)
+                k = parent_id[k]
+    # A , B       A immediately follows B.
+    elif operator == ',':
+        for j in targets:
+            # the nodes immediately following j are the node just
+            # after its subtree, and that node's left-most descendants
+            k = end_id[j] + 1
+            if k < num_nodes:
+                if istree(k):
+                    result.add(k)
+                while end_id[k] > k:
+                    k += 1
+                    if istree(k):
+                        result.add(k)
+    # A .. B      A precedes B.
+    elif operator == '..':
+        if targets:
+            last = max(targets)
+            result.update(i for i in range(last) if end_id[i] < last and istree(i))
+    # A ,, B      A follows B.
+    elif operator == ',,':
+        if targets:
+            first_end = min(end_id[j] for j in targets)
+            result.update(i for i in range(first_end + 1, num_nodes) if istree(i))
+    # A $ B       A is a sister of B (and A != B).
+    elif operator in ('$', '%', '$.', '%.', '$,', '%,', '$..', '%..', '$,,', '%,,'):
+        # group the targets by their parents
+        sisters = {}
+        for j in targets:
+            if j > 0:
+                sisters.setdefault(parent_id[j], []).append(child_rank[j])
+        for parent, ranks in sisters.items():
+            children = list(index.children_ids(parent))
+            if operator[1:] == '':
+                # A $ B       A is a sister of B (and A != B).
+                ranks = set(ranks)
+                selected = [c for k, c in enumerate(children)
+                            if len(ranks) > 1 or k not in ranks]
+            elif operator[1:] == '.':
+                # A $. B      A is a sister of and immediately precedes B.
+                selected = [children[k - 1] for k in ranks if k > 0]
+            elif operator[1:] == ',':
+                # A $, B      A is a sister of and immediately follows B.
+                selected = [children[k + 1] for k in ranks
+                            if k + 1 < len(children)]
+            elif operator[1:] == '..':
+                # A $.. B     A is a sister of and precedes B.
+                selected = children[:max(ranks)]
+            else:
+                # A $,, B     A is a sister of and follows B.
+                selected = children[min(ranks) + 1:]
+            result.update(c for c in selected if istree(c))
+    else:
+        raise TgrepException(
+            'cannot interpret tgrep operator "{0}"'.format(operator))
+    return result
+
+class _SetEvaluator(object):
+    '''
+    Evaluates pattern ASTs bottom-up over a `TreeIndex`, computing for
+    each subpattern the set of ids of all the nodes in the tree which
+    match it.
+
+    Relations are evaluated as joins between node id sets (see
+    `_tgrep_relation_join`), and boolean connectives as set
+    intersection, union and difference; each distinct subpattern is
+    evaluated at most once per tree.
+    '''
+
+    def __init__(self, pattern, index):
+        self.pattern = pattern
+        self.index = index
+        self.macros = dict(pattern.ast[1])
+        self.universe = frozenset(range(len(index)))
+        self._results = {}
+
+    def matches(self, ast):
+        '''
+        Returns the set of ids of the nodes in the tree matching the
+        given pattern AST.
+        '''
+        try:
+            return self._results[ast]
+        except KeyError:
+            pass
+        kind = ast[0]
+        if kind == 'any':
+            result = self.universe
+        elif kind in ('literal', 'regex', 'icase', 'treepos'):
+            result = set(self.pattern.name_matches(ast, self.index))
+        elif kind == 'node_or':
+            result = set()
+            for disjunct in ast[1]:
+                result |= self.matches(disjunct)
+        elif kind == 'macro':
+            if ast[1] not in self.macros:
+                raise TgrepException('macro {0} not defined'.format(ast[1]))
+            result = self.matches(self.macros[ast[1]])
+        elif kind == 'bind':
+            # label uses fall back to the node-at-a-time engine, so
+            # bindings have no effect here
+            result = self.matches(ast[1])
+        elif kind == 'rel':
+            result = _tgrep_relation_join(self.index, ast[1],
+                                          self.matches(ast[2]))
+        elif kind == 'not':
+            result = self.universe - self.matches(ast[1])
+        elif kind == 'and':
+            result = self.matches(ast[1][0])
+            for conjunct in ast[1][1:]:
+                if not result:
+                    break
+                result = result & self.matches(conjunct)
+        elif kind in ('or', 'exprs'):
+            disjuncts = ast[1] if kind == 'or' else ast[2]
+            result = set()
+            for disjunct in disjuncts:
+                result |= self.matches(disjunct)
+        else:
+            raise TgrepException(
+                'the set engine cannot evaluate pattern node {0!r}'.format(ast))
+        self._results[ast] = result
+        return result
+
+def _tgrep_span_action(_s, _l, tokens):
+    '''
+    Records the source span of the AST node parsed by a
+    `pyparsing.Located` element (see `_build_tgrep_parser`), and
+    passes the AST node on unchanged.
+    '''
+    start, value, end = tokens
+    if len(value) == 1 and isinstance(value[0], tuple):
+        _SPAN_LOG.append((value[0], start, end))
+    return value
+
+def _build_tgrep_parser(set_parse_actions = True, record_spans = False):
     '''
     Builds a pyparsing-based parser object for tokenizing and
     interpreting tgrep search strings.
+
+    If `record_spans` is True, the parser also records the source span
+    of each AST node it builds in `_SPAN_LOG` (see
+    `_parse_tgrep_spans`).
     '''
+    # pyparsing is only imported once it is needed, since importing it
+    # takes longer than importing the rest of this package
+    import pyparsing
+    if record_spans:
+        # the span is only known once the AST node has been built, so
+        # the parts of the grammar which build AST nodes are wrapped
+        located = lambda expr: pyparsing.Located(expr).setParseAction(
+            _tgrep_span_action)
+    else:
+        located = lambda expr: expr
     tgrep_op = (pyparsing.Optional('!') +
                 pyparsing.Regex('[$%,.<>][%,.<>0-9-\':]*'))
     tgrep_qstring = pyparsing.QuotedString(quoteChar='"', escChar='\\',
@@ -728,7 +2211,7 @@ def _build_tgrep_parser(set_parse_actions = True):
     tgrep_node_literal = pyparsing.Regex('[^][ \r\t\n;:.,&|<>()$!@%\'^=]+')
     tgrep_expr = pyparsing.Forward()
     tgrep_relations = pyparsing.Forward()
-    tgrep_parens = pyparsing.Literal('(') + tgrep_expr + ')'
+    tgrep_parens = pyparsing.Literal('(') + located(tgrep_expr) + ')'
     tgrep_nltk_tree_pos = (
         pyparsing.Literal('N(') +
         pyparsing.Optional(pyparsing.Word(pyparsing.nums) + ',' +
@@ -742,9 +2225,9 @@ def _build_tgrep_parser(set_parse_actions = True):
     macro_name = pyparsing.Regex('[^];:.,&|<>()[$!@%\'^=\r\t\n ]+')
     macro_name.setWhitespaceChars('')
     macro_use = pyparsing.Combine('@' + macro_name)
-    tgrep_node_expr = (tgrep_node_label_use_pred |
-                       macro_use |
-                       tgrep_nltk_tree_pos |
+    tgrep_node_expr = (located(tgrep_node_label_use_pred) |
+                       located(macro_use) |
+                       located(tgrep_nltk_tree_pos) |
                        tgrep_qstring_icase |
                        tgrep_node_regex_icase |
                        tgrep_qstring |
@@ -757,26 +2240,30 @@ def _build_tgrep_parser(set_parse_actions = True):
                         tgrep_node_expr)
     tgrep_node = (tgrep_parens |
                   (pyparsing.Optional("'") +
-                   tgrep_node_expr2 +
+                   located(tgrep_node_expr2) +
                    pyparsing.ZeroOrMore("|" + tgrep_node_expr)))
-    tgrep_brackets = pyparsing.Optional('!') + '[' + tgrep_relations + ']'
-    tgrep_relation = tgrep_brackets | (tgrep_op + tgrep_node)
+    tgrep_brackets = (pyparsing.Optional('!') + '[' +
+                      located(tgrep_relations) + ']')
+    tgrep_relation = tgrep_brackets | (tgrep_op + located(tgrep_node))
     tgrep_rel_conjunction = pyparsing.Forward()
-    tgrep_rel_conjunction << (tgrep_relation +
+    tgrep_rel_conjunction << (located(tgrep_relation) +
                               pyparsing.ZeroOrMore(pyparsing.Optional('&') +
-                                                   tgrep_rel_conjunction))
-    tgrep_relations << tgrep_rel_conjunction + pyparsing.ZeroOrMore(
-        "|" + tgrep_relations)
-    tgrep_expr << tgrep_node + pyparsing.Optional(tgrep_relations)
-    tgrep_expr_labeled = tgrep_node_label_use + pyparsing.Optional(tgrep_relations)
-    tgrep_expr2 = tgrep_expr + pyparsing.ZeroOrMore(':' + tgrep_expr_labeled)
+                                                   located(tgrep_rel_conjunction)))
+    tgrep_relations << located(tgrep_rel_conjunction) + pyparsing.ZeroOrMore(
+        "|" + located(tgrep_relations))
+    tgrep_expr << located(tgrep_node) + pyparsing.Optional(
+        located(tgrep_relations))
+    tgrep_expr_labeled = tgrep_node_label_use + pyparsing.Optional(
+        located(tgrep_relations))
+    tgrep_expr2 = located(tgrep_expr) + pyparsing.ZeroOrMore(
+        ':' + located(tgrep_expr_labeled))
     macro_defn = (pyparsing.Literal('@') +
                   pyparsing.White().suppress() +
                   macro_name +
-                  tgrep_expr2)
+                  located(tgrep_expr2))
     tgrep_exprs = (pyparsing.Optional(macro_defn + pyparsing.ZeroOrMore(';' + macro_defn) + ';') +
-                   tgrep_expr2 +
-                   pyparsing.ZeroOrMore(';' + (macro_defn | tgrep_expr2)) +
+                   located(tgrep_expr2) +
+                   pyparsing.ZeroOrMore(';' + (macro_defn | located(tgrep_expr2))) +
                    pyparsing.ZeroOrMore(';').suppress())
     if set_parse_actions:
         tgrep_node_label_use.setParseAction(_tgrep_node_label_use_action)
@@ -800,24 +2287,675 @@ def _build_tgrep_parser(set_parse_actions = True):
         tgrep_exprs.setParseAction(_tgrep_exprs_action)
     return tgrep_exprs.ignore('#' + pyparsing.restOfLine)
 
-def tgrep_tokenize(tgrep_string):
+# the parser objects are expensive to build, so we only build them
+# once; `_PARSER_LOCK` also serialises access to the parsers, since
+# pyparsing does not guarantee that parsing is thread-safe
+_PARSER_LOCK = threading.RLock()
+_PARSERS = {}
+# the `(ast, start, end)` spans recorded while parsing with
+# `_parse_tgrep_spans`
+_SPAN_LOG = []
+
+def _parse_tgrep_string(tgrep_string, set_parse_actions, parser='pyparsing'):
     '''
-    Tokenizes a TGrep search string into separate tokens.
+    Parses the given TGrep search string using the given parser:
+    'pyparsing', the shared pyparsing parser object, which is built on
+    first use, or 'native', a `_TgrepParser`.  Search strings which
+    the native parser rejects are parsed again with pyparsing, so that
+    both parsers report syntax errors as the same
+    `pyparsing.ParseException`.
     '''
-    parser = _build_tgrep_parser(False)
     if isinstance(tgrep_string, bytes):
         tgrep_string = tgrep_string.decode()
-    return list(parser.parseString(tgrep_string))
+    if parser == 'native':
+        tokens = _TgrepParser(tgrep_string, set_parse_actions).parse(
+            set_parse_actions)
+        if tokens is not None:
+            return tokens
+    elif parser != 'pyparsing':
+        raise TgrepException('unknown tgrep parser "{0}"'.format(parser))
+    with _PARSER_LOCK:
+        parser = _PARSERS.get(set_parse_actions)
+        if parser is None:
+            parser = _PARSERS[set_parse_actions] = _build_tgrep_parser(
+                set_parse_actions)
+        return list(parser.parseString(tgrep_string,
+                                       parseAll=set_parse_actions))
+
+def _parse_tgrep_spans(tgrep_string):
+    '''
+    Parses the given TGrep search string into its pattern AST, and
+    also returns a dictionary mapping the `id` of each AST node built
+    by the parser onto its source span, as a `(start, end)` pair of
+    offsets into `tgrep_string`.  The third value returned is a list
+    of the AST nodes which have spans, which must be kept alive for as
+    long as the ids are used.
+    '''
+    import pyparsing
+    if not hasattr(pyparsing, 'Located'):
+        raise TgrepException('source spans require pyparsing 3.0 or later')
+    with _PARSER_LOCK:
+        parser = _PARSERS.get('spans')
+        if parser is None:
+            parser = _PARSERS['spans'] = _build_tgrep_parser(True, True)
+        del _SPAN_LOG[:]
+        try:
+            ast = parser.parseString(tgrep_string, parseAll=True)[0]
+            log = list(_SPAN_LOG)
+        finally:
+            del _SPAN_LOG[:]
+    spans = {}
+    # an AST node passed up unchanged (e.g., out of parentheses) gets
+    # the span of its outermost occurrence
+    for node, start, end in log:
+        while start < end and tgrep_string[start].isspace():
+            start += 1
+        while end > start and tgrep_string[end - 1].isspace():
+            end -= 1
+        spans[id(node)] = (start, end)
+    spans[id(ast)] = (0, len(tgrep_string))
+    # a negated relation is built together with its negation
+    for node in _tgrep_ast_walk(ast):
+        if node[0] == 'not' and id(node) in spans:
+            spans.setdefault(id(node[1]), spans[id(node)])
+    return ast, spans, [node for node, _start, _end in log] + [ast]
+
+# the terminal symbols of the TGrep grammar, for `_TgrepParser`; these
+# match the same strings as the corresponding pyparsing elements in
+# `_build_tgrep_parser`
+_TGREP_SKIP = re.compile('(?:[ \t\r\n]+|#[^\n]*)*')
+_TGREP_OPERATOR = re.compile('[$%,.<>][%,.<>0-9\\-\':]*')
+_TGREP_QSTRING = re.compile('"(?:(?:\\\\.)|(?:[^"\n\r\\\\]))*"')
+_TGREP_NODE_REGEX = re.compile('/(?:(?:\\\\.)|(?:[^/\n\r\\\\]))*/')
+_TGREP_QSTRING_ICASE = re.compile('i@\\"(?:[^"\\n\\r\\\\]|(?:\\\\.))*\\"')
+_TGREP_NODE_REGEX_ICASE = re.compile('i@\\/(?:[^/\\n\\r\\\\]|(?:\\\\.))*\\/')
+_TGREP_NODE_LITERAL = re.compile('[^][ \r\t\n;:.,&|<>()$!@%\'^=]+')
+_TGREP_NODE_LABEL = re.compile('[A-Za-z0-9]+')
+_TGREP_MACRO_NAME = re.compile('[^];:.,&|<>()[$!@%\'^=\r\t\n ]+')
+_TGREP_NUMBER = re.compile('[0-9]+')
+_TGREP_WHITE = re.compile('[ \t\r\n]+')
+
+class _TgrepParser(object):
+    '''
+    A hand-written recursive-descent parser for TGrep search strings,
+    which accepts the same grammar as `_build_tgrep_parser`, and
+    produces the same tokens (or, with `set_parse_actions`, the same
+    pattern AST, by calling the same parse actions), but is much
+    faster than pyparsing.
+
+    Each method parses one element of the grammar at the current
+    position, and returns its list of tokens, or None (leaving the
+    position where it was) if the element does not match there.
+    '''
 
-def tgrep_compile(tgrep_string):
+    def __init__(self, tgrep_string, set_parse_actions):
+        # pyparsing expands tabs before parsing, which shows in quoted
+        # node names
+        self.string = tgrep_string.expandtabs()
+        self.pos = 0
+        self.set_parse_actions = set_parse_actions
+
+    def parse(self, parse_all):
+        '''
+        Parses the whole search string, or (unless `parse_all` is
+        True) as much of it as makes up a search.  Returns None if the
+        search string cannot be parsed.
+        '''
+        tokens = self.exprs()
+        if tokens is not None and parse_all:
+            self.skip()
+            if self.pos < len(self.string):
+                tokens = None
+        return tokens
+
+    def action(self, action, tokens):
+        '''Applies the parse action to the tokens of an element.'''
+        if self.set_parse_actions:
+            return [action(self.string, self.pos, tokens)]
+        return tokens
+
+    def skip(self):
+        '''Skips whitespace and comments.'''
+        self.pos = _TGREP_SKIP.match(self.string, self.pos).end()
+
+    def fail(self, start):
+        '''
+        Resets the position to `start`, where the element which failed
+        to match began.  Failures are not recorded: search strings
+        which the parser rejects are parsed again with pyparsing to
+        report the error (see `_parse_tgrep_string`).
+        '''
+        self.pos = start
+
+    def literal(self, text, skip=True):
+        '''Matches the given text.'''
+        if skip:
+            self.skip()
+        if self.string.startswith(text, self.pos):
+            self.pos += len(text)
+            return text
+        return None
+
+    def regex(self, regex, skip=True):
+        '''Matches the given regular expression.'''
+        if skip:
+            self.skip()
+        match = regex.match(self.string, self.pos)
+        if match is None:
+            return None
+        self.pos = match.end()
+        return match.group()
+
+    def combine(self, prefix, regex):
+        '''
+        Matches the prefix, immediately followed by the regular
+        expression, as a single token.
+        '''
+        start = self.pos
+        if self.literal(prefix) is None:
+            return None
+        rest = self.regex(regex, False)
+        if rest is None:
+            self.fail(start)
+            return None
+        return prefix + rest
+
+    def node_expr(self):
+        '''`tgrep_node_expr`: a node name, macro use or label use.'''
+        start = self.pos
+        token = self.combine('=', _TGREP_NODE_LABEL)
+        if token is not None:
+            return self.action(_tgrep_node_label_pred_use_action, [token])
+        token = self.combine('@', _TGREP_MACRO_NAME)
+        if token is not None:
+            return self.action(_tgrep_macro_use_action, [token])
+        tokens = self.tree_position()
+        if tokens is not None:
+            return tokens
+        for regex in (_TGREP_QSTRING_ICASE, _TGREP_NODE_REGEX_ICASE,
+                      _TGREP_QSTRING, _TGREP_NODE_REGEX):
+            token = self.regex(regex)
+            if token is not None:
+                return [token]
+        token = self.literal('*')
+        if token is None:
+            token = self.regex(_TGREP_NODE_LITERAL)
+        if token is None:
+            self.fail(start)
+            return None
+        return [token]
+
+    def tree_position(self):
+        '''`tgrep_nltk_tree_pos`: an NLTK tree position.'''
+        start = self.pos
+        if self.literal('N(') is None:
+            return None
+        tokens = ['N(']
+        after_open = self.pos
+        number = self.regex(_TGREP_NUMBER)
+        if number is not None and self.literal(',') is not None:
+            tokens.extend([number, ','])
+            number = self.regex(_TGREP_NUMBER)
+            if number is not None:
+                tokens.append(number)
+                while True:
+                    # the commas of the delimited list are suppressed
+                    after_number = self.pos
+                    number = self.literal(',') and self.regex(_TGREP_NUMBER)
+                    if not number:
+                        self.pos = after_number
+                        break
+                    tokens.append(number)
+                after_number = self.pos
+                if self.literal(',') is not None:
+                    tokens.append(',')
+                else:
+                    self.pos = after_number
+        else:
+            self.pos = after_open
+        if self.literal(')') is None:
+            self.fail(start)
+            return None
+        tokens.append(')')
+        return self.action(_tgrep_nltk_tree_pos_action, tokens)
+
+    def node_expr2(self):
+        '''`tgrep_node_expr2`: a node expression, optionally bound.'''
+        tokens = self.node_expr()
+        if tokens is None:
+            return None
+        after_node = self.pos
+        if self.literal('=', False) is not None:
+            label = self.regex(_TGREP_NODE_LABEL, False)
+            if label is not None:
+                return self.action(_tgrep_bind_node_label_action,
+                                   tokens + ['=', label])
+            self.pos = after_node
+        return self.action(_tgrep_bind_node_label_action, tokens)
+
+    def node(self):
+        '''`tgrep_node`: a parenthesised expression, or node names.'''
+        start = self.pos
+        if self.literal('(') is not None:
+            expr = self.expr()
+            if expr is not None and self.literal(')') is not None:
+                tokens = self.action(_tgrep_parens_action,
+                                     ['('] + expr + [')'])
+                return self.action(_tgrep_node_action, tokens)
+            self.fail(start)
+        tokens = []
+        if self.literal('\'') is not None:
+            tokens.append('\'')
+        expr = self.node_expr2()
+        if expr is None:
+            self.fail(start)
+            return None
+        tokens.extend(expr)
+        while True:
+            after_node = self.pos
+            if self.literal('|') is None:
+                break
+            expr = self.node_expr()
+            if expr is None:
+                self.pos = after_node
+                break
+            tokens.append('|')
+            tokens.extend(expr)
+        return self.action(_tgrep_node_action, tokens)
+
+    def relation(self):
+        '''`tgrep_relation`: a bracketed disjunction, or a relation.'''
+        start = self.pos
+        tokens = []
+        if self.literal('!') is not None:
+            tokens.append('!')
+        if self.literal('[') is not None:
+            relations = self.relations()
+            if relations is not None and self.literal(']') is not None:
+                return self.action(_tgrep_relation_action,
+                                   tokens + ['['] + relations + [']'])
+            self.fail(start)
+            tokens = []
+            if self.literal('!') is not None:
+                tokens.append('!')
+        operator = self.regex(_TGREP_OPERATOR)
+        node = operator is not None and self.node()
+        if not node:
+            self.fail(start)
+            return None
+        return self.action(_tgrep_relation_action,
+                           tokens + [operator] + node)
+
+    def rel_conjunction(self):
+        '''`tgrep_rel_conjunction`: a conjunction of relations.'''
+        tokens = self.relation()
+        if tokens is None:
+            return None
+        while True:
+            before = self.pos
+            ampersand = self.literal('&')
+            conjunction = self.rel_conjunction()
+            if conjunction is None:
+                self.pos = before
+                break
+            if ampersand is not None:
+                tokens.append(ampersand)
+            tokens.extend(conjunction)
+        return self.action(_tgrep_conjunction_action, tokens)
+
+    def relations(self):
+        '''`tgrep_relations`: a disjunction of relation conjunctions.'''
+        tokens = self.rel_conjunction()
+        if tokens is None:
+            return None
+        while True:
+            before = self.pos
+            relations = self.literal('|') and self.relations()
+            if not relations:
+                self.pos = before
+                break
+            tokens.append('|')
+            tokens.extend(relations)
+        return self.action(_tgrep_rel_disjunction_action, tokens)
+
+    def optional_relations(self, tokens):
+        '''Appends the relations following a node, if any, to `tokens`.'''
+        relations = self.relations()
+        if relations is not None:
+            tokens.extend(relations)
+        return tokens
+
+    def expr(self):
+        '''`tgrep_expr`: a node, with the relations it stands in.'''
+        tokens = self.node()
+        if tokens is None:
+            return None
+        return self.action(_tgrep_conjunction_action,
+                           self.optional_relations(tokens))
+
+    def expr_labeled(self):
+        '''`tgrep_expr_labeled`: a segmented pattern.'''
+        label = self.combine('=', _TGREP_NODE_LABEL)
+        if label is None:
+            return None
+        tokens = self.action(_tgrep_node_label_use_action, [label])
+        return self.action(_tgrep_segmented_pattern_action,
+                           self.optional_relations(tokens))
+
+    def expr2(self):
+        '''`tgrep_expr2`: an expression, with its segmented patterns.'''
+        tokens = self.expr()
+        if tokens is None:
+            return None
+        while True:
+            before = self.pos
+            segment = self.literal(':') and self.expr_labeled()
+            if not segment:
+                self.pos = before
+                break
+            tokens.append(':')
+            tokens.extend(segment)
+        return self.action(functools.partial(_tgrep_conjunction_action,
+                                             join_char = ':'), tokens)
+
+    def macro_defn(self):
+        '''`macro_defn`: a macro definition.'''
+        start = self.pos
+        if (self.literal('@') is None or
+            self.regex(_TGREP_WHITE, False) is None):
+            self.fail(start)
+            return None
+        name = self.regex(_TGREP_MACRO_NAME, False)
+        expr = name is not None and self.expr2()
+        if not expr:
+            self.fail(start)
+            return None
+        return self.action(_macro_defn_action, ['@', name] + expr)
+
+    def exprs(self):
+        '''`tgrep_exprs`: a whole search string.'''
+        start = self.pos
+        tokens = []
+        defns = self.macro_defn()
+        if defns is not None:
+            while True:
+                before = self.pos
+                defn = self.literal(';') and self.macro_defn()
+                if not defn:
+                    self.pos = before
+                    break
+                defns.append(';')
+                defns.extend(defn)
+            if self.literal(';') is not None:
+                tokens = defns + [';']
+            else:
+                self.pos = start
+        expr = self.expr2()
+        if expr is None:
+            return None
+        tokens.extend(expr)
+        while True:
+            before = self.pos
+            item = self.literal(';') and (self.macro_defn() or self.expr2())
+            if not item:
+                self.pos = before
+                break
+            tokens.append(';')
+            tokens.extend(item)
+        while self.literal(';') is not None:
+            pass
+        return self.action(_tgrep_exprs_action, tokens)
+
+class TgrepPattern(object):
+    '''
+    A compiled TGrep search string, as returned by `tgrep_compile`.
+
+    A `TgrepPattern` is a predicate on tree nodes, and is called just
+    like the lambda functions built for the parts of the search string
+    (see the module documentation).  It also keeps the parsed pattern
+    AST (see `_tgrep_predicate`), which the set-at-a-time search
+    engine evaluates directly.  Patterns are pickled as their AST, so
+    that they can be sent to other processes.
+    '''
+
+    def __init__(self, ast, tgrep_string=None):
+        self.ast = ast
+        self.tgrep_string = tgrep_string
+        self.predicate = _tgrep_predicate(ast)
+        self.uses_labels = _tgrep_ast_uses_labels(ast)
+        self.macros = dict(ast[1])
+        self.head = _tgrep_head_constraint(ast, self.macros)
+        self._node_predicates = {}
+
+    def __call__(self, n, *args, **kwargs):
+        return self.predicate(n, *args, **kwargs)
+
+    def __reduce__(self):
+        # the predicate functions cannot be pickled, but are rebuilt
+        # from the AST without parsing the search string again
+        return (type(self), (self.ast, self.tgrep_string))
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.tgrep_string)
+
+    def node_predicate(self, ast):
+        '''
+        Returns the (cached) predicate function for the given node name
+        AST inside this pattern.
+        '''
+        try:
+            return self._node_predicates[ast]
+        except KeyError:
+            predicate = self._node_predicates[ast] = _tgrep_node_predicate(ast)
+            return predicate
+
+    def name_matches(self, ast, index):
+        '''
+        Returns the sorted ids of the nodes in the tree indexed by
+        `index` (a `TreeIndex`) which match the given node name AST
+        inside this pattern.
+
+        Literal names are looked up in the index\'s label and word
+        indices; other tests on node names (such as regular
+        expressions) are run once per distinct label or word.
+        '''
+        if _tgrep_is_name_test(ast) and index.label_ids is not None:
+            values = _tgrep_literal_values(ast)
+            if values is not None:
+                return index.ids_with_values(values)
+            return index.ids_matching(self.node_predicate(ast))
+        if ast[0] == 'treepos':
+            node_id = index.position_id(ast[1])
+            if node_id is None or not index.is_tree(node_id):
+                return []
+            return [node_id]
+        predicate = self.node_predicate(ast)
+        # the index lets tree positions be found in plain `Tree`s
+        label_dict = _LabelDict(index)
+        return [i for i, node in enumerate(index.nodes)
+                if predicate(node, None, label_dict)]
+
+    def candidate_ids(self, index):
+        '''
+        Returns the sorted ids of the nodes in the tree indexed by
+        `index` which satisfy the head constraint of this pattern (see
+        `_tgrep_head_constraint`), and so may match it; or None, if
+        the pattern has no head constraint.
+        '''
+        if self.head is None:
+            return None
+        return self.name_matches(self.head, index)
+
+    def match_ids(self, index):
+        '''
+        Returns the set of ids of the nodes in the tree indexed by
+        `index` (a `TreeIndex`) which match this pattern, using the
+        set-at-a-time engine.
+        '''
+        if self.uses_labels:
+            # node labels are bound and used per candidate node, so
+            # fall back to testing each node in turn
+            label_dict = _LabelDict(index, _new_memo())
+            search_ids = self.candidate_ids(index)
+            if search_ids is None:
+                search_ids = range(len(index))
+            return set(i for i in search_ids
+                       if self.predicate(index.nodes[i], l=label_dict))
+        return _SetEvaluator(self, index).matches(self.ast)
+
+def tgrep_tokenize(tgrep_string, parser='pyparsing'):
+    '''
+    Tokenizes a TGrep search string into separate tokens.  See
+    `tgrep_compile` for the `parser` argument.
+    '''
+    return _parse_tgrep_string(tgrep_string, False, parser)
+
+def tgrep_compile(tgrep_string, stats=None, parser='pyparsing'):
     '''
     Parses (and tokenizes, if necessary) a TGrep search string into a
-    lambda function.
+    `TgrepPattern`, a predicate function on tree nodes.
+
+    `parser` selects the parser used: 'pyparsing' (the default), or
+    'native', a hand-written parser which accepts the same grammar
+    and builds the same patterns, but compiles search strings many
+    times faster.  Both parsers report syntax errors by raising
+    `pyparsing.ParseException`.  Profiling (see `tgrep_profile`)
+    always uses pyparsing.
+
+    If `stats` (a `nltk_tgrep.corpus_stats.CorpusStatistics`) is
+    given, the parts of each conjunction and disjunction in the
+    pattern are reordered so that those most likely to decide its
+    result cheaply in the corpus described are tested first; this
+    does not change which nodes match.
     '''
-    parser = _build_tgrep_parser(True)
     if isinstance(tgrep_string, bytes):
         tgrep_string = tgrep_string.decode()
-    return list(parser.parseString(tgrep_string, parseAll=True))[0]
+    ast = _parse_tgrep_string(tgrep_string, True, parser)[0]
+    if stats is not None:
+        ast = _tgrep_reorder_ast(ast, stats, dict(ast[1]))
+    return TgrepPattern(ast, tgrep_string)
+
+CacheInfo = namedtuple('CacheInfo',
+                       ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+class TgrepPatternCache(object):
+    '''
+    A bounded, thread-safe LRU cache of compiled TGrep search strings.
+
+    Search strings are normalised (decoded to text and stripped of
+    surrounding whitespace) before lookup, so that `b'NP < DT'` and
+    `' NP < DT'` share a single cache entry.  A `maxsize` of 0
+    disables caching; a `maxsize` of None makes the cache unbounded.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._maxsize = maxsize
+        self._hits = self._misses = self._evictions = 0
+
+    @staticmethod
+    def normalize(tgrep_string):
+        '''Returns the cache key for the given TGrep search string.'''
+        if isinstance(tgrep_string, bytes):
+            tgrep_string = tgrep_string.decode()
+        return tgrep_string.strip()
+
+    def compile(self, tgrep_string, parser='pyparsing'):
+        '''
+        Returns the compiled predicate for the given TGrep search
+        string, compiling it with `tgrep_compile` and the given
+        `parser` on a cache miss.  Both parsers build the same
+        patterns, so entries are shared between them.
+        '''
+        key = self.normalize(tgrep_string)
+        with self._lock:
+            try:
+                predicate = self._entries[key]
+            except KeyError:
+                self._misses += 1
+            else:
+                self._hits += 1
+                # mark the entry as most recently used
+                del self._entries[key]
+                self._entries[key] = predicate
+                return predicate
+        # compile outside the lock; if two threads race on the same
+        # key, the second result simply replaces the first
+        predicate = tgrep_compile(key, parser=parser)
+        with self._lock:
+            if self._maxsize != 0:
+                self._entries[key] = predicate
+                self._trim()
+        return predicate
+
+    def _trim(self):
+        '''Evicts least recently used entries until under `maxsize`.'''
+        if self._maxsize is None:
+            return
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def resize(self, maxsize):
+        '''Changes the maximum size of the cache, evicting if needed.'''
+        if maxsize is not None and maxsize < 0:
+            raise ValueError('maxsize must be None or a non-negative integer')
+        with self._lock:
+            self._maxsize = maxsize
+            self._trim()
+
+    def clear(self):
+        '''Empties the cache and resets its statistics.'''
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        '''Returns a `CacheInfo` with the statistics of this cache.'''
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions,
+                             self._maxsize, len(self._entries))
+
+# the cache used when `tgrep_positions` is given a search string
+_PATTERN_CACHE = TgrepPatternCache()
+
+def tgrep_cache_info():
+    '''
+    Returns the hit, miss and eviction counts, maximum size and current
+    size of the module-level cache of compiled search strings.
+    '''
+    return _PATTERN_CACHE.info()
+
+def tgrep_cache_clear():
+    '''
+    Empties the module-level cache of compiled search strings.
+    '''
+    _PATTERN_CACHE.clear()
+
+def tgrep_set_cache_size(maxsize):
+    '''
+    Sets the maximum number of compiled search strings kept in the
+    module-level cache.  0 disables caching; None means no limit.
+    '''
+    _PATTERN_CACHE.resize(maxsize)
+
+# whether searches memoize the results of subpatterns per node
+_MEMOIZE = True
+
+def tgrep_set_memoization(enabled):
+    '''
+    Turns on or off the memoization of subpattern results during
+    node-at-a-time searches (see `_tgrep_memoized_predicate`); this
+    does not change search results, and is meant for benchmarking.
+    Memoization is on by default.
+    '''
+    global _MEMOIZE
+    _MEMOIZE = bool(enabled)
+
+def _new_memo():
+    '''Returns a new memo table for a search, or None if disabled.'''
+    return {} if _MEMOIZE else None
 
 def treepositions_no_leaves(tree):
     '''
@@ -833,33 +2971,706 @@ def treepositions_no_leaves(tree):
             prefixes.add(pos[:length])
     return [pos for pos in treepositions if pos in prefixes]
 
-def tgrep_positions(tree, tgrep_string, search_leaves = True):
+# a high-resolution clock for profiling, where available
+_PROFILE_TIMER = getattr(time, 'perf_counter', time.time)
+
+ProfileEntry = namedtuple('ProfileEntry',
+                          ['source', 'kind', 'calls', 'true', 'time',
+                           'visited'])
+
+class _ProfileCounter(object):
+    '''The statistics gathered for one subpattern while profiling.'''
+    __slots__ = ('kind', 'calls', 'true', 'time', 'visited')
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = self.true = 0
+        self.time = 0.0
+        # only counted for relations
+        self.visited = None
+
+class _TgrepPatternProfile(object):
+    '''
+    Profiles the searches for one TGrep search string: `pattern` is a
+    `TgrepPattern` whose predicates count their calls and true
+    results, and time themselves, for each subpattern with a source
+    span (see `_parse_tgrep_spans`).  Relations also count the nodes
+    they visit, i.e., the calls they make to the predicate of their
+    target.
+
+    When several AST nodes share the same span (as with a relation
+    and its negation), the outermost one is instrumented.
+    '''
+
+    def __init__(self, tgrep_string):
+        ast, self._spans, self._span_nodes = _parse_tgrep_spans(tgrep_string)
+        self.tgrep_string = tgrep_string
+        # the walk visits outer AST nodes before the nodes inside them
+        self._owners = {}
+        counters = {}
+        for node in _tgrep_ast_walk(ast):
+            span = self._spans.get(id(node))
+            if span is not None and span not in self._owners:
+                self._owners[span] = id(node)
+                counters[span] = _ProfileCounter(node[0])
+            if node[0] == 'rel' and span is not None:
+                counters[span].visited = 0
+        # order the subpatterns by their position in the search string
+        self._counters = OrderedDict(
+            sorted(counters.items(),
+                   key=lambda item: (item[0][0], -item[0][1])))
+        self.pattern = TgrepPattern(ast, tgrep_string)
+        self.pattern.predicate = _tgrep_predicate(ast, profile=self)
+
+    def instrument(self, ast, predicate):
+        '''
+        Wraps the predicate of the given AST node to profile it, if the
+        node has its own source span.
+        '''
+        span = self._spans.get(id(ast))
+        if span is None or self._owners[span] != id(ast):
+            return predicate
+        counter = self._counters[span]
+        def profiled_pred(n, *args, **kwargs):
+            counter.calls += 1
+            start = _PROFILE_TIMER()
+            try:
+                result = predicate(n, *args, **kwargs)
+            finally:
+                counter.time += _PROFILE_TIMER() - start
+            if result:
+                counter.true += 1
+            return result
+        return profiled_pred
+
+    def count_visits(self, ast, target):
+        '''
+        Wraps the predicate on the target of the given relation AST
+        node to count the nodes visited by the relation.
+        '''
+        span = self._spans.get(id(ast))
+        if span is None:
+            return target
+        counter = self._counters[span]
+        def visit_pred(n, m=None, l=None):
+            counter.visited += 1
+            return target(n, m, l)
+        return visit_pred
+
+    def report(self):
+        '''
+        Returns an `OrderedDict` mapping the `(start, end)` source span
+        of each subpattern onto its `ProfileEntry`, in order of
+        position in the search string.
+        '''
+        return OrderedDict(
+            ((start, end), ProfileEntry(self.tgrep_string[start:end],
+                                        counter.kind, counter.calls,
+                                        counter.true, counter.time,
+                                        counter.visited))
+            for (start, end), counter in self._counters.items())
+
+class TgrepProfile(object):
+    '''
+    The profile of the searches made inside a `tgrep_profile` block.
+
+    For each subpattern of each search string searched for (keyed by
+    its source span), the profile records the number of times it was
+    tested against a node, the number of times it was true, the
+    cumulative time spent testing it (including the time spent in
+    the subpatterns inside it), and, for relations, the number of
+    nodes the relation visited (None, for other subpatterns).
+    '''
+
+    def __init__(self):
+        self._patterns = OrderedDict()
+
+    def pattern(self, tgrep_string):
+        '''
+        Returns the profiled `TgrepPattern` to search with in place of
+        the given search string or `TgrepPattern`.  Patterns whose
+        search string is unknown (and other predicates) are returned
+        unchanged.
+        '''
+        if isinstance(tgrep_string, TgrepPattern):
+            tgrep_string = tgrep_string.tgrep_string
+        if isinstance(tgrep_string, bytes):
+            tgrep_string = tgrep_string.decode()
+        if not isinstance(tgrep_string, str):
+            return tgrep_string
+        try:
+            return self._patterns[tgrep_string].pattern
+        except KeyError:
+            profile = self._patterns[tgrep_string] = _TgrepPatternProfile(
+                tgrep_string)
+            return profile.pattern
+
+    def report(self, tgrep_string=None):
+        '''
+        Returns an `OrderedDict` mapping the `(start, end)` span of each
+        subpattern of the given search string onto its `ProfileEntry`.
+        `tgrep_string` may be omitted if only one search string was
+        profiled.
+        '''
+        if tgrep_string is None:
+            if len(self._patterns) != 1:
+                raise TgrepException('{0} search strings were profiled; '
+                                     'specify one'.format(len(self._patterns)))
+            tgrep_string = next(iter(self._patterns))
+        if isinstance(tgrep_string, TgrepPattern):
+            tgrep_string = tgrep_string.tgrep_string
+        if isinstance(tgrep_string, bytes):
+            tgrep_string = tgrep_string.decode()
+        if tgrep_string not in self._patterns:
+            raise TgrepException(
+                'search string "{0}" was not profiled'.format(tgrep_string))
+        return self._patterns[tgrep_string].report()
+
+    def format(self):
+        '''
+        Returns the profiles of all search strings as a table, with the
+        subpatterns indented under the subpatterns containing them.
+        '''
+        lines = []
+        for tgrep_string in self._patterns:
+            lines.append('{0:>8} {1:>8} {2:>10} {3:>8}  {4}'.format(
+                'calls', 'true', 'time (ms)', 'visited', tgrep_string))
+            enclosing = []
+            for (start, end), entry in self.report(tgrep_string).items():
+                while enclosing and enclosing[-1] < end:
+                    enclosing.pop()
+                lines.append('{0:>8} {1:>8} {2:>10.3f} {3:>8}  {4}{5}'.format(
+                    entry.calls, entry.true, entry.time * 1000,
+                    '' if entry.visited is None else entry.visited,
+                    '  ' * len(enclosing), entry.source))
+                enclosing.append(end)
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.format()
+
+_PROFILES = threading.local()
+
+def _active_profile():
+    '''Returns the innermost active `TgrepProfile` of this thread.'''
+    stack = getattr(_PROFILES, 'stack', None)
+    return stack[-1] if stack else None
+
+@contextlib.contextmanager
+def tgrep_profile():
+    '''
+    A context manager which profiles the searches made inside it
+    (with `tgrep_positions`, `tgrep_nodes`, `search_corpus`, etc.),
+    and gives the `TgrepProfile` collecting the results::
+
+        with tgrep_profile() as profile:
+            tgrep_positions(tree, 'NP < DT')
+        print(profile)
+
+    While profiling, searches use the node engine, and are slower.
+    Profiling requires pyparsing 3.0 or later.
+    '''
+    import pyparsing
+    if not hasattr(pyparsing, 'Located'):
+        raise TgrepException('profiling requires pyparsing 3.0 or later')
+    profile = TgrepProfile()
+    if getattr(_PROFILES, 'stack', None) is None:
+        _PROFILES.stack = []
+    _PROFILES.stack.append(profile)
+    try:
+        yield profile
+    finally:
+        _PROFILES.stack.remove(profile)
+
+# the cost of evaluating each relation: with the node engine, for
+# each node tested; with the set engine, for each tree (see
+# `_tgrep_relation_join`).  n is the number of nodes in the tree, d
+# its depth, b the fan-out of its nodes, and |B| the number of nodes
+# matching the target of the relation.
+_TGREP_RELATION_COSTS = {
+    'node': {
+        '<': 'O(b)', '>': 'O(1)', '<N': 'O(1)', '>N': 'O(1)', '<:': 'O(1)',
+        '>:': 'O(1)', '<<': 'O(n)', '>>': 'O(d)', '<<,': 'O(d)',
+        '>>,': 'O(d)', '<<\'': 'O(d)', '>>\'': 'O(d)', '<<:': 'O(d)',
+        '>>:': 'O(d)', '.': 'O(d)', ',': 'O(d)', '..': 'O(n)', ',,': 'O(n)',
+        '$': 'O(b)', '$.': 'O(1)', '$,': 'O(1)', '$..': 'O(b)', '$,,': 'O(b)',
+    },
+    'set': {
+        '<': 'O(|B|)', '>': 'O(|B| b)', '<N': 'O(|B|)', '>N': 'O(|B| b)',
+        '<:': 'O(|B|)', '>:': 'O(|B| b)', '<<': 'O(n)', '>>': 'O(n)',
+        '<<,': 'O(|B| d)', '>>,': 'O(|B| d)', '<<\'': 'O(|B| d)',
+        '>>\'': 'O(|B| d)', '<<:': 'O(|B| d)', '>>:': 'O(|B| d)',
+        '.': 'O(|B| d)', ',': 'O(|B| d)', '..': 'O(n)', ',,': 'O(n)',
+        '$': 'O(|B| b)', '$.': 'O(|B| b)', '$,': 'O(|B| b)',
+        '$..': 'O(|B| b)', '$,,': 'O(|B| b)',
+    },
+}
+
+def _tgrep_relation_cost(operator, engine):
+    '''
+    Returns the complexity class of evaluating the relation given by
+    the tgrep `operator` with the given engine (see
+    `_TGREP_RELATION_COSTS`).
+    '''
+    operator = _tgrep_canonical_operator(operator)
+    if operator[0] in '<>' and operator[1:].lstrip('-').isdigit():
+        operator = operator[0] + 'N'
+    try:
+        return _TGREP_RELATION_COSTS[engine][operator]
+    except KeyError:
+        raise TgrepException(
+            'cannot interpret tgrep operator "{0}"'.format(operator))
+
+PlanStep = namedtuple('PlanStep', ['depth', 'kind', 'text', 'cost',
+                                   'quadratic', 'selectivity'])
+
+class TgrepPlan(object):
+    '''
+    The plan of a search, as returned by `tgrep_explain`.
+
+    `steps` lists the nodes of the operator tree of the search string,
+    in preorder, as `PlanStep` tuples giving the depth of each node in
+    the operator tree, its kind (see `_tgrep_predicate`), its text,
+    and, for relations, the complexity class of evaluating it (with
+    the node engine, per node tested; with the set engine, per tree)
+    and whether this makes the search quadratic in the size of the
+    tree.  Given corpus statistics, each step also carries its
+    estimated selectivity, the fraction of nodes in the corpus which
+    match it; otherwise, this is None.
+    '''
+
+    def __init__(self, source, engine, steps, mean_size=None, note=None):
+        self.source = source
+        self.engine = engine
+        self.steps = steps
+        self.mean_size = mean_size
+        self.note = note
+
+    @property
+    def quadratic(self):
+        '''The steps which make the search quadratic in tree size.'''
+        return [step for step in self.steps if step.quadratic]
+
+    @property
+    def estimated_matches(self):
+        '''
+        The estimated number of matches per tree, or None without
+        corpus statistics.
+        '''
+        if self.mean_size is None:
+            return None
+        return self.steps[0].selectivity * self.mean_size
+
+    def format(self):
+        '''
+        Returns the plan as a table, with the operator tree indented.
+        '''
+        lines = [self.source,
+                 'engine: {0}{1}'.format(self.engine, ' ({0})'.format(
+                     self.note) if self.note else ''),
+                 '{0:>10} {1:>11}  {2}'.format('cost', 'selectivity', 'plan')]
+        for step in self.steps:
+            lines.append('{0:>10} {1:>11}  {2}{3}'.format(
+                (step.cost or '') + (' *' if step.quadratic else ''),
+                '' if step.selectivity is None else '{0:.3g}'.format(
+                    step.selectivity),
+                '  ' * step.depth, step.text))
+        if self.estimated_matches is not None:
+            lines.append('estimated matches per tree: {0:.3g}'.format(
+                self.estimated_matches))
+        if self.quadratic:
+            lines.append('* quadratic in the size of the tree')
+        lines.append('n: nodes in the tree; d: depth; b: fan-out; '
+                     '|B|: nodes matching the target')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.format()
+
+def _tgrep_plan_steps(ast, engine, stats, steps, depth=0):
+    '''
+    Appends to `steps` the `PlanStep` tuples of the operator tree of
+    the given (macro-free) pattern AST (see `tgrep_explain`).
+    '''
+    kind = ast[0]
+    selectivity = None if stats is None else stats.selectivity(ast)
+    cost = None
+    children = ()
+    if kind == 'exprs' and len(ast[2]) == 1:
+        return _tgrep_plan_steps(ast[2][0], engine, stats, steps, depth)
+    elif kind in ('exprs', 'and', 'or'):
+        text = 'or' if kind == 'exprs' else kind
+        children = ast[2] if kind == 'exprs' else ast[1]
+    elif kind == 'rel' or (kind == 'not' and ast[1][0] == 'rel'):
+        relation = ast if kind == 'rel' else ast[1]
+        text = ('!' if kind == 'not' else '') + relation[1]
+        cost = _tgrep_relation_cost(relation[1], engine)
+        children = (relation[2],)
+    elif kind == 'not':
+        text = 'not'
+        children = (ast[1],)
+    elif kind == 'segment':
+        text = ': =' + ast[1]
+        children = ast[2]
+    elif kind == 'bind' and not _tgrep_is_name_test(ast[1]):
+        text = 'bind =' + ast[2]
+        children = (ast[1],)
+    else:
+        text = _tgrep_ast_source(ast)
+    steps.append(PlanStep(depth, kind, text, cost,
+                          engine == 'node' and cost == 'O(n)', selectivity))
+    for child in children:
+        _tgrep_plan_steps(child, engine, stats, steps, depth + 1)
+
+def tgrep_explain(tgrep_string, engine = 'node', stats = None):
+    '''
+    Returns the `TgrepPlan` of searching for the given `tgrep_string`
+    (a search string or a `TgrepPattern`) with the given engine (see
+    `tgrep_positions`); print it to see the operator tree of the
+    search string, with its macros expanded and its operators
+    normalised (e.g., `<,` is shown as `<1`), and each relation
+    annotated with its complexity class::
+
+        >>> print(tgrep_explain('S << NP .. VP'))
+
+    A relation which costs O(n) for each node tested makes the whole
+    search quadratic in the size of the tree; `TgrepPlan.quadratic`
+    lists such relations.  If `stats` (a
+    `nltk_tgrep.corpus_stats.CorpusStatistics`) is given, each step of
+    the plan is also annotated with its estimated selectivity.
+    '''
+    if engine not in _TGREP_RELATION_COSTS:
+        raise TgrepException('unknown tgrep engine "{0}"'.format(engine))
+    pattern = tgrep_string
+    if not isinstance(pattern, TgrepPattern):
+        pattern = _PATTERN_CACHE.compile(tgrep_string)
+    note = None
+    if engine == 'set' and pattern.uses_labels:
+        engine = 'node'
+        note = 'the set engine falls back on it for node labels'
+    ast = _tgrep_canonical_ast(_tgrep_expand_macros(pattern.ast,
+                                                    pattern.macros))
+    steps = []
+    _tgrep_plan_steps(ast, engine, stats, steps)
+    return TgrepPlan(_tgrep_ast_source(ast), engine, steps,
+                     None if stats is None else stats.mean_size, note)
+
+def _tgrep_match_ids(tree, tgrep_string, search_leaves, engine, limit=None,
+                     parser='pyparsing'):
+    '''
+    Indexes the given tree, and returns its `TreeIndex` together with
+    an iterator over the ids of the nodes matching `tgrep_string`, in
+    preorder (see `tgrep_positions`), which stops after `limit` ids if
+    `limit` is given.  With the node engine, nodes are
+    tested as the iterator advances, and the third value returned is
+    the `_LabelDict` passed to the predicate, which holds the labels
+    bound by the latest match; with the set engine, it is None.
+    Search strings are compiled with the given `parser`.
+    '''
+    if not _istree(tree):
+        return None, iter(()), None
+    profile = _active_profile()
+    if profile is not None:
+        tgrep_string = profile.pattern(tgrep_string)
+        engine = 'node'
+    if isinstance(tgrep_string, (bytes, str)):
+        tgrep_string = _PATTERN_CACHE.compile(tgrep_string, parser)
+    index = TreeIndex(tree)
+    nodes = index.nodes
+    if engine == 'node':
+        label_dict = _LabelDict(index, _new_memo())
+        search_ids = None
+        if isinstance(tgrep_string, TgrepPattern):
+            # only visit the nodes which can satisfy the pattern's head
+            search_ids = tgrep_string.candidate_ids(index)
+        if search_ids is None:
+            search_ids = range(len(nodes))
+        if not search_leaves:
+            search_ids = (i for i in search_ids if not index.is_leaf(i))
+        if isinstance(tgrep_string, TgrepPattern):
+            search_ids = (i for i in search_ids
+                          if tgrep_string(nodes[i], l=label_dict))
+        else:
+            # other predicates are called with just the node
+            search_ids = (i for i in search_ids if tgrep_string(nodes[i]))
+    elif engine == 'set':
+        if not isinstance(tgrep_string, TgrepPattern):
+            raise TgrepException('the set engine needs a search string or a '
+                                 'pattern built by tgrep_compile')
+        search_ids = sorted(tgrep_string.match_ids(index))
+        if not search_leaves:
+            search_ids = [i for i in search_ids if not index.is_leaf(i)]
+        search_ids = iter(search_ids)
+        label_dict = None
+    else:
+        raise TgrepException('unknown tgrep engine "{0}"'.format(engine))
+    if limit is not None:
+        search_ids = itertools.islice(search_ids, max(limit, 0))
+    return index, search_ids, label_dict
+
+def iter_tgrep_positions(tree, tgrep_string, search_leaves = True,
+                         engine = 'node', limit = None, parser = 'pyparsing'):
+    '''
+    Yields the tree positions in the given tree which match the given
+    `tgrep_string`, as they are found.  See `tgrep_positions` for the
+    meaning of the arguments.
+    '''
+    index, match_ids, _label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, limit, parser)
+    for node_id in match_ids:
+        yield index.treeposition(node_id)
+
+def iter_tgrep_nodes(tree, tgrep_string, search_leaves = True,
+                     engine = 'node', limit = None, parser = 'pyparsing'):
+    '''
+    Yields the tree nodes in the given tree which match the given
+    `tgrep_string`, as they are found.  See `tgrep_positions` for the
+    meaning of the arguments.
+    '''
+    index, match_ids, _label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, limit, parser)
+    for node_id in match_ids:
+        yield index.nodes[node_id]
+
+def tgrep_positions(tree, tgrep_string, search_leaves = True,
+                    engine = 'node', limit = None, parser = 'pyparsing'):
     '''
     Return all tree positions in the given tree which match the given
     `tgrep_string`.
 
     If `search_leaves` is False, the method will not return any
     results in leaf positions.
+
+    `tree` may be a plain `nltk.tree.Tree`: all relations are looked
+    up in a `TreeIndex` of the tree, so it need not be converted to a
+    `ParentedTree` first.
+
+    `tgrep_string` may be a search string or a predicate built by
+    `tgrep_compile`; search strings are compiled through a shared LRU
+    cache (see `tgrep_cache_info`), with the given `parser` (see
+    `tgrep_compile`).
+
+    `engine` selects how the search is evaluated.  The default
+    engine, 'node', tests each node in turn against the compiled
+    predicate.  The 'set' engine instead evaluates each subpattern
+    once, bottom-up, into the set of all nodes matching it, and
+    combines these sets; this avoids re-testing inner subpatterns for
+    every candidate node, and gives the same results.
+
+    If `limit` is given, at most that many positions (the first ones,
+    in preorder) are returned; with the node engine, the search stops
+    as soon as they have been found.
     '''
-    try:
-        if search_leaves:
-            search_positions = tree.treepositions()
-        else:
-            search_positions = treepositions_no_leaves(tree)
-    except AttributeError:
-        return []
-    if isinstance(tgrep_string, (bytes, str)):
-        tgrep_string = tgrep_compile(tgrep_string)
-    return [position for position in search_positions
-            if tgrep_string(tree[position])]
+    return list(iter_tgrep_positions(tree, tgrep_string, search_leaves,
+                                     engine, limit, parser))
 
-def tgrep_nodes(tree, tgrep_string, search_leaves = True):
+def tgrep_nodes(tree, tgrep_string, search_leaves = True, engine = 'node',
+                limit = None, parser = 'pyparsing'):
     '''
     Return all tree nodes in the given tree which match the given
     `tgrep_ string`.
 
     If `search_leaves` is False, the method will not return any
-    results in leaf positions.
+    results in leaf positions.  See `tgrep_positions` for the meaning
+    of `engine`, `limit` and `parser`.
+    '''
+    return list(iter_tgrep_nodes(tree, tgrep_string, search_leaves, engine,
+                                 limit, parser))
+
+def tgrep_exists(tree, tgrep_string, search_leaves = True, engine = 'node',
+                 parser = 'pyparsing'):
     '''
-    return [tree[position] for position in tgrep_positions(tree, tgrep_string,
-                                                           search_leaves)]
+    Returns True if any node in the given tree matches the given
+    `tgrep_string`.  With the node engine, the search stops at the
+    first match.  See `tgrep_positions` for the meaning of the
+    arguments.
+    '''
+    _index, match_ids, _label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, parser=parser)
+    return next(match_ids, None) is not None
+
+def tgrep_first(tree, tgrep_string, search_leaves = True, engine = 'node',
+                parser = 'pyparsing'):
+    '''
+    Returns the tree position of the first node (in preorder) in the
+    given tree which matches the given `tgrep_string`, or None if
+    there is none.  With the node engine, the search stops at the
+    first match.  See `tgrep_positions` for the meaning of the
+    arguments.
+    '''
+    index, match_ids, _label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, parser=parser)
+    node_id = next(match_ids, None)
+    return None if node_id is None else index.treeposition(node_id)
+
+def tgrep_count(tree, tgrep_string, search_leaves = True, engine = 'node',
+                limit = None, parser = 'pyparsing'):
+    '''
+    Returns the number of nodes in the given tree which match the
+    given `tgrep_string`, without building a list of them.  If `limit`
+    is given, counting stops there (e.g. ``limit=2`` tells whether a
+    tree has more than one match).  See `tgrep_positions` for the
+    meaning of the other arguments.
+    '''
+    _index, match_ids, _label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, limit, parser)
+    return sum(1 for _node_id in match_ids)
+
+TgrepMatch = namedtuple('TgrepMatch', ['position', 'node', 'label_positions',
+                                       'label_nodes'])
+
+def tgrep_matches(tree, tgrep_string, search_leaves = True, engine = 'node',
+                  limit = None, parser = 'pyparsing'):
+    '''
+    Yields a `TgrepMatch` for each node in the given tree which matches
+    the given `tgrep_string`, as it is found.  A match gives the tree
+    position of the node and the node itself, and dictionaries mapping
+    the node labels bound by the match (e.g. ``n`` in ``NP=n < DT``)
+    onto the tree positions and the nodes they are bound to.
+
+    The bindings are those left by the test which found the match, so
+    no second search is needed to find them.  A leaf bound to a label
+    has no known tree position (see `TreeIndex`), unless it is the
+    matching node itself; its position is given as None.
+
+    See `tgrep_positions` for the meaning of the arguments; patterns
+    which bind node labels are always searched with the node engine,
+    since the set engine does not bind them.
+    '''
+    if isinstance(tgrep_string, (bytes, str)):
+        tgrep_string = _PATTERN_CACHE.compile(tgrep_string, parser)
+    if (isinstance(tgrep_string, TgrepPattern) and
+            _tgrep_ast_binds_labels(tgrep_string.ast)):
+        engine = 'node'
+    index, match_ids, label_dict = _tgrep_match_ids(
+        tree, tgrep_string, search_leaves, engine, limit)
+    for node_id in match_ids:
+        position = index.treeposition(node_id)
+        node = index.nodes[node_id]
+        label_positions = {}
+        label_nodes = {}
+        if label_dict is not None and label_dict.bindings is not None:
+            for label, bound in label_dict.bindings.items():
+                bound_id = node_id if bound is node else index.node_id(bound)
+                label_positions[label] = (None if bound_id is None else
+                                          index.treeposition(bound_id))
+                label_nodes[label] = bound
+            label_dict.bindings = None
+        yield TgrepMatch(position, node, label_positions, label_nodes)
+
+def search_corpus(trees, tgrep_string, search_leaves = True, engine = 'node',
+                  limit = None, parser = 'pyparsing'):
+    '''
+    Searches a corpus of trees for the given `tgrep_string`, and
+    yields a `(tree_index, position, node)` triple for each match, as
+    it is found, where `tree_index` counts the trees from 0.
+
+    `trees` may be any iterable of trees, such as a lazily read
+    corpus; only one tree is searched at a time, and nothing is kept
+    from the trees already searched.  If `limit` is given, the search
+    stops after that many matches.  See `tgrep_positions` for the
+    meaning of the other arguments.
+    '''
+    if isinstance(tgrep_string, (bytes, str)):
+        tgrep_string = _PATTERN_CACHE.compile(tgrep_string, parser)
+    if limit is not None and limit <= 0:
+        return
+    num_found = 0
+    for tree_index, tree in enumerate(trees):
+        index, match_ids, _label_dict = _tgrep_match_ids(
+            tree, tgrep_string, search_leaves, engine,
+            None if limit is None else limit - num_found)
+        for node_id in match_ids:
+            yield tree_index, index.treeposition(node_id), index.nodes[node_id]
+            num_found += 1
+        if limit is not None and num_found >= limit:
+            return
+
+def filter_corpus(trees, tgrep_string, search_leaves = True, engine = 'node',
+                  parser = 'pyparsing'):
+    '''
+    Yields a `(tree_index, tree)` pair for each tree in the corpus
+    `trees` which contains a match for the given `tgrep_string` (see
+    `tgrep_exists`): with the node engine, each tree is only searched
+    up to its first match.  See `search_corpus` for the meaning of the
+    arguments.
+    '''
+    if isinstance(tgrep_string, (bytes, str)):
+        tgrep_string = _PATTERN_CACHE.compile(tgrep_string, parser)
+    for tree_index, tree in enumerate(trees):
+        if tgrep_exists(tree, tgrep_string, search_leaves, engine):
+            yield tree_index, tree
+
+class PatternSet(object):
+    '''
+    A collection of TGrep patterns which are searched for together.
+
+    Each tree is indexed once for all the patterns, and the patterns
+    are evaluated by the set-at-a-time engine (see `_SetEvaluator`)
+    with their macros expanded, sharing a single table of results, so
+    that a subpattern which occurs in several patterns (such as
+    ``NP < DT``, or the expansion of a macro) is evaluated only once
+    per tree.  Patterns which use node labels are evaluated on their
+    own, on the shared index.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = [pattern if isinstance(pattern, TgrepPattern)
+                         else _PATTERN_CACHE.compile(pattern)
+                         for pattern in patterns]
+        # the macro-free AST of each pattern, or None for the patterns
+        # which must be evaluated on their own
+        self._asts = []
+        for pattern in self.patterns:
+            ast = None
+            if not pattern.uses_labels:
+                try:
+                    ast = _tgrep_expand_macros(pattern.ast, pattern.macros)
+                except TgrepException:
+                    # leave the error to be reported by a search
+                    pass
+            self._asts.append(ast)
+        self._shared = TgrepPattern(
+            ('exprs', (), tuple(ast for ast in self._asts if ast is not None)))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match_ids(self, index, search_leaves = True):
+        '''
+        Returns, for each pattern, the sorted ids of the nodes matching
+        it in the tree indexed by `index` (a `TreeIndex`).
+        '''
+        evaluator = _SetEvaluator(self._shared, index)
+        results = []
+        for pattern, ast in zip(self.patterns, self._asts):
+            if ast is None:
+                ids = sorted(pattern.match_ids(index))
+            else:
+                ids = sorted(evaluator.matches(ast))
+            if not search_leaves:
+                ids = [i for i in ids if not index.is_leaf(i)]
+            results.append(ids)
+        return results
+
+    def positions(self, tree, search_leaves = True):
+        '''
+        Returns, for each pattern, the list of tree positions in the
+        given tree which match it (see `tgrep_positions`).
+        '''
+        if not _istree(tree):
+            return [[] for _pattern in self.patterns]
+        index = TreeIndex(tree)
+        return [[index.treeposition(i) for i in ids]
+                for ids in self.match_ids(index, search_leaves)]
+
+    def nodes(self, tree, search_leaves = True):
+        '''
+        Returns, for each pattern, the list of tree nodes in the given
+        tree which match it (see `tgrep_nodes`).
+        '''
+        if not _istree(tree):
+            return [[] for _pattern in self.patterns]
+        index = TreeIndex(tree)
+        return [[index.nodes[i] for i in ids]
+                for ids in self.match_ids(index, search_leaves)]